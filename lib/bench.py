@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+
+"""The benchmark methods
+"""
+
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import datetime
+import contextlib
+
+import jinja2
+
+from unidecode import unidecode
+
+import lib.db
+import lib.bloom
+
+from lib.db import db_connect, db_close, mobile_or_desktop, create_random_index, \
+    create_grid_indexes, get_random_item, get_sampled_item, insert_item, read_item_content
+
+from lib.item import Item
+
+from lib.parser import magic_decoding, iter_magic_decoding, magic_parser, \
+    build_discovery_kwargs, get_discovery_kwargs, parse_title
+
+from lib.rewriter import rewrite_content
+
+BENCH_DATABASE = 'randomery_bench'
+LIB_DIR_ABSPATH = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES_DIRPATH = os.path.join(LIB_DIR_ABSPATH, '../templates')
+CSS_DIRPATH = os.path.join(LIB_DIR_ABSPATH, '../static/css')
+BASELINE_FILEPATH = os.path.join(LIB_DIR_ABSPATH, '../bench_baseline.json')
+CORPUS_SEED = 42
+# (number of pages, number of paragraphs, number of links/imgs per paragraph)
+CORPUS_PROFILES = [(20, 5, 2), (20, 50, 5), (10, 400, 10)]
+DISCOVER_SAMPLES = 100
+REGRESSION_TOLERANCE = 0.2
+STAGE_PERCENTILES = [50, 95, 99]
+BENCH_INSERT_BATCH_SIZE = 10000
+SAMPLER_CORPUS_SIZES = [1000, 10000, 100000, 1000000]
+SAMPLER_DRAWS = 200
+DECODING_ROUNDS = 5
+DECODING_CHUNK_SIZE = 261120 # a GridFS chunk
+NON_LATIN_WORDS = ['\u043f\u0440\u0438\u0432\u0435\u0442', '\u5317\u4eac', \
+    '\u0395\u03bb\u03bb\u03ac\u03b4\u03b1', '\u0645\u0631\u062d\u0628\u0627', '\U0001f600']
+
+def percentile(values, pct):
+    """
+        Compute a percentile.
+
+        :param values: Some measures
+        :param pct: The percentile (between 0 and 100)
+        :type values: list
+        :type pct: int
+        :return: The percentile of the measures
+        :rtype: float
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = int(round((len(ordered) - 1) * pct / 100.0))
+    return ordered[index]
+
+def time_calls(method, count):
+    """
+        Time several calls of a method.
+
+        :param method: A method without parameters
+        :param count: The number of calls
+        :type method: function
+        :type count: int
+        :return: The duration of each call in ms
+        :rtype: list
+    """
+    durations = list()
+    for _ in range(count):
+        start_time = time.time()
+        method()
+        durations.append((time.time() - start_time) * 1000)
+    return durations
+
+@contextlib.contextmanager
+def use_bench_database(conn):
+    """
+        Switch the db methods to the benchmark database.
+
+        This point the db methods to the BENCH_DATABASE database (dropped before and
+        after) and the known links filter to a temporary directory (so there is no
+        filter), so benchmarks never touch the real data. Both are restored at the end.
+
+        :param conn: A mongo connection
+        :type conn: MongoClient
+        :return: A context manager
+        :rtype: GeneratorContextManager
+    """
+    database, bloom_filepath = lib.db.MONGO_DATABASE, lib.bloom.BLOOM_FILEPATH
+    links_filter = dict(lib.bloom.LINKS_FILTER)
+    bloom_dirpath = tempfile.mkdtemp(prefix='randomery-bench-')
+    conn.drop_database(BENCH_DATABASE)
+    lib.db.MONGO_DATABASE = BENCH_DATABASE
+    lib.bloom.BLOOM_FILEPATH = os.path.join(bloom_dirpath, 'links.bloom')
+    lib.bloom.LINKS_FILTER.update({'filter': None, 'checked_at': 0, 'dropped': None})
+    try:
+        yield
+    finally:
+        conn.drop_database(BENCH_DATABASE)
+        lib.db.MONGO_DATABASE = database
+        lib.bloom.BLOOM_FILEPATH = bloom_filepath
+        lib.bloom.LINKS_FILTER.update(links_filter)
+        shutil.rmtree(bloom_dirpath, ignore_errors=True)
+
+def grow_files_collection(conn, mobile, current_size, size):
+    """
+        Grow a data collection with synthetic file documents.
+
+        Only the file documents are inserted (without chunks), it's all the
+        samplers need.
+
+        :param conn: A mongo connection
+        :param mobile: The mobile flag
+        :param current_size: The current number of documents
+        :param size: The wanted number of documents
+        :type conn: MongoClient
+        :type mobile: bool
+        :type current_size: int
+        :type size: int
+        :return: Nothing
+        :rtype: None
+    """
+    files_collection = conn[BENCH_DATABASE]['{}.files'.format(mobile_or_desktop(mobile))]
+    for start in range(current_size, size, BENCH_INSERT_BATCH_SIZE):
+        docs = list()
+        for index in range(start, min(start + BENCH_INSERT_BATCH_SIZE, size)):
+            link = 'https://bench{}.example.com/item/{}'.format(index % 1000, index)
+            docs.append({
+                'filename': link,
+                'length': 0,
+                'chunkSize': 261120,
+                'uploadDate': datetime.datetime.now(),
+                'md5': 'd41d8cd98f00b204e9800998ecf8427e',
+                'metadata': {'title': 'Item {}'.format(index), 'link': link, \
+                    'feed': '', 'username': 'bench', 'random': random.random()}
+            })
+        files_collection.insert_many(docs, ordered=False)
+    files_collection.create_index('filename')
+
+def bench_sampler(sizes=None, draws=SAMPLER_DRAWS):
+    """
+        Benchmark the random item samplers.
+
+        This compare the random key sampler with the MongoDB internal randomizer
+        while the corpus grows (needs a running mongod, uses a dedicated database).
+
+        :param sizes: The corpus sizes
+        :param draws: The number of draws per size
+        :type sizes: list
+        :type draws: int
+        :return: The p50/p95 latencies (ms) per size and sampler
+        :rtype: list
+    """
+    conn = db_connect()
+    results = list()
+    current_size = 0
+    print '{:>10} {:>12} {:>12} {:>12} {:>12}'.format( \
+        'items', 'key p50', 'key p95', 'sample p50', 'sample p95')
+    with use_bench_database(conn):
+        create_random_index(conn, False)
+        for size in sizes or SAMPLER_CORPUS_SIZES:
+            grow_files_collection(conn, False, current_size, size)
+            current_size = size
+            key_durations = time_calls(lambda: get_random_item(conn, False), draws)
+            sample_durations = time_calls(lambda: get_sampled_item(conn, False), draws)
+            result = {
+                'items': size,
+                'key_p50': percentile(key_durations, 50),
+                'key_p95': percentile(key_durations, 95),
+                'sample_p50': percentile(sample_durations, 50),
+                'sample_p95': percentile(sample_durations, 95)
+            }
+            results.append(result)
+            print '{items:>10} {key_p50:>10.2f}ms {key_p95:>10.2f}ms ' \
+                '{sample_p50:>10.2f}ms {sample_p95:>10.2f}ms'.format(**result)
+    db_close(conn)
+    return results
+
+def build_synthetic_page(rand, index, paragraphs, links):
+    """
+        Build a synthetic html page.
+
+        :param rand: A random generator
+        :param index: The page index
+        :param paragraphs: The number of paragraphs
+        :param links: The number of links and images per paragraph
+        :type rand: Random
+        :type index: int
+        :type paragraphs: int
+        :type links: int
+        :return: The page
+        :rtype: unicode
+    """
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'caf\xe9', 'na\xefve', 'r\xe9sum\xe9']
+    parts = ['<!DOCTYPE html><html><head><title>Page {}</title>'.format(index), \
+        '<link rel="stylesheet" href="/css/main.css"><script src="js/app.js"></script>', \
+        '</head><body><div data-version="v{}">'.format(index)]
+    for paragraph in range(paragraphs):
+        parts.append('<p>{}</p>'.format(' '.join(rand.choice(words) for _ in range(60))))
+        for link in range(links):
+            parts.append('<a href="/article/{}/{}">{}</a>'.format( \
+                paragraph, link, rand.choice(words)))
+            parts.append('<img src="img/{0}.png" srcset="/img/{0}.png 1x, /img/{0}@2x.png 2x">' \
+                .format(rand.randint(0, 10000)))
+    parts.append('</div></body></html>')
+    return ''.join(parts)
+
+def build_synthetic_corpus():
+    """
+        Build the synthetic corpus.
+
+        The corpus is the same on every run (seeded), pages are of varying size
+        and complexity regarding CORPUS_PROFILES.
+
+        :return: The pages as (link, content) tuples
+        :rtype: list
+    """
+    rand = random.Random(CORPUS_SEED)
+    corpus = list()
+    for count, paragraphs, links in CORPUS_PROFILES:
+        for _ in range(count):
+            index = len(corpus)
+            content = build_synthetic_page(rand, index, paragraphs, links)
+            corpus.append(('https://bench{}.example.com/page/{}'.format(index, index), content))
+    return corpus
+
+def build_decoding_corpora():
+    """
+        Build the corpora of the decoding benchmark.
+
+        The synthetic corpus (mostly ASCII, some accented words) is benchmarked as
+        is, fully ASCII (as stored), and with non-latin words (mostly non-ASCII).
+
+        :return: The pages of each corpus
+        :rtype: list
+    """
+    rand = random.Random(CORPUS_SEED)
+    pages = [content for _, content in build_synthetic_corpus()]
+    non_latin_pages = [' '.join(a if rand.random() < 0.5 else rand.choice(NON_LATIN_WORDS) \
+        for a in content.split(' ')) for content in pages]
+    return [
+        ('ascii', [unidecode(content).decode('ascii') for content in pages]),
+        ('mostly ascii', pages),
+        ('non latin', non_latin_pages)
+    ]
+
+def iter_chunks(content, size):
+    """
+        Split a raw content into chunks.
+
+        :param content: A raw content
+        :param size: The size of a chunk
+        :type content: str
+        :type size: int
+        :return: A generator of chunks
+        :rtype: generator
+    """
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+def bench_decoding(rounds=DECODING_ROUNDS, chunk_size=DECODING_CHUNK_SIZE):
+    """
+        Benchmark the magic decoding against unidecode.
+
+        This time unidecode, magic_decoding and iter_magic_decoding (on the utf-8
+        encoded pages, chunk by chunk) on each page of each corpus, and check that
+        they all give the same result.
+
+        :param rounds: The number of times each page is decoded
+        :param chunk_size: The size of a chunk of the streaming decoding
+        :type rounds: int
+        :type chunk_size: int
+        :return: The p50/p95 latencies (ms) per corpus and method
+        :rtype: list
+    """
+    methods = [
+        ('unidecode', unidecode),
+        ('magic', magic_decoding),
+        ('stream', lambda content: ''.join(iter_magic_decoding( \
+            iter_chunks(content.encode('utf-8'), chunk_size))))
+    ]
+    results = list()
+    print '{:>14} {:>14} {:>14} {:>14} {:>14} {:>14} {:>14}'.format('corpus', \
+        'unidecode p50', 'p95', 'magic p50', 'p95', 'stream p50', 'p95')
+    for corpus, pages in build_decoding_corpora():
+        durations = dict((name, list()) for name, _ in methods)
+        for content in pages:
+            expected = unidecode(content)
+            for name, method in methods:
+                if method(content) != expected:
+                    raise Exception('{} decoding differs from unidecode...'.format(name))
+                durations[name] += time_calls(lambda: method(content), rounds)
+        result = {'corpus': corpus}
+        for name, _ in methods:
+            result['{}_p50'.format(name)] = percentile(durations[name], 50)
+            result['{}_p95'.format(name)] = percentile(durations[name], 95)
+        results.append(result)
+        print '{corpus:>14} {unidecode_p50:>12.2f}ms {unidecode_p95:>12.2f}ms ' \
+            '{magic_p50:>12.2f}ms {magic_p95:>12.2f}ms ' \
+            '{stream_p50:>12.2f}ms {stream_p95:>12.2f}ms'.format(**result)
+    return results
+
+def bench_discover(samples=DISCOVER_SAMPLES, output_path=None, baseline_path=None, \
+    tolerance=REGRESSION_TOLERANCE):
+    """
+        Benchmark each stage of the discover page.
+
+        This insert the synthetic corpus into the benchmark database (needs a running
+        mongod, uses a dedicated database) then time each stage of the discover page on random
+        items. The percentiles of each stage can be saved as a JSON baseline, and
+        compared with a previous baseline.
+
+        :param samples: The number of discover pages
+        :param output_path: Save the results as a JSON baseline into this file
+        :param baseline_path: Compare the results with the JSON baseline of this file
+        :param tolerance: Max relative slow down of a stage compared with the baseline
+        :type samples: int
+        :type output_path: str
+        :type baseline_path: str
+        :type tolerance: float
+        :return: The stages slower than the baseline
+        :rtype: list
+    """
+    random.seed(CORPUS_SEED) # same random keys and draws on every run
+    conn = db_connect()
+    css_files = ['{}/shared/shared-discover.css'.format(CSS_DIRPATH), \
+        '{}/the-discover-style.css'.format(CSS_DIRPATH)]
+    template = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES_DIRPATH), \
+        autoescape=True).get_template('discover.html')
+    stages = ['get_random_item', 'read_item_content', 'magic_decoding', 'magic_parser', \
+        'rewrite_content', 'build_discovery_kwargs', 'get_discovery_kwargs', 'render_template']
+    durations = dict((stage, list()) for stage in stages)
+
+    def timed(stage, method, *args):
+        start_time = time.time()
+        result = method(*args)
+        durations[stage].append((time.time() - start_time) * 1000)
+        return result
+
+    with use_bench_database(conn):
+        create_random_index(conn, False)
+        create_grid_indexes(conn)
+        for link, content in build_synthetic_corpus():
+            item = Item('Title of {}'.format(link), link, '', 'bench', magic_decoding(content))
+            insert_item(conn, item.link, str(item.content), item.get_metadata(), False)
+        for _ in range(samples):
+            title, link, content_obj = timed('get_random_item', get_random_item, conn, False)
+            content = timed('read_item_content', read_item_content, conn, content_obj)
+            decoded = timed('magic_decoding', magic_decoding, content)
+            parsed_content = unicode(timed('magic_parser', magic_parser, decoded, link))
+            timed('rewrite_content', rewrite_content, decoded, link)
+            timed('build_discovery_kwargs', build_discovery_kwargs, css_files)
+            kwargs = timed('get_discovery_kwargs', get_discovery_kwargs, css_files)
+            timed('render_template', lambda: template.render(website_title='Bench', \
+                mobile='', username='bench', content=jinja2.Markup(parsed_content), \
+                title=parse_title(title), link=link, **kwargs))
+    db_close(conn)
+
+    results = dict()
+    print '{:>24} {:>10} {:>10} {:>10}'.format('stage', 'p50', 'p95', 'p99')
+    for stage in stages:
+        results[stage] = dict(('p{}'.format(pct), percentile(durations[stage], pct)) \
+            for pct in STAGE_PERCENTILES)
+        print '{:>24} {p50:>8.2f}ms {p95:>8.2f}ms {p99:>8.2f}ms'.format(stage, **results[stage])
+    if output_path:
+        with open(output_path, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    return compare_with_baseline(results, baseline_path, tolerance) if baseline_path else list()
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    """
+        Compare benchmark results with a baseline.
+
+        A stage is a regression when one of its percentiles is slower than the
+        baseline by more than the tolerance.
+
+        :param results: The percentiles of each stage
+        :param baseline_path: The JSON baseline file
+        :param tolerance: Max relative slow down of a stage
+        :type results: dict
+        :type baseline_path: str
+        :type tolerance: float
+        :return: The stages slower than the baseline
+        :rtype: list
+    """
+    with open(baseline_path, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = list()
+    for stage, percentiles in sorted(results.items()):
+        for name, value in sorted(percentiles.items()):
+            reference = baseline.get(stage, dict()).get(name)
+            if reference and value > reference * (1 + tolerance):
+                print 'Regression on {} {}: {:.2f}ms (baseline {:.2f}ms)'.format( \
+                    stage, name, value, reference)
+                if stage not in regressions:
+                    regressions.append(stage)
+    return regressions
+
+def check_discover_regressions():
+    """
+        Benchmark the discover page and compare it with the baseline.
+
+        This compare with the BASELINE_FILEPATH baseline (or create it if missing),
+        it exits with an error on regression so it can be used before deploying.
+
+        :return: Nothing
+        :rtype: None
+    """
+    if not os.path.exists(BASELINE_FILEPATH):
+        bench_discover(output_path=BASELINE_FILEPATH)
+        print 'Baseline saved into {}'.format(BASELINE_FILEPATH)
+        return
+    if bench_discover(baseline_path=BASELINE_FILEPATH):
+        raise SystemExit(1)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+"""The known links bloom filter methods and class
+"""
+
+from __future__ import unicode_literals
+
+import os
+import math
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import contextlib
+
+from lib.config import load_config
+
+CONFIG = load_config().get('bloom', dict())
+
+LIB_DIR_ABSPATH = os.path.dirname(os.path.abspath(__file__))
+BLOOM_FILEPATH = CONFIG.get('FILEPATH', os.path.join(LIB_DIR_ABSPATH, '../links.bloom'))
+BLOOM_CAPACITY = CONFIG.get('CAPACITY', 10000000)
+BLOOM_ERROR_RATE = CONFIG.get('ERROR_RATE', 0.01)
+BLOOM_RELOAD_INTERVAL = 1 # seconds between two checks of the file
+BLOOM_MAGIC = b'RBF1'
+BLOOM_HEADER = struct.Struct(b'<4sIQQ') # magic, hashes, bits, count
+BLOOM_HEADER_SIZE = 32
+
+class BloomFilter(object):
+    """
+        Define a bloom filter stored into a memory-mapped file.
+
+        Every process mapping the file shares the same pages of memory, the filter
+        is never copied. Writers must hold the lock of the file (see bloom_lock).
+    """
+    def __init__(self, filepath):
+        """
+            Initialize a bloom filter object.
+
+            This map an existing bloom filter file (read only if the file is not
+            writable by the process).
+
+            :param filepath: The bloom filter file path
+            :type filepath: str
+        """
+        self.filepath = filepath
+        self.writable = os.access(filepath, os.W_OK)
+        with open(filepath, 'r+b' if self.writable else 'rb') as bloom_file:
+            self.inode = os.fstat(bloom_file.fileno()).st_ino
+            access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+            self.data = mmap.mmap(bloom_file.fileno(), 0, access=access)
+        magic, self.hashes, self.bits, _ = BLOOM_HEADER.unpack_from(self.data, 0)
+        if magic != BLOOM_MAGIC:
+            raise Exception('{} is not a bloom filter...'.format(filepath))
+
+    @property
+    def count(self):
+        """
+            Get the number of keys added to the filter.
+
+            :return: The number of keys
+            :rtype: int
+        """
+        return BLOOM_HEADER.unpack_from(self.data, 0)[3]
+
+    def positions(self, key):
+        """
+            Get the bit positions of a key.
+
+            The positions are computed by double hashing of the md5 digest of the key.
+
+            :param key: A key
+            :type key: unicode
+            :return: The bit positions
+            :rtype: generator
+        """
+        first_hash, second_hash = struct.unpack(b'<QQ', hashlib.md5(key.encode('utf-8')).digest())
+        second_hash |= 1
+        return ((first_hash + i * second_hash) % self.bits for i in range(self.hashes))
+
+    def __contains__(self, key):
+        """
+            Check if a key may have been added to the filter.
+
+            :param key: A key
+            :type key: unicode
+            :return: False if the key has never been added, True if it may have been
+            :rtype: bool
+        """
+        data = self.data
+        for position in self.positions(key):
+            if not ord(data[BLOOM_HEADER_SIZE + (position >> 3)]) & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """
+            Add a key to the filter.
+
+            :param key: A key
+            :type key: unicode
+            :return: Nothing
+            :rtype: None
+        """
+        data = self.data
+        for position in self.positions(key):
+            index = BLOOM_HEADER_SIZE + (position >> 3)
+            data[index] = chr(ord(data[index]) | (1 << (position & 7)))
+        BLOOM_HEADER.pack_into(data, 0, BLOOM_MAGIC, self.hashes, self.bits, self.count + 1)
+
+    def false_positive_rate(self):
+        """
+            Get the current false positive rate of the filter.
+
+            :return: The probability that a key never added is said to be present
+            :rtype: float
+        """
+        return (1 - math.exp(-float(self.hashes) * self.count / self.bits)) ** self.hashes
+
+    def close(self):
+        """
+            Unmap the filter file.
+
+            :return: Nothing
+            :rtype: None
+        """
+        self.data.close()
+
+def create_bloom_filter(filepath, capacity, error_rate):
+    """
+        Create an empty bloom filter file.
+
+        The filter is sized to keep the false positive rate under error_rate until
+        capacity keys have been added.
+
+        :param filepath: The bloom filter file path
+        :param capacity: The expected number of keys
+        :param error_rate: The expected false positive rate
+        :type filepath: str
+        :type capacity: int
+        :type error_rate: float
+        :return: The bloom filter
+        :rtype: BloomFilter
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    bits += -bits % 8
+    hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+    with open(filepath, 'wb') as bloom_file:
+        header = BLOOM_HEADER.pack(BLOOM_MAGIC, hashes, bits, 0)
+        bloom_file.write(header.ljust(BLOOM_HEADER_SIZE, b'\0'))
+        bloom_file.truncate(BLOOM_HEADER_SIZE + bits // 8)
+    return BloomFilter(filepath)
+
+@contextlib.contextmanager
+def bloom_lock(filepath=None):
+    """
+        Hold the write lock of a bloom filter file.
+
+        :param filepath: The bloom filter file path (BLOOM_FILEPATH by default)
+        :type filepath: str
+        :return: A context manager
+        :rtype: GeneratorContextManager
+    """
+    with open((filepath or BLOOM_FILEPATH) + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def link_key(filename, mobile):
+    """
+        Build the bloom filter key of an item.
+
+        :param filename: An item filename (its link)
+        :param mobile: The mobile flag
+        :type filename: str
+        :type mobile: bool
+        :return: The key
+        :rtype: unicode
+    """
+    return '{}|{}'.format('mobile' if mobile else 'desktop', filename)
+
+LINKS_FILTER = {'filter': None, 'checked_at': 0, 'dropped': None}
+
+def get_links_filter(force=False):
+    """
+        Get the bloom filter of the known links.
+
+        The filter is mapped once per process, and mapped again when the file has
+        been replaced (rebuilt). There is no filter until it has been built (see
+        rebuild_links_filter), or once it has been dropped (see drop_links_filter),
+        every link may be known then.
+
+        :param force: Check the file even if it has been checked recently
+        :type force: bool
+        :return: The bloom filter (None if it has not been built)
+        :rtype: BloomFilter
+    """
+    now = time.time()
+    if not force and now - LINKS_FILTER['checked_at'] < BLOOM_RELOAD_INTERVAL:
+        return LINKS_FILTER['filter']
+    LINKS_FILTER['checked_at'] = now
+    current = LINKS_FILTER['filter']
+    try:
+        inode = os.stat(BLOOM_FILEPATH).st_ino
+    except OSError:
+        LINKS_FILTER['filter'] = None
+        return None
+    if inode == LINKS_FILTER['dropped']:
+        LINKS_FILTER['filter'] = None
+        return None
+    if not current or current.inode != inode:
+        try:
+            LINKS_FILTER['filter'] = BloomFilter(BLOOM_FILEPATH)
+        except Exception as err:
+            print err
+            LINKS_FILTER['filter'] = None
+    return LINKS_FILTER['filter']
+
+def link_may_exist(filename, mobile):
+    """
+        Check if an item may be stored.
+
+        :param filename: An item filename (its link)
+        :param mobile: The mobile flag
+        :type filename: str
+        :type mobile: bool
+        :return: False if the item is not stored, True if it may be
+        :rtype: bool
+    """
+    links_filter = get_links_filter()
+    return links_filter is None or link_key(filename, mobile) in links_filter
+
+def check_links_filter():
+    """
+        Check that the stored items can be added to the bloom filter of the known
+        links.
+
+        An item stored but not added would be said unknown, so the items must not
+        be stored by a process which maps the filter read only.
+
+        :return: Nothing
+        :rtype: None
+    """
+    links_filter = get_links_filter()
+    if links_filter and not links_filter.writable:
+        raise Exception('The known links filter {} is read only, no item can be stored...'.format( \
+            BLOOM_FILEPATH))
+
+def drop_links_filter():
+    """
+        Drop the bloom filter of the known links.
+
+        The filter file is removed, so every process says every link may be known
+        until it's rebuilt (see rebuild_links_filter). The file is ignored by this
+        process anyway if it can't be removed.
+
+        :return: Nothing
+        :rtype: None
+    """
+    current = LINKS_FILTER['filter']
+    LINKS_FILTER['filter'] = None
+    try:
+        os.remove(BLOOM_FILEPATH)
+    except OSError as err:
+        print err
+        LINKS_FILTER['dropped'] = current.inode if current else None
+
+def add_link(filename, mobile):
+    """
+        Add a stored item to the bloom filter of the known links.
+
+        A link which could not be added would be said unknown, the filter is
+        dropped then (see drop_links_filter).
+
+        :param filename: An item filename (its link)
+        :param mobile: The mobile flag
+        :type filename: str
+        :type mobile: bool
+        :return: Nothing
+        :rtype: None
+    """
+    try:
+        with bloom_lock(): # waits for a running rebuild
+            links_filter = get_links_filter(force=True)
+            if links_filter:
+                if not links_filter.writable:
+                    raise Exception('The known links filter {} is read only...'.format( \
+                        BLOOM_FILEPATH))
+                links_filter.add(link_key(filename, mobile))
+    except Exception as err:
+        print err
+        drop_links_filter()
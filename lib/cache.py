@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""The rendered pages cache methods
+"""
+
+from __future__ import unicode_literals
+
+import os
+import io
+import time
+import uuid
+import hashlib
+import threading
+
+from lib.config import load_config
+
+CONFIG = load_config().get('cache', dict())
+
+LIB_DIR_ABSPATH = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIRPATH = CONFIG.get('CACHE_DIR', os.path.join(LIB_DIR_ABSPATH, '../cache'))
+CACHE_MAX_BYTES = CONFIG.get('CACHE_MAX_BYTES', 256 * 1024 * 1024)
+CACHE_EVICT_RATIO = 0.9 # an evicted cache goes down to this ratio of CACHE_MAX_BYTES
+CACHE_SCAN_INTERVAL = 60 # max seconds between two scans (other processes write too)
+CACHE_FILE_EXTENSION = '.html'
+CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+CACHE_SIZE = {'bytes': 0, 'scanned_at': 0, 'lock': threading.Lock()}
+
+def cache_key(filename, mobile, version):
+    """
+        Build a cache key.
+
+        This build the cache key of a rendered page regarding the item filename,
+        the experience (mobile or desktop) and the parser version. Bumping the
+        parser version is enough to invalidate the whole cache.
+
+        :param filename: An item filename (its link)
+        :param mobile: The mobile flag
+        :param version: The parser version
+        :type filename: str
+        :type mobile: bool
+        :type version: str
+        :return: The cache key
+        :rtype: str
+    """
+    variant = 'mobile' if mobile else 'desktop'
+    raw_key = '{}|{}|{}'.format(version, variant, filename)
+    return hashlib.sha1(raw_key.encode('utf-8')).hexdigest()
+
+def cache_filepath(key):
+    """
+        Get the cache file path of a key.
+
+        :param key: A cache key
+        :type key: str
+        :return: The cache file path
+        :rtype: str
+    """
+    return os.path.join(CACHE_DIRPATH, key + CACHE_FILE_EXTENSION)
+
+def cache_get(key):
+    """
+        Get a rendered page from the cache.
+
+        This read a rendered page from the on-disk cache shared by every process.
+        A hit refreshes the modification time of the entry, which is the recency
+        used by the LRU eviction.
+
+        :param key: A cache key
+        :type key: str
+        :return: The rendered page (None if missing)
+        :rtype: unicode
+    """
+    filepath = cache_filepath(key)
+    try:
+        with io.open(filepath, 'r', encoding='utf-8') as cache_file:
+            content = cache_file.read()
+        os.utime(filepath, None)
+    except (IOError, OSError):
+        CACHE_STATS['misses'] += 1
+        return None
+    CACHE_STATS['hits'] += 1
+    return content
+
+def cache_set(key, content):
+    """
+        Put a rendered page into the cache.
+
+        This write a rendered page into the on-disk cache. The file is written
+        under a temporary name then renamed, so concurrent readers never see a
+        partial entry. The cache is then evicted if it became too big (see
+        track_cache_size).
+
+        :param key: A cache key
+        :param content: A rendered page
+        :type key: str
+        :type content: unicode
+        :return: Nothing
+        :rtype: None
+    """
+    tmp_filepath = os.path.join(CACHE_DIRPATH, '{}.tmp'.format(uuid.uuid4().hex))
+    try:
+        if not os.path.isdir(CACHE_DIRPATH):
+            os.makedirs(CACHE_DIRPATH)
+        with io.open(tmp_filepath, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(content)
+        size = os.stat(tmp_filepath).st_size
+        os.rename(tmp_filepath, cache_filepath(key))
+    except (IOError, OSError) as err:
+        print err
+        return
+    track_cache_size(size)
+
+def track_cache_size(size):
+    """
+        Track the cache size and evict the cache when it became too big.
+
+        The cache directory is not listed at every write: the size of the cache
+        is only tracked by adding the written entries, and the directory is only
+        scanned (see cache_evict) once it's over CACHE_MAX_BYTES, or when the last
+        scan is older than CACHE_SCAN_INTERVAL seconds since the other processes
+        write into the cache too. An evicted cache goes down to CACHE_EVICT_RATIO
+        of CACHE_MAX_BYTES, so the next scan is not due at the next write.
+
+        :param size: The size of the written entry
+        :type size: int
+        :return: Nothing
+        :rtype: None
+    """
+    now = time.time()
+    with CACHE_SIZE['lock']:
+        CACHE_SIZE['bytes'] += size
+        if CACHE_SIZE['bytes'] <= CACHE_MAX_BYTES and \
+            now - CACHE_SIZE['scanned_at'] < CACHE_SCAN_INTERVAL:
+            return
+        CACHE_SIZE['scanned_at'] = now # a single scan at a time
+    total_size = cache_evict(CACHE_MAX_BYTES, int(CACHE_MAX_BYTES * CACHE_EVICT_RATIO))
+    with CACHE_SIZE['lock']:
+        CACHE_SIZE['bytes'] = total_size
+
+def list_cache_entries():
+    """
+        List the cache entries.
+
+        :return: The entries as (mtime, size, filepath) tuples, least recent first
+        :rtype: list
+    """
+    entries = list()
+    try:
+        filenames = os.listdir(CACHE_DIRPATH)
+    except OSError:
+        return entries
+    for filename in filenames:
+        if not filename.endswith(CACHE_FILE_EXTENSION):
+            continue
+        filepath = os.path.join(CACHE_DIRPATH, filename)
+        try:
+            stat = os.stat(filepath)
+        except OSError: # already evicted by another process
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filepath))
+    entries.sort()
+    return entries
+
+def cache_evict(max_bytes, target_bytes=None):
+    """
+        Evict the least recently used entries.
+
+        This remove the least recently used entries once the cache size is over
+        the max_bytes limit, until it's under the target_bytes size.
+
+        :param max_bytes: The max size of the cache
+        :param target_bytes: The size of the evicted cache (max_bytes by default)
+        :type max_bytes: int
+        :type target_bytes: int
+        :return: The cache size
+        :rtype: int
+    """
+    entries = list_cache_entries()
+    total_size = sum(size for _, size, _ in entries)
+    if total_size <= max_bytes:
+        return total_size
+    for _, size, filepath in entries:
+        if total_size <= (max_bytes if target_bytes is None else target_bytes):
+            break
+        try:
+            os.remove(filepath)
+            CACHE_STATS['evictions'] += 1
+        except OSError:
+            pass
+        total_size -= size
+    return total_size
+
+def cache_stats():
+    """
+        Get the cache statistics.
+
+        The hits, misses and evictions counters are the ones of the current
+        process, the entries and size are the ones of the shared cache.
+
+        :return: The cache statistics
+        :rtype: dict
+    """
+    entries = list_cache_entries()
+    stats = dict(CACHE_STATS)
+    stats['entries'] = len(entries)
+    stats['size'] = sum(size for _, size, _ in entries)
+    return stats
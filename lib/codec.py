@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""The storage codec methods
+"""
+
+from __future__ import unicode_literals
+
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError: # lzma is only in the stdlib of python 3
+        lzma = None
+
+IDENTITY_CODEC = 'identity'
+
+class IdentityDecompressor(object):
+    """
+        Define a decompressor which does not decompress anything.
+    """
+    def decompress(self, data):
+        """
+            Return the data as is.
+
+            :param data: Some data
+            :type data: str
+            :return: The same data
+            :rtype: str
+        """
+        return data
+
+CODECS = {
+    IDENTITY_CODEC: (lambda data: data, IdentityDecompressor),
+    'zlib': (zlib.compress, zlib.decompressobj),
+    'bz2': (bz2.compress, bz2.BZ2Decompressor)
+}
+if lzma:
+    CODECS['lzma'] = (lzma.compress, lzma.LZMADecompressor)
+
+def register_codec(name, compress, decompressor):
+    """
+        Register a new codec.
+
+        :param name: The codec name (stored into the items metadata)
+        :param compress: A method compressing data
+        :param decompressor: A factory of incremental decompressors
+        :type name: str
+        :type compress: function
+        :type decompressor: function
+        :return: Nothing
+        :rtype: None
+    """
+    CODECS[name] = (compress, decompressor)
+
+def get_codec(name):
+    """
+        Get a codec.
+
+        :param name: The codec name (None for the identity codec)
+        :type name: str
+        :return: The compress method and the decompressor factory
+        :rtype: tuple
+    """
+    codec = CODECS.get(name or IDENTITY_CODEC)
+    if not codec:
+        raise Exception('Codec {} is not available...'.format(name))
+    return codec
+
+def encode_content(data, name):
+    """
+        Compress data with a codec.
+
+        :param data: Some data
+        :param name: The codec name
+        :type data: str
+        :type name: str
+        :return: The compressed data
+        :rtype: str
+    """
+    return get_codec(name)[0](data)
+
+def decode_content(data, name):
+    """
+        Decompress data with a codec.
+
+        :param data: Some compressed data
+        :param name: The codec name
+        :type data: str
+        :type name: str
+        :return: The data
+        :rtype: str
+    """
+    return b''.join(iter_decode_content([data], name))
+
+def iter_decode_content(chunks, name):
+    """
+        Decompress chunks of data with a codec.
+
+        This decompress data chunk by chunk, the whole data is never loaded.
+
+        :param chunks: Some chunks of compressed data
+        :param name: The codec name
+        :type chunks: iterable
+        :type name: str
+        :return: A generator of chunks of data
+        :rtype: generator
+    """
+    decompressor = get_codec(name)[1]()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
@@ -5,19 +5,49 @@
 
 from __future__ import unicode_literals
 
+import os
+import time
+import random
+import hashlib
+import datetime
+import collections
+
+import bson
 import pymongo
 import gridfs
 
 from lib.config import load_config
 
+from lib.codec import encode_content, decode_content, iter_decode_content
+
+from lib.bloom import create_bloom_filter, bloom_lock, link_key, link_may_exist, add_link, \
+    check_links_filter, get_links_filter, BLOOM_FILEPATH, BLOOM_CAPACITY, BLOOM_ERROR_RATE
+
 CONFIG = load_config()
 
 MONGO_URI = CONFIG.get('MONGO_URI', 'mongodb://localhost:27017')
 MONGO_DATABASE = 'randomery'
 MONGO_DATA_COLLECTION = 'desktopdata'
 MONGO_MOBILE_DATA_COLLECTION = 'mobiledata'
+MONGO_RENDERED_DATA_COLLECTION = 'desktoprendered'
+MONGO_MOBILE_RENDERED_DATA_COLLECTION = 'mobilerendered'
 MONGO_USERS_COLLECTION = 'users'
 MONGO_POOL_COLLECTION = 'pool'
+MONGO_DEAD_POOL_COLLECTION = 'pool_dead'
+MONGO_BLOBS_COLLECTION = 'blobs'
+MONGO_FEEDS_COLLECTION = 'feeds'
+RANDOM_KEY_FIELD = 'metadata.random'
+RANDOM_KEY_BATCH_SIZE = 1000
+STORAGE_CODEC = CONFIG.get('storage', dict()).get('CODEC', 'zlib')
+RECOMPRESS_BATCH_SIZE = 100
+BLOB_RETRIES = 3
+BLOB_RETRY_DELAY = 0.1
+BLOB_RELEASE_TIMEOUT = 60
+GRID_CHUNK_SIZE = gridfs.grid_file.DEFAULT_CHUNK_SIZE
+DUPLICATE_KEY_ERROR = 11000
+JOB_LEASE_SECONDS = CONFIG.get('jobs', dict()).get('LEASE_SECONDS', 600)
+JOB_MAX_ATTEMPTS = CONFIG.get('jobs', dict()).get('MAX_ATTEMPTS', 3)
+JOB_RETRY_DELAY = CONFIG.get('jobs', dict()).get('RETRY_DELAY', 60) # doubled at each attempt
 
 def db_connect():
     """
@@ -116,12 +146,31 @@ def mobile_or_desktop(mobile):
     else:
         return MONGO_DATA_COLLECTION
 
+def rendered_mobile_or_desktop(mobile):
+    """
+        Get the rendered collection name regarding mobile parameter.
+
+        This return the mongo rendered data collection name regarding the experience
+        asked for with the mobile paramater. If mobile if False then desktop experience
+        is asked.
+
+        :param mobile: The mobile flag
+        :type mobile: bool
+        :return: A mongo collection name
+        :rtype: str
+    """
+    if mobile:
+        return MONGO_MOBILE_RENDERED_DATA_COLLECTION
+    else:
+        return MONGO_RENDERED_DATA_COLLECTION
+
 def item_exists_in_db(conn, filename, mobile):
     """
         Check if item exists in a collection.
 
         This check if an item is already into one of data collection regarding the
-        mobile paramater. The item is represented by a single link.
+        mobile paramater. The item is represented by a single link. The db is only
+        queried when the bloom filter of the known links says the item may exist.
 
         :param conn: A mongo connection
         :param filename: A link
@@ -132,16 +181,52 @@ def item_exists_in_db(conn, filename, mobile):
         :return: Existence or not of the item
         :rtype: bool
     """
+    if not link_may_exist(filename, mobile):
+        return False
     grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=mobile_or_desktop(mobile))
     return grid_conn.exists(filename=filename)
 
+def items_exist_in_db(conn, filenames, mobiles=(False, True)):
+    """
+        Check if items exist in the data collections.
+
+        This check which items are already into the data collections regarding
+        the mobile parameters, with a single query per collection. The items are
+        represented by their links. Only the items the bloom filter of the known
+        links says may exist are queried.
+
+        :param conn: A mongo connection
+        :param filenames: Some links
+        :param mobiles: The mobile flags of the collections to check
+        :type conn: MongoClient
+        :type filenames: list
+        :type mobiles: list
+        :return: The existing links of each collection (by mobile flag)
+        :rtype: dict
+    """
+    existing = dict()
+    for mobile in mobiles:
+        existing[mobile] = set()
+        candidates = [x for x in set(filenames) if link_may_exist(x, mobile)]
+        if not candidates:
+            continue
+        files_collection = '{}.files'.format(mobile_or_desktop(mobile))
+        cursor = conn[MONGO_DATABASE][files_collection].find( \
+            {'filename': {'$in': candidates}}, {'filename': 1, '_id': 0})
+        existing[mobile].update(c.get('filename') for c in cursor)
+    return existing
+
 def insert_item(conn, filename, content, meta, mobile):
     """
         Insert a new item in a collection.
 
         This insert a new item into one of data collection regarding the
         mobile paramater. The item is represented by a link, some content and
-        some metadata.
+        some metadata. A random key is added to the metadata for sampling. The
+        content itself is stored once as a blob (see acquire_blob), the item only
+        references it. The link is added to the bloom filter of the known links,
+        nothing is inserted when the filter is read only (see check_links_filter).
+        The GridFS indexes must exist (see create_grid_indexes).
 
         :param conn: A mongo connection
         :param filename: An item link
@@ -153,28 +238,783 @@ def insert_item(conn, filename, content, meta, mobile):
         :type content: str
         :type meta: dict
         :type mobile: bool
-        :return: None
+        :return: Inserted or not
+        :rtype: bool
+    """
+    grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=mobile_or_desktop(mobile))
+    try:
+        check_links_filter()
+        digest = acquire_blob(conn, content)
+        metadata = dict(meta, random=random.random(), blob=digest)
+        grid_conn.put(b'', filename=filename, metadata=metadata)
+        add_link(filename, mobile)
+    except Exception as err:
+        print err
+        return False
+    return True
+
+def rebuild_links_filter(force=True):
+    """
+        Build the bloom filter of the known links.
+
+        This build a new bloom filter of the links of all the items (for all kind
+        of experiences), sized for BLOOM_CAPACITY links (or twice the current
+        number of items) with a BLOOM_ERROR_RATE false positive rate. The new filter
+        replaces the old one at once, every process maps it again. Items inserted
+        meanwhile wait for the rebuild to be added.
+
+        Unless forced, the filter is only rebuilt when it's needed: when it's
+        missing (never built, or dropped, see add_link) or full (its false positive
+        rate is over twice BLOOM_ERROR_RATE). The feeder and the workers check it
+        when they start.
+
+        :param force: Rebuild the filter even if it's not needed
+        :type force: bool
+        :return: Rebuilt or not
+        :rtype: bool
+    """
+    tmp_filepath = '{}.tmp'.format(BLOOM_FILEPATH)
+    with bloom_lock():
+        links_filter = get_links_filter(force=True)
+        if not force and links_filter and \
+            links_filter.false_positive_rate() <= 2 * BLOOM_ERROR_RATE:
+            return False
+        conn = db_connect()
+        files_collections = ['{}.files'.format(mobile_or_desktop(mobile)) \
+            for mobile in [False, True]]
+        items = sum(conn[MONGO_DATABASE][x].count() for x in files_collections)
+        links_filter = create_bloom_filter(tmp_filepath, max(BLOOM_CAPACITY, 2 * items), \
+            BLOOM_ERROR_RATE)
+        for mobile, files_collection in zip([False, True], files_collections):
+            cursor = conn[MONGO_DATABASE][files_collection].find({}, {'filename': 1, '_id': 0})
+            for item in cursor:
+                links_filter.add(link_key(item.get('filename'), mobile))
+        print '{} links, {:.2f} MB, false positive rate {:.4f}'.format(links_filter.count, \
+            links_filter.bits / 8.0 / 1024 / 1024, links_filter.false_positive_rate())
+        links_filter.close()
+        os.rename(tmp_filepath, BLOOM_FILEPATH)
+        db_close(conn)
+    return True
+
+def acquire_blob(conn, content):
+    """
+        Store a content as a blob or reference an existing one.
+
+        This store a content into the MONGO_BLOBS_COLLECTION collection, addressed
+        by its sha256 hash and compressed with the STORAGE_CODEC codec. A content
+        already stored (the same page for mobile and desktop, the same article in
+        several feeds...) is not stored again, its reference count is incremented.
+        A blob being released is not referenced anymore, it's stored again once
+        removed (see acquire_blobs).
+
+        :param conn: A mongo connection
+        :param content: A content
+        :type conn: MongoClient
+        :type content: str
+        :return: The blob hash
+        :rtype: str
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    blobs_files = conn[MONGO_DATABASE]['{}.files'.format(MONGO_BLOBS_COLLECTION)]
+    if blobs_files.update_one({'_id': digest, 'released': {'$exists': False}}, \
+        {'$inc': {'refs': 1}}).matched_count:
+        return digest
+    return acquire_blobs(conn, [content])[0]
+
+def build_grid_file(file_id, data, fields):
+    """
+        Build the GridFS documents of a file.
+
+        This build the file document and the chunk documents GridFS would write,
+        so many files can be written at once with bulk inserts.
+
+        :param file_id: The file id
+        :param data: The file data
+        :param fields: The other fields of the file document (filename, metadata...)
+        :type file_id: object
+        :type data: str
+        :type fields: dict
+        :return: The file document, the chunk documents
+        :rtype: tuple
+    """
+    file_doc = dict(fields, _id=file_id, length=len(data), chunkSize=GRID_CHUNK_SIZE, \
+        uploadDate=datetime.datetime.utcnow(), md5=hashlib.md5(data).hexdigest())
+    chunks = [{'files_id': file_id, 'n': n, 'data': bson.Binary(data[i:i + GRID_CHUNK_SIZE])} \
+        for n, i in enumerate(range(0, len(data), GRID_CHUNK_SIZE))]
+    return file_doc, chunks
+
+def create_grid_indexes(conn):
+    """
+        Create the GridFS indexes of the blobs and data collections.
+
+        GridFS creates them on its first write, they must exist before files are
+        written with bulk inserts (see insert_items).
+
+        :param conn: A mongo connection
+        :type conn: MongoClient
+        :return: Nothing
+        :rtype: None
+    """
+    for collection in [MONGO_BLOBS_COLLECTION, MONGO_DATA_COLLECTION, \
+        MONGO_MOBILE_DATA_COLLECTION]:
+        conn[MONGO_DATABASE]['{}.files'.format(collection)].create_index( \
+            [('filename', pymongo.ASCENDING), ('uploadDate', pymongo.ASCENDING)])
+        conn[MONGO_DATABASE]['{}.chunks'.format(collection)].create_index( \
+            [('files_id', pymongo.ASCENDING), ('n', pymongo.ASCENDING)], unique=True)
+
+def insert_blob_chunks(conn, chunks):
+    """
+        Write the chunks of some blobs.
+
+        The chunks are written with one unordered bulk insert. A chunk already
+        stored (the chunk of a blob written meanwhile by another process, or of an
+        orphan chunk set left by an interrupted write) is kept, it holds the same
+        data. The chunks written are removed if some of them could not be written.
+
+        :param conn: A mongo connection
+        :param chunks: The chunk documents
+        :type conn: MongoClient
+        :type chunks: list
+        :return: The blobs some chunks of which were already stored
+        :rtype: set
+    """
+    blobs_chunks = conn[MONGO_DATABASE]['{}.chunks'.format(MONGO_BLOBS_COLLECTION)]
+    chunks = [dict(chunk, _id=bson.ObjectId()) for chunk in chunks]
+    try:
+        blobs_chunks.insert_many(chunks, ordered=False)
+    except Exception as err:
+        write_errors = getattr(err, 'details', None) and err.details.get('writeErrors')
+        if not write_errors or \
+            any(error.get('code') != DUPLICATE_KEY_ERROR for error in write_errors):
+            blobs_chunks.delete_many({'_id': {'$in': [chunk.get('_id') for chunk in chunks]}})
+            raise
+        return set(chunks[error.get('index')].get('files_id') for error in write_errors)
+    return set()
+
+def write_blobs(conn, contents, refs):
+    """
+        Write new blobs.
+
+        As with GridFS, the chunks are written first and the file documents last,
+        so a file document only exists for a complete blob. The chunks of a blob
+        which were already stored may be removed meanwhile by a release (see
+        release_blob), they are written again once its file document is written.
+
+        :param conn: A mongo connection
+        :param contents: The contents by blob hash
+        :param refs: The reference count of each blob
+        :type conn: MongoClient
+        :type contents: dict
+        :type refs: dict
+        :return: The written blobs, the blobs stored meanwhile by another process
+        :rtype: tuple
+    """
+    blobs_files = conn[MONGO_DATABASE]['{}.files'.format(MONGO_BLOBS_COLLECTION)]
+    file_docs = list()
+    chunks = dict()
+    for digest, content in contents.items():
+        file_doc, chunks[digest] = build_grid_file(digest, \
+            encode_content(content, STORAGE_CODEC), \
+            {'refs': refs[digest], 'metadata': {'codec': STORAGE_CODEC}})
+        file_docs.append(file_doc)
+    if not file_docs:
+        return set(), set()
+    shared = insert_blob_chunks(conn, [chunk for x in chunks.values() for chunk in x])
+    existing = set()
+    try:
+        blobs_files.insert_many(file_docs, ordered=False)
+    except pymongo.errors.BulkWriteError as err: # stored meanwhile by another process
+        for error in err.details.get('writeErrors'):
+            if error.get('code') != DUPLICATE_KEY_ERROR:
+                raise
+            existing.add(file_docs[error.get('index')].get('_id'))
+    written = set(chunks) - existing
+    if shared & written: # a written blob can't be released anymore
+        insert_blob_chunks(conn, [chunk for digest in shared & written for chunk in chunks[digest]])
+    return written, existing
+
+def reference_blobs(conn, digests, refs):
+    """
+        Reference existing blobs.
+
+        The reference counts are incremented with one bulk update, a blob being
+        released is not referenced (see release_blob). When some blobs could not
+        be referenced, the other ones are found back by the token of the update. A
+        blob referenced meanwhile by another process may be referenced twice, it's
+        only kept longer.
+
+        :param conn: A mongo connection
+        :param digests: The blob hashes
+        :param refs: The reference count of each blob
+        :type conn: MongoClient
+        :type digests: set
+        :type refs: dict
+        :return: The referenced blobs
+        :rtype: set
+    """
+    blobs_files = conn[MONGO_DATABASE]['{}.files'.format(MONGO_BLOBS_COLLECTION)]
+    token = bson.ObjectId()
+    result = blobs_files.bulk_write([pymongo.UpdateOne( \
+        {'_id': digest, 'released': {'$exists': False}}, \
+        {'$inc': {'refs': refs[digest]}, '$set': {'token': token}}) for digest in digests], \
+        ordered=False)
+    if result.matched_count == len(digests):
+        return set(digests)
+    return set(x.get('_id') for x in blobs_files.find( \
+        {'_id': {'$in': list(digests)}, 'token': token}, {'_id': 1}))
+
+def acquire_blobs(conn, contents):
+    """
+        Store many contents as blobs or reference existing ones.
+
+        This is the bulk version of acquire_blob: the existing blobs are referenced
+        with one bulk update (see reference_blobs), the new ones are written with
+        unordered bulk inserts (see write_blobs). The blobs being released are
+        stored again once removed, an interrupted release is finished. An
+        exception is raised when some blobs could not be stored after
+        BLOB_RETRIES attempts, the references taken are released then.
+
+        :param conn: A mongo connection
+        :param contents: Some contents
+        :type conn: MongoClient
+        :type contents: list
+        :return: The blob hash of each content
+        :rtype: list
+    """
+    digests = [hashlib.sha256(content).hexdigest() for content in contents]
+    refs = collections.Counter(digests)
+    contents = dict(zip(digests, contents))
+    blobs_files = conn[MONGO_DATABASE]['{}.files'.format(MONGO_BLOBS_COLLECTION)]
+    remaining = set(refs)
+    for attempt in range(BLOB_RETRIES):
+        if attempt:
+            time.sleep(BLOB_RETRY_DELAY)
+        existing = set()
+        for blob in blobs_files.find({'_id': {'$in': list(remaining)}}, {'released': 1}):
+            if not blob.get('released'):
+                existing.add(blob.get('_id'))
+            elif blob.get('released') < datetime.datetime.utcnow() - \
+                datetime.timedelta(seconds=BLOB_RELEASE_TIMEOUT):
+                release_blob(conn, blob.get('_id'), 0) # finish an interrupted release
+        written, stored = write_blobs(conn, \
+            dict((digest, contents[digest]) for digest in remaining - existing), refs)
+        remaining -= written
+        if existing | stored:
+            remaining -= reference_blobs(conn, existing | stored, refs)
+        if not remaining:
+            return digests
+    for digest in set(refs) - remaining:
+        release_blob(conn, digest, refs[digest])
+    raise Exception('The blobs {} are being released, they could not be stored...'.format( \
+        ', '.join(sorted(remaining))))
+
+def insert_items(conn, items):
+    """
+        Insert many new items in the collections.
+
+        This is the bulk version of insert_item: the contents are stored as blobs
+        (see acquire_blobs), then the items of each data collection are written
+        with one unordered bulk insert. The GridFS indexes must exist (see
+        create_grid_indexes).
+
+        An item is inserted or not at all: when a bulk insert fails, the written
+        items are found by their ids, the blob references of the other ones are
+        released and they are returned, so they can be inserted again (see
+        insert_item). No item is inserted when the blobs could not be stored, or
+        when the bloom filter of the known links is read only.
+
+        :param conn: A mongo connection
+        :param items: Some items as (filename, content, meta, mobile) tuples
+        :type conn: MongoClient
+        :type items: list
+        :return: The items which have not been inserted
+        :rtype: list
+    """
+    try:
+        check_links_filter()
+        digests = acquire_blobs(conn, [content for _, content, _, _ in items])
+    except Exception as err:
+        print err
+        return list(items)
+    failed = list()
+    for mobile in [False, True]:
+        entries = [(item, digest, build_grid_file(bson.ObjectId(), b'', {
+            'filename': item[0],
+            'metadata': dict(item[2], random=random.random(), blob=digest)
+        })[0]) for item, digest in zip(items, digests) if item[3] == mobile]
+        if not entries:
+            continue
+        files_collection = conn[MONGO_DATABASE]['{}.files'.format(mobile_or_desktop(mobile))]
+        file_ids = [file_doc.get('_id') for _, _, file_doc in entries]
+        try:
+            files_collection.insert_many([file_doc for _, _, file_doc in entries], ordered=False)
+            inserted = set(file_ids)
+        except Exception as err:
+            print err
+            inserted = set(x.get('_id') for x in files_collection.find( \
+                {'_id': {'$in': file_ids}}, {'_id': 1}))
+        for item, digest, file_doc in entries:
+            if file_doc.get('_id') in inserted:
+                add_link(item[0], mobile)
+            else:
+                release_blob(conn, digest)
+                failed.append(item)
+    return failed
+
+def drop_stored_items(conn, items):
+    """
+        Drop the items already stored.
+
+        This is used before inserting again the items of a failed insert (see
+        insert_items): the db is queried without the bloom filter of the known
+        links, which the failed insert may not have updated, and the stored items
+        are added to it.
+
+        :param conn: A mongo connection
+        :param items: Some items as (filename, content, meta, mobile) tuples
+        :type conn: MongoClient
+        :type items: list
+        :return: The items which are not stored
+        :rtype: list
+    """
+    stored = dict()
+    for mobile in [False, True]:
+        filenames = [item[0] for item in items if item[3] == mobile]
+        if not filenames:
+            continue
+        files_collection = '{}.files'.format(mobile_or_desktop(mobile))
+        cursor = conn[MONGO_DATABASE][files_collection].find( \
+            {'filename': {'$in': filenames}}, {'filename': 1, '_id': 0})
+        stored[mobile] = set(c.get('filename') for c in cursor)
+    remaining = list()
+    for item in items:
+        if item[0] not in stored.get(item[3], set()):
+            remaining.append(item)
+        else:
+            add_link(item[0], item[3])
+    return remaining
+
+def release_blob(conn, digest, refs=1):
+    """
+        Release some references to a blob.
+
+        This decrement the reference count of a blob and remove the blob once it's
+        not referenced anymore. The blob is marked as released first, so it can't
+        be referenced again (see acquire_blobs), then its chunks are removed before
+        its file document: a blob written again meanwhile always finds either the
+        file document or none of the old chunks. A release interrupted for more
+        than BLOB_RELEASE_TIMEOUT seconds is finished by releasing no reference.
+
+        :param conn: A mongo connection
+        :param digest: The blob hash
+        :param refs: The number of references to release
+        :type conn: MongoClient
+        :type digest: str
+        :type refs: int
+        :return: Nothing
         :rtype: None
     """
+    blobs_files = conn[MONGO_DATABASE]['{}.files'.format(MONGO_BLOBS_COLLECTION)]
+    if refs:
+        blobs_files.update_one({'_id': digest}, {'$inc': {'refs': -refs}})
+    now = datetime.datetime.utcnow()
+    if blobs_files.update_one({'_id': digest, 'refs': {'$lte': 0}, '$or': [
+            {'released': {'$exists': False}},
+            {'released': {'$lt': now - datetime.timedelta(seconds=BLOB_RELEASE_TIMEOUT)}}
+        ]}, {'$set': {'released': now}}).matched_count:
+        blobs_chunks = conn[MONGO_DATABASE]['{}.chunks'.format(MONGO_BLOBS_COLLECTION)]
+        blobs_chunks.delete_many({'files_id': digest})
+        blobs_files.delete_one({'_id': digest, 'released': now})
+
+def find_items(conn, mobile):
+    """
+        Find all items of a collection.
+
+        This fetch every item from one of the data collection regarding the mobile
+        parameter. The cursor does not time out, it's meant for maintenance tasks.
+
+        :param conn: A mongo connection
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type mobile: bool
+        :return: A cursor of content streams
+        :rtype: GridOutCursor
+    """
     grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=mobile_or_desktop(mobile))
+    return grid_conn.find({}, no_cursor_timeout=True)
+
+def insert_rendered_item(conn, filename, content, version, mobile):
+    """
+        Insert a rendered item in a collection.
+
+        This insert the rendered content of an item into one of the rendered data
+        collection regarding the mobile paramater. The parser version used to render
+        the item is kept into the metadata, previous renderings are removed. The
+        content is compressed with the STORAGE_CODEC codec.
+
+        :param conn: A mongo connection
+        :param filename: An item link
+        :param content: An item rendered content
+        :param version: The parser version
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type filename: str
+        :type content: unicode
+        :type version: str
+        :type mobile: bool
+        :return: None
+        :rtype: None
+    """
+    grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=rendered_mobile_or_desktop(mobile))
     try:
-        grid_conn.put(content, filename=filename, metadata=meta)
+        previous_ids = [a._id for a in grid_conn.find({'filename': filename})]
+        grid_conn.put(encode_content(content.encode('utf-8'), STORAGE_CODEC), \
+            filename=filename, metadata={'parser_version': version, 'codec': STORAGE_CODEC})
+        for previous_id in previous_ids:
+            grid_conn.delete(previous_id)
     except Exception as err:
         print err
     return
 
-def get_random_item(conn, mobile):
+def get_rendered_item(conn, filename, mobile):
     """
-        Get a random item.
+        Get a rendered item.
+
+        This fetch the last rendered content of an item from one of the rendered
+        data collection regarding the mobile parameter.
+
+        :param conn: A mongo connection
+        :param filename: An item link
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type filename: str
+        :type mobile: bool
+        :return: The rendered content stream (None if not rendered yet)
+        :rtype: GridOut
+    """
+    grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=rendered_mobile_or_desktop(mobile))
+    cursor = grid_conn.find({'filename': filename}).sort('uploadDate', -1).limit(1)
+    results = [a for a in cursor]
+    if len(results) > 0:
+        return results[0]
+    else:
+        return None
+
+def open_item_content(conn, content_obj):
+    """
+        Open the content of an item.
+
+        This return the stream holding the content of an item: the blob it
+        references, or the item itself for items stored before the blobs.
+
+        :param conn: A mongo connection
+        :param content_obj: The content stream of an item
+        :type conn: MongoClient
+        :type content_obj: GridOut
+        :return: The stream of the (compressed) content
+        :rtype: GridOut
+    """
+    digest = (content_obj.metadata or dict()).get('blob')
+    if not digest:
+        return content_obj
+    grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=MONGO_BLOBS_COLLECTION)
+    return grid_conn.get(digest)
+
+def read_item_content(conn, content_obj):
+    """
+        Read the content of an item.
+
+        This read and decompress the whole content of an item regarding the codec
+        stored into its metadata (or the metadata of its blob).
+
+        :param conn: A mongo connection
+        :param content_obj: The content stream of an item
+        :type conn: MongoClient
+        :type content_obj: GridOut
+        :return: The content
+        :rtype: str
+    """
+    stream = open_item_content(conn, content_obj)
+    return decode_content(stream.read(), (stream.metadata or dict()).get('codec'))
+
+def iter_item_content(conn, content_obj):
+    """
+        Read the content of an item chunk by chunk.
+
+        This read and decompress the content of an item chunk by chunk regarding
+        the codec stored into its metadata (or the metadata of its blob).
+
+        :param conn: A mongo connection
+        :param content_obj: The content stream of an item
+        :type conn: MongoClient
+        :type content_obj: GridOut
+        :return: A generator of chunks of content
+        :rtype: generator
+    """
+    stream = open_item_content(conn, content_obj)
+    return iter_decode_content(stream, (stream.metadata or dict()).get('codec'))
+
+def swap_blob_chunks(conn, digest, pending):
+    """
+        Replace the chunks of a blob by its recompressed chunks.
+
+        This finish the recompression of a blob (see recompress_blob): the old
+        chunks are removed, the new ones are moved to the blob, then the blob gets
+        its new length, checksum and codec at once. Running it again finishes an
+        interrupted swap.
+
+        :param conn: A mongo connection
+        :param digest: The blob hash
+        :param pending: The recompressed chunks (ids, length, md5 and codec)
+        :type conn: MongoClient
+        :type digest: str
+        :type pending: dict
+        :return: Nothing
+        :rtype: None
+    """
+    blobs_chunks = conn[MONGO_DATABASE]['{}.chunks'.format(MONGO_BLOBS_COLLECTION)]
+    blobs_chunks.delete_many({'files_id': digest, '_id': {'$nin': pending.get('chunks')}})
+    blobs_chunks.update_many({'_id': {'$in': pending.get('chunks')}}, \
+        {'$set': {'files_id': digest}})
+    conn[MONGO_DATABASE]['{}.files'.format(MONGO_BLOBS_COLLECTION)].update_one({'_id': digest}, {
+        '$set': {
+            'length': pending.get('length'),
+            'md5': pending.get('md5'),
+            'chunkSize': GRID_CHUNK_SIZE,
+            'metadata.codec': pending.get('codec')
+        },
+        '$unset': {'pending': ''}
+    })
+
+def recompress_blob(conn, content_obj, codec):
+    """
+        Recompress a blob.
+
+        The recompressed chunks are written aside first (under a temporary file
+        id), then recorded as pending into the blob document, then swapped with
+        the old ones (see swap_blob_chunks). The content is never lost: a failed
+        write leaves the blob untouched, an interrupted swap is finished by the
+        next recompression. The blob document is updated in place, so its
+        references count stays the live one.
+
+        :param conn: A mongo connection
+        :param content_obj: The content stream of a blob
+        :param codec: The codec name
+        :type conn: MongoClient
+        :type content_obj: GridOut
+        :type codec: str
+        :return: Nothing
+        :rtype: None
+    """
+    pending = getattr(content_obj, 'pending', None)
+    if not pending:
+        blobs_chunks = conn[MONGO_DATABASE]['{}.chunks'.format(MONGO_BLOBS_COLLECTION)]
+        temp_id = bson.ObjectId()
+        file_doc, chunks = build_grid_file(temp_id, \
+            encode_content(read_item_content(conn, content_obj), codec), dict())
+        for chunk in chunks:
+            chunk['_id'] = bson.ObjectId()
+        try:
+            if chunks:
+                blobs_chunks.insert_many(chunks)
+        except Exception:
+            blobs_chunks.delete_many({'files_id': temp_id})
+            raise
+        pending = {
+            'chunks': [chunk.get('_id') for chunk in chunks],
+            'length': file_doc.get('length'),
+            'md5': file_doc.get('md5'),
+            'codec': codec
+        }
+        conn[MONGO_DATABASE]['{}.files'.format(MONGO_BLOBS_COLLECTION)].update_one( \
+            {'_id': content_obj._id}, {'$set': {'pending': pending}})
+    swap_blob_chunks(conn, content_obj._id, pending)
+
+def recompress_collection(conn, collection, codec, batch_size=RECOMPRESS_BATCH_SIZE):
+    """
+        Recompress the items of a collection.
+
+        This rewrite every item of a GridFS collection which is not compressed with
+        the codec, by batch of batch_size items. Each item is written again with the
+        same filename and metadata (except the codec) then the old one is removed.
+        Items referencing a blob are skipped, blobs are recompressed in place with
+        their collection (see recompress_blob), a blob can't be read while its
+        chunks are swapped.
+
+        :param conn: A mongo connection
+        :param collection: A GridFS collection name
+        :param codec: The codec name
+        :param batch_size: The number of items per batch
+        :type conn: MongoClient
+        :type collection: str
+        :type codec: str
+        :type batch_size: int
+        :return: The number of recompressed items
+        :rtype: int
+    """
+    grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=collection)
+    query = {'metadata.codec': {'$ne': codec}, 'metadata.blob': {'$exists': False}}
+    count = 0
+    while True:
+        cursor = grid_conn.find(query).sort('_id', 1).limit(batch_size)
+        batch = [a for a in cursor]
+        if not batch:
+            break
+        for content_obj in batch:
+            try:
+                if collection == MONGO_BLOBS_COLLECTION:
+                    recompress_blob(conn, content_obj, codec)
+                else:
+                    content = read_item_content(conn, content_obj)
+                    metadata = dict(content_obj.metadata or dict(), codec=codec)
+                    grid_conn.put(encode_content(content, codec), \
+                        filename=content_obj.filename, metadata=metadata)
+                    grid_conn.delete(content_obj._id)
+                count += 1
+            except Exception as err:
+                print err
+        query['_id'] = {'$gt': batch[-1]._id}
+    return count
+
+def recompress_all_items(codec=STORAGE_CODEC):
+    """
+        Recompress the items of all collections.
+
+        This recompress the blobs, the raw items stored before the blobs and the
+        rendered items for all kind of experiences with a codec (the STORAGE_CODEC
+        codec by default).
+
+        :param codec: The codec name
+        :type codec: str
+        :return: Nothing
+        :rtype: None
+    """
+    conn = db_connect()
+    for collection in [MONGO_BLOBS_COLLECTION, \
+        MONGO_DATA_COLLECTION, MONGO_MOBILE_DATA_COLLECTION, \
+        MONGO_RENDERED_DATA_COLLECTION, MONGO_MOBILE_RENDERED_DATA_COLLECTION]:
+        print '{}: {} items recompressed'.format(collection, \
+            recompress_collection(conn, collection, codec))
+    db_close(conn)
+
+def dedup_collection(conn, mobile):
+    """
+        Move the contents of a collection into blobs.
+
+        This rewrite every item of one of the data collection regarding the mobile
+        parameter which still holds its content, so it references a blob instead.
+
+        :param conn: A mongo connection
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type mobile: bool
+        :return: The number of rewritten items
+        :rtype: int
+    """
+    grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=mobile_or_desktop(mobile))
+    cursor = grid_conn.find({'metadata.blob': {'$exists': False}}, no_cursor_timeout=True)
+    count = 0
+    for content_obj in cursor:
+        try:
+            digest = acquire_blob(conn, read_item_content(conn, content_obj))
+            metadata = dict(content_obj.metadata or dict(), blob=digest)
+            metadata.pop('codec', None)
+            grid_conn.put(b'', filename=content_obj.filename, metadata=metadata)
+            grid_conn.delete(content_obj._id)
+            count += 1
+        except Exception as err:
+            print err
+    cursor.close()
+    return count
+
+def dedup_all_items():
+    """
+        Move the contents of all collections into blobs.
+
+        :return: Nothing
+        :rtype: None
+    """
+    conn = db_connect()
+    create_grid_indexes(conn)
+    for mobile in [False, True]:
+        print '{}: {} items moved into blobs'.format(mobile_or_desktop(mobile), \
+            dedup_collection(conn, mobile))
+    db_close(conn)
+
+def create_random_index(conn, mobile):
+    """
+        Create the random key index.
+
+        This create the index on the random key of one of the data collection
+        regarding the mobile parameter. It's required by the sampler.
+
+        :param conn: A mongo connection
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type mobile: bool
+        :return: The index name
+        :rtype: str
+    """
+    files_collection = '{}.files'.format(mobile_or_desktop(mobile))
+    return conn[MONGO_DATABASE][files_collection].create_index(RANDOM_KEY_FIELD)
+
+def backfill_random_keys(conn, mobile):
+    """
+        Add a random key to items which do not have one.
+
+        This add the random key to every item inserted before the sampler existed,
+        by batch of RANDOM_KEY_BATCH_SIZE updates.
+
+        :param conn: A mongo connection
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type mobile: bool
+        :return: The number of updated items
+        :rtype: int
+    """
+    files_collection = conn[MONGO_DATABASE]['{}.files'.format(mobile_or_desktop(mobile))]
+    cursor = files_collection.find({RANDOM_KEY_FIELD: {'$exists': False}}, {'_id': 1})
+    count = 0
+    requests = list()
+    for doc in cursor:
+        requests.append(pymongo.UpdateOne({'_id': doc['_id']}, \
+            {'$set': {RANDOM_KEY_FIELD: random.random()}}))
+        if len(requests) >= RANDOM_KEY_BATCH_SIZE:
+            count += files_collection.bulk_write(requests, ordered=False).modified_count
+            requests = list()
+    if requests:
+        count += files_collection.bulk_write(requests, ordered=False).modified_count
+    return count
+
+def setup_random_sampler():
+    """
+        Setup the sampler for all kind of experiences.
+
+        This create the random key indexes and backfill the missing random keys.
+
+        :return: Nothing
+        :rtype: None
+    """
+    conn = db_connect()
+    for mobile in [False, True]:
+        create_random_index(conn, mobile)
+        print '{}: {} items updated'.format(mobile_or_desktop(mobile), \
+            backfill_random_keys(conn, mobile))
+    db_close(conn)
+
+def get_sampled_item(conn, mobile):
+    """
+        Get a random item with the MongoDB randomizer.
 
         This fetch a random item from one of the data collection regarding the mobile
-        parameter. Note that the method use the MongoDB internal randomizer.
+        parameter with the MongoDB internal randomizer ($sample). It's slower than
+        the random key sampler, but does not need any random key.
 
         :param conn: A mongo connection
-        :param mobile: A user document
+        :param mobile: The mobile flag
         :type conn: MongoClient
         :type mobile: bool
-        :return: the title, the link, the content stream
+        :return: the title, the link, the content stream (None if there is no item)
         :rtype: tuple
     """
     data_collection = mobile_or_desktop(mobile)
@@ -182,7 +1022,10 @@ def get_random_item(conn, mobile):
     cursor = conn[MONGO_DATABASE][files_collection].aggregate([
         {'$sample': {'size': 1}}
     ])
-    random_result = [c for c in cursor][0]
+    random_results = [c for c in cursor]
+    if not random_results:
+        return None
+    random_result = random_results[0]
     grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=data_collection)
     results = [a for a in grid_conn.find({'filename': random_result.get('filename')})]
     if len(results) > 0:
@@ -191,20 +1034,32 @@ def get_random_item(conn, mobile):
     else:
         return (None, None, None)
 
-def find_jobs(conn):
+def get_random_item(conn, mobile):
     """
-        Find all jobs from the pool.
+        Get a random item.
 
-        This fetch the list of jobs from the MONGO_POOL_COLLECTION collection.
+        This fetch a random item from one of the data collection regarding the mobile
+        parameter. It draws a random number and returns the item with the closest
+        random key above it (wrapping around to the lowest key), so it's a single
+        indexed query whatever the size of the collection. It falls back to the
+        MongoDB internal randomizer if no item has a random key yet.
 
         :param conn: A mongo connection
+        :param mobile: The mobile flag
         :type conn: MongoClient
-        :return: A list of job documents
-        :rtype: list
+        :type mobile: bool
+        :return: the title, the link, the content stream (None if there is no item)
+        :rtype: tuple
     """
-    cursor = conn[MONGO_DATABASE][MONGO_POOL_COLLECTION].find()
-    results = [c for c in cursor]
-    return results
+    grid_conn = gridfs.GridFS(conn[MONGO_DATABASE], collection=mobile_or_desktop(mobile))
+    random_key = random.random()
+    for key_filter in [{'$gte': random_key}, {'$lt': random_key}]:
+        cursor = grid_conn.find({RANDOM_KEY_FIELD: key_filter}).sort(RANDOM_KEY_FIELD, 1).limit(1)
+        results = [a for a in cursor]
+        if len(results) > 0:
+            metadata = results[0].metadata or dict()
+            return metadata.get('title'), metadata.get('link'), results[0]
+    return get_sampled_item(conn, mobile)
 
 def find_job(conn, link):
     """
@@ -227,36 +1082,191 @@ def find_job(conn, link):
     else:
         return None
 
+def create_pool_indexes(conn):
+    """
+        Create the pool collection indexes.
+
+        This create a unique index on the link of the MONGO_POOL_COLLECTION
+        collection (a link is queued once) and an index on the lease used to
+        claim the jobs. The jobs queued twice before are removed first (the
+        oldest one is kept), the unique index could not be created otherwise. It's
+        run when the server and the workers start.
+
+        :param conn: A mongo connection
+        :type conn: MongoClient
+        :return: The index names
+        :rtype: list
+    """
+    pool_collection = conn[MONGO_DATABASE][MONGO_POOL_COLLECTION]
+    duplicates = pool_collection.aggregate([
+        {'$group': {'_id': '$link', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ])
+    for duplicate in duplicates:
+        pool_collection.delete_many({'_id': {'$in': sorted(duplicate.get('ids'))[1:]}})
+    return [pool_collection.create_index('link', unique=True), \
+        pool_collection.create_index([('leaseUntil', 1), ('createdAt', 1)])]
+
 def insert_job(conn, job):
     """
         Insert a new job.
 
-        This insert a new job into the MONGO_POOL_COLLECTION collection.
+        This insert a new job into the MONGO_POOL_COLLECTION collection. A job
+        with the same link is rejected by the unique index of the collection.
 
         :param conn: A mongo connection
         :param job: A job document
         :type conn: MongoClient
         :type job: dict
-        :return: TODO
-        :rtype: TODO
+        :return: The id of the job (None if the link is already queued)
+        :rtype: ObjectId
     """
-    job_already_exists = find_job(conn, job.get('link'))
-    if job_already_exists:
+    job = dict(job, attempts=0)
+    try:
+        return conn[MONGO_DATABASE][MONGO_POOL_COLLECTION].insert_one(job).inserted_id
+    except pymongo.errors.DuplicateKeyError:
         return None
-    else:
-        return conn[MONGO_DATABASE][MONGO_POOL_COLLECTION].insert(job)
 
-def remove_job(conn, job):
+def claim_job(conn, worker_id):
     """
-        Remove a job from the pool.
+        Claim the oldest available job of the pool.
 
-        This remove a job from the MONGO_POOL_COLLECTION collection.
+        This atomically lease a job of the MONGO_POOL_COLLECTION collection for
+        JOB_LEASE_SECONDS seconds: other workers do not see it until the lease
+        expires (the worker died, or it has been retried). Each claim counts as an
+        attempt, jobs claimed more than JOB_MAX_ATTEMPTS times are dead-lettered.
 
         :param conn: A mongo connection
-        :param job: A job document
+        :param worker_id: An identifier of the worker
+        :type conn: MongoClient
+        :type worker_id: str
+        :return: A job document (None if there is no available job)
+        :rtype: dict
+    """
+    while True:
+        now = datetime.datetime.utcnow()
+        job = conn[MONGO_DATABASE][MONGO_POOL_COLLECTION].find_one_and_update( \
+            {'$or': [{'leaseUntil': {'$lte': now}}, {'leaseUntil': {'$exists': False}}]}, \
+            {'$set': {
+                'leaseUntil': now + datetime.timedelta(seconds=JOB_LEASE_SECONDS),
+                'worker': worker_id
+            }, '$inc': {'attempts': 1}}, \
+            sort=[('createdAt', pymongo.ASCENDING)], \
+            return_document=pymongo.ReturnDocument.AFTER)
+        if not job or job.get('attempts') <= JOB_MAX_ATTEMPTS:
+            return job
+        dead_letter_job(conn, job, job.get('lastError', 'Lease expired'))
+
+def complete_job(conn, job):
+    """
+        Remove a processed job from the pool.
+
+        :param conn: A mongo connection
+        :param job: A claimed job document
         :type conn: MongoClient
         :type job: dict
         :return: An instance of DeleteResult
         :rtype: DeleteResult
     """
-    return conn[MONGO_DATABASE][MONGO_POOL_COLLECTION].delete_one(job)
+    return conn[MONGO_DATABASE][MONGO_POOL_COLLECTION].delete_one({'_id': job.get('_id')})
+
+def fail_job(conn, job, error):
+    """
+        Release a failed job.
+
+        The job is retried after JOB_RETRY_DELAY seconds (doubled at each
+        attempt), or dead-lettered if it already used its JOB_MAX_ATTEMPTS attempts.
+
+        :param conn: A mongo connection
+        :param job: A claimed job document
+        :param error: The error of the attempt
+        :type conn: MongoClient
+        :type job: dict
+        :type error: str
+        :return: Retried or not (dead-lettered)
+        :rtype: bool
+    """
+    attempts = job.get('attempts', 1)
+    if attempts >= JOB_MAX_ATTEMPTS:
+        dead_letter_job(conn, job, error)
+        return False
+    retry_at = datetime.datetime.utcnow() + \
+        datetime.timedelta(seconds=JOB_RETRY_DELAY * 2 ** (attempts - 1))
+    conn[MONGO_DATABASE][MONGO_POOL_COLLECTION].update_one({'_id': job.get('_id')}, \
+        {'$set': {'leaseUntil': retry_at, 'lastError': error}})
+    return True
+
+def dead_letter_job(conn, job, error):
+    """
+        Move a job to the dead jobs.
+
+        This move a job which can't be processed from the MONGO_POOL_COLLECTION
+        collection to the MONGO_DEAD_POOL_COLLECTION collection.
+
+        :param conn: A mongo connection
+        :param job: A job document
+        :param error: The last error of the job
+        :type conn: MongoClient
+        :type job: dict
+        :type error: str
+        :return: Nothing
+        :rtype: None
+    """
+    dead_job = dict(job, lastError=error, deadAt=datetime.datetime.utcnow())
+    conn[MONGO_DATABASE][MONGO_DEAD_POOL_COLLECTION].replace_one( \
+        {'_id': job.get('_id')}, dead_job, upsert=True)
+    conn[MONGO_DATABASE][MONGO_POOL_COLLECTION].delete_one({'_id': job.get('_id')})
+
+def create_feed_index(conn):
+    """
+        Create the feed collection index.
+
+        This create a specific index for the MONGO_FEEDS_COLLECTION collection.
+        The index is based on the url field and ensure unicity of feeds.
+
+        :param conn: A mongo connection
+        :type conn: MongoClient
+        :return: The index name
+        :rtype: str
+    """
+    return conn[MONGO_DATABASE][MONGO_FEEDS_COLLECTION].create_index('url', unique=True)
+
+def find_feed(conn, url):
+    """
+        Find the state of a rss feed.
+
+        This fetch the state of a rss feed (HTTP validators...) from the
+        MONGO_FEEDS_COLLECTION collection regarding its url.
+
+        :param conn: A mongo connection
+        :param url: The url of the rss feed
+        :type conn: MongoClient
+        :type url: str
+        :return: A feed document (None if the feed has never been crawled)
+        :rtype: dict
+    """
+    return conn[MONGO_DATABASE][MONGO_FEEDS_COLLECTION].find_one({'url': url})
+
+def update_feed(conn, url, state, removed=None):
+    """
+        Update the state of a rss feed.
+
+        This update (or insert) the state of a rss feed into the
+        MONGO_FEEDS_COLLECTION collection.
+
+        :param conn: A mongo connection
+        :param url: The url of the rss feed
+        :param state: The fields of the state to update
+        :param removed: The fields of the state to remove
+        :type conn: MongoClient
+        :type url: str
+        :type state: dict
+        :type removed: list
+        :return: An instance of UpdateResult
+        :rtype: UpdateResult
+    """
+    update = {'$set': state}
+    if removed:
+        update['$unset'] = dict((key, '') for key in removed)
+    return conn[MONGO_DATABASE][MONGO_FEEDS_COLLECTION].update_one( \
+        {'url': url}, update, upsert=True)
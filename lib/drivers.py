@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+
+"""The web drivers pool methods and class
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import fcntl
+import Queue
+import atexit
+import signal
+import weakref
+import threading
+import contextlib
+
+from lib.config import load_config
+
+from lib.metrics import METRICS
+
+CONFIG = load_config().get('feeder')
+
+DRIVER_MAX_PAGES = CONFIG.get('DRIVER_MAX_PAGES', 200)
+DRIVER_MAX_RSS_MB = CONFIG.get('DRIVER_MAX_RSS_MB', 512)
+DRIVER_HEALTH_TIMEOUT = CONFIG.get('DRIVER_HEALTH_TIMEOUT', 10)
+DRIVER_START_RETRIES = 3
+DRIVER_START_RETRY_DELAY = 1 # doubled at each attempt
+LIB_DIR_ABSPATH = os.path.dirname(os.path.abspath(__file__))
+DRIVER_PIDS_FILEPATH = CONFIG.get('DRIVER_PIDS_FILEPATH', \
+    os.path.join(LIB_DIR_ABSPATH, '../drivers.pids'))
+DRIVER_PROCESS_NAME = 'phantomjs'
+MANAGED_DRIVERS = weakref.WeakSet()
+
+def get_process_rss(pid):
+    """
+        Get the resident memory of a process.
+
+        :param pid: A process id
+        :type pid: int
+        :return: The resident memory in bytes (None if unknown)
+        :rtype: int
+    """
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+def get_process_start(pid):
+    """
+        Get the start time of a process.
+
+        It tells a process from a later one which reused its id.
+
+        :param pid: A process id
+        :type pid: int
+        :return: The start time in clock ticks since boot (None if the process is gone)
+        :rtype: int
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'r') as stat_file:
+            stat = stat_file.read()
+        return int(stat[stat.rfind(')') + 2:].split()[19])
+    except (IOError, ValueError, IndexError):
+        return None
+
+def kill_process(pid):
+    """
+        Kill a process.
+
+        :param pid: A process id
+        :type pid: int
+        :return: Killed or not
+        :rtype: bool
+    """
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        return False
+    return True
+
+@contextlib.contextmanager
+def driver_pids_lock(filepath=None):
+    """
+        Hold the lock of the web driver pids file.
+
+        :param filepath: The pids file path (DRIVER_PIDS_FILEPATH by default)
+        :type filepath: str
+        :return: A context manager
+        :rtype: GeneratorContextManager
+    """
+    with open((filepath or DRIVER_PIDS_FILEPATH) + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def read_driver_pids():
+    """
+        Read the web driver pids file (the lock must be held).
+
+        :return: The (pid, start, owner pid, owner start) of each tracked web driver
+        :rtype: list
+    """
+    try:
+        with open(DRIVER_PIDS_FILEPATH, 'r') as pids_file:
+            return [tuple(int(x) for x in line.split()) for line in pids_file \
+                if len(line.split()) == 4]
+    except (IOError, ValueError) as err:
+        if os.path.exists(DRIVER_PIDS_FILEPATH):
+            print err
+        return list()
+
+def write_driver_pids(entries):
+    """
+        Write the web driver pids file (the lock must be held).
+
+        :param entries: The (pid, start, owner pid, owner start) of each tracked
+            web driver
+        :type entries: list
+        :return: Nothing
+        :rtype: None
+    """
+    try:
+        with open(DRIVER_PIDS_FILEPATH + '.tmp', 'w') as pids_file:
+            pids_file.write(''.join('{} {} {} {}\n'.format(*x) for x in entries))
+        os.rename(DRIVER_PIDS_FILEPATH + '.tmp', DRIVER_PIDS_FILEPATH)
+    except (IOError, OSError) as err:
+        print err
+
+def track_driver(pid):
+    """
+        Add a started web driver process to the pids file.
+
+        :param pid: The process id of the web driver
+        :type pid: int
+        :return: Nothing
+        :rtype: None
+    """
+    start = get_process_start(pid) if pid else None
+    if start is None:
+        return
+    with driver_pids_lock():
+        entries = [x for x in read_driver_pids() if x[0] != pid]
+        write_driver_pids(entries + [(pid, start, os.getpid(), get_process_start(os.getpid()))])
+
+def untrack_driver(pid):
+    """
+        Remove a closed web driver process from the pids file.
+
+        :param pid: The process id of the web driver
+        :type pid: int
+        :return: Nothing
+        :rtype: None
+    """
+    if not pid:
+        return
+    with driver_pids_lock():
+        entries = read_driver_pids()
+        if any(x[0] == pid for x in entries):
+            write_driver_pids([x for x in entries if x[0] != pid])
+
+def reap_orphan_drivers():
+    """
+        Kill the orphan web driver processes.
+
+        The web drivers started by the feeder and the workers are tracked into the
+        DRIVER_PIDS_FILEPATH file with the process which started them. This kill
+        the tracked web drivers whose owner died, which happens when the feeder or
+        a worker is stopped without closing its web drivers. A process is only
+        killed if it's still the started one (same start time), never a process
+        which reused its id.
+
+        :return: The number of killed processes
+        :rtype: int
+    """
+    killed = 0
+    if not os.path.isdir('/proc'): # no procfs
+        return killed
+    with driver_pids_lock():
+        entries = read_driver_pids()
+        running = list()
+        for pid, start, owner, owner_start in entries:
+            if get_process_start(pid) != start: # already gone
+                continue
+            if get_process_start(owner) == owner_start:
+                running.append((pid, start, owner, owner_start))
+                continue
+            killed += kill_process(pid)
+        if running != entries:
+            write_driver_pids(running)
+    if killed:
+        print '{} orphan {} processes killed'.format(killed, DRIVER_PROCESS_NAME)
+    return killed
+
+def close_managed_drivers():
+    """
+        Close all the managed web drivers, then kill the orphan ones.
+
+        This is called at exit, so no web driver survives the application.
+
+        :return: Nothing
+        :rtype: None
+    """
+    for driver in list(MANAGED_DRIVERS):
+        driver.quit()
+    reap_orphan_drivers()
+
+atexit.register(close_managed_drivers)
+
+class ManagedDriver(object):
+    """
+        Define a web driver which is recycled and restarted when needed.
+
+        It can be used as the web driver itself, every other attribute is the one
+        of the current web driver.
+    """
+    def __init__(self, factory, max_pages=DRIVER_MAX_PAGES, max_rss_mb=DRIVER_MAX_RSS_MB):
+        """
+            Initialize a managed driver object.
+
+            This start a web driver with the factory method. The web driver is
+            recycled after max_pages pages or once its resident memory is over
+            max_rss_mb MB.
+
+            :param factory: A method starting a new web driver
+            :param max_pages: The max number of pages of a web driver
+            :param max_rss_mb: The max resident memory of a web driver
+            :type factory: function
+            :type max_pages: int
+            :type max_rss_mb: int
+        """
+        self.factory = factory
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.driver = None
+        self.started_at = None
+        self.pages = 0
+        self.total_pages = 0
+        self.recycles = 0
+        self.restarts = 0
+        self.start()
+        MANAGED_DRIVERS.add(self)
+
+    def __getattr__(self, name):
+        """
+            Get an attribute of the current web driver.
+
+            :param name: The attribute name
+            :type name: str
+            :return: The attribute value
+            :rtype: object
+        """
+        return getattr(self.driver, name)
+
+    def start(self):
+        """
+            Start a new web driver.
+
+            :return: Nothing
+            :rtype: None
+        """
+        self.driver = self.factory()
+        self.started_at = time.time()
+        self.pages = 0
+        track_driver(self.get_pid())
+
+    def get_pid(self):
+        """
+            Get the process id of the current web driver.
+
+            :return: The process id (None if unknown)
+            :rtype: int
+        """
+        process = getattr(getattr(self.driver, 'service', None), 'process', None)
+        return getattr(process, 'pid', None)
+
+    def get_rss(self):
+        """
+            Get the resident memory of the current web driver.
+
+            :return: The resident memory in bytes (None if unknown)
+            :rtype: int
+        """
+        pid = self.get_pid()
+        return get_process_rss(pid) if pid else None
+
+    def get(self, url):
+        """
+            Load a page with the current web driver.
+
+            :param url: Link to load
+            :type url: str
+            :return: Nothing
+            :rtype: None
+        """
+        self.pages += 1
+        self.total_pages += 1
+        self.driver.get(url)
+
+    def is_healthy(self, timeout=DRIVER_HEALTH_TIMEOUT):
+        """
+            Check if the current web driver still answers.
+
+            :param timeout: The max time to answer (in seconds)
+            :type timeout: int
+            :return: Healthy or not
+            :rtype: bool
+        """
+        answers = list()
+        def ping():
+            try:
+                answers.append(self.driver.execute_script('return 1;'))
+            except Exception as err:
+                print err
+        thread = threading.Thread(target=ping)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        return answers == [1]
+
+    def quit(self):
+        """
+            Close the current web driver (its process is killed if it hangs).
+
+            The process is only killed while the quit is still running and if it's
+            still the web driver one, so a process which reused its id is never
+            killed.
+
+            :return: Nothing
+            :rtype: None
+        """
+        if not self.driver:
+            return
+        pid = self.get_pid()
+        start = get_process_start(pid) if pid else None
+        thread = threading.Thread(target=self.driver.quit)
+        thread.daemon = True
+        thread.start()
+        thread.join(DRIVER_HEALTH_TIMEOUT)
+        if start is not None and thread.is_alive() and get_process_start(pid) == start:
+            kill_process(pid)
+        untrack_driver(pid)
+        self.driver = None
+
+    def recycle(self):
+        """
+            Replace the current web driver by a new one (it served too much).
+
+            :return: Nothing
+            :rtype: None
+        """
+        self.quit()
+        self.start()
+        self.recycles += 1
+        METRICS.count('driver_recycles_total')
+
+    def restart(self):
+        """
+            Replace the current web driver by a new one (it's broken).
+
+            :return: Nothing
+            :rtype: None
+        """
+        self.quit()
+        self.start()
+        self.restarts += 1
+        METRICS.count('driver_restarts_total')
+
+    def checkup(self):
+        """
+            Recycle or restart the current web driver if needed.
+
+            This is called between two jobs: the web driver is recycled when it
+            loaded too many pages or uses too much memory, and restarted when it
+            does not answer anymore.
+
+            :return: Nothing
+            :rtype: None
+        """
+        rss = self.get_rss()
+        if self.pages >= self.max_pages or (rss and rss > self.max_rss_mb * 1024 * 1024):
+            print 'Web driver recycled: {}'.format(self.stats())
+            self.recycle()
+        elif not self.is_healthy():
+            print 'Web driver is not answering, restart it'
+            self.restart()
+
+    def stats(self):
+        """
+            Get the statistics of the managed driver.
+
+            :return: The age (in seconds), the pages served, the recycles and the
+                restarts of the managed driver, the memory of the current web driver
+            :rtype: dict
+        """
+        return {
+            'age': time.time() - self.started_at,
+            'pages': self.pages,
+            'total_pages': self.total_pages,
+            'recycles': self.recycles,
+            'restarts': self.restarts,
+            'rss': self.get_rss()
+        }
+
+class DriverPool(object):
+    """
+        Define a pool of long-lived web drivers shared by several threads.
+    """
+    def __init__(self, factory, size):
+        """
+            Initialize a driver pool object.
+
+            This start size web drivers with the factory method.
+
+            :param factory: A method starting a new web driver
+            :param size: The number of web drivers
+            :type factory: function
+            :type size: int
+        """
+        self.factory = factory
+        self.size = size
+        self.drivers = Queue.Queue()
+        for _ in range(size):
+            self.drivers.put(factory())
+
+    def acquire(self):
+        """
+            Get a free web driver (wait until one is released).
+
+            A managed driver which could not be started (see replace) is started
+            again first.
+
+            :return: A web driver
+            :rtype: WebDriver
+        """
+        driver = self.drivers.get()
+        if isinstance(driver, ManagedDriver) and not driver.driver:
+            try:
+                driver.start()
+            except Exception as err:
+                print err
+        return driver
+
+    def release(self, driver):
+        """
+            Give back a web driver to the pool.
+
+            Cookies are deleted so the next user of the driver starts clean, a
+            managed driver also gets its checkup.
+
+            :param driver: A web driver
+            :type driver: WebDriver
+            :return: Nothing
+            :rtype: None
+        """
+        try:
+            driver.delete_all_cookies()
+            if isinstance(driver, ManagedDriver):
+                driver.checkup()
+        except Exception as err:
+            print err
+            self.replace(driver)
+            return
+        self.drivers.put(driver)
+
+    def replace(self, driver):
+        """
+            Close a (broken) web driver and put a new one into the pool.
+
+            A managed driver is restarted in place. The pool never shrinks: the new
+            web driver is started DRIVER_START_RETRIES times at most, then the broken
+            one is put back (started again when it's acquired, for a managed
+            driver, replaced again on its next failure otherwise).
+
+            :param driver: A web driver
+            :type driver: WebDriver
+            :return: Nothing
+            :rtype: None
+        """
+        try:
+            driver.quit()
+        except Exception as err:
+            print err
+        for attempt in range(DRIVER_START_RETRIES):
+            if attempt:
+                time.sleep(DRIVER_START_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                if isinstance(driver, ManagedDriver):
+                    driver.restart()
+                else:
+                    driver = self.factory()
+                break
+            except Exception as err:
+                print err
+        self.drivers.put(driver)
+
+    def stats(self):
+        """
+            Get the statistics of the free managed drivers of the pool.
+
+            :return: The statistics of each free managed driver
+            :rtype: list
+        """
+        return [driver.stats() for driver in list(self.drivers.queue) \
+            if isinstance(driver, ManagedDriver)]
+
+    def close(self):
+        """
+            Close all the web drivers of the pool.
+
+            :return: Nothing
+            :rtype: None
+        """
+        for _ in range(self.size):
+            try:
+                self.drivers.get_nowait().quit()
+            except Queue.Empty:
+                break
+            except Exception as err:
+                print err
@@ -8,20 +8,38 @@ from __future__ import unicode_literals
 import os
 import json
 import time
+import Queue
 import datetime
+import threading
 
 from selenium import webdriver
 
-from xml.etree import ElementTree
-
 from lib.config import load_config
 
-from lib.db import db_connect, db_close, insert_item, item_exists_in_db
+from lib.db import db_connect, db_close, insert_item, item_exists_in_db, items_exist_in_db, \
+    find_feed, update_feed, rebuild_links_filter
+
+from lib.drivers import DriverPool, ManagedDriver, reap_orphan_drivers
+
+from lib.fetcher import fetch_page, fetch_feed, execute_phantom_script, get_profile_stats, \
+    FETCH_STATS, SCHEDULER
 
 from lib.item import Item, clean_link, format_link
 
+from lib.metrics import time_stage, count_event, start_metrics_file
+
 from lib.parser import magic_decoding
 
+from lib.poller import poll_feeds, commit_feed
+
+from lib.reader import iter_entries
+
+from lib.render import prerender_item
+
+from lib.urls_filter import get_local_unwanted_urls
+
+from lib.writer import ItemWriter, PendingItem
+
 CONFIG = load_config().get('feeder')
 
 LIB_DIR_ABSPATH = os.path.dirname(os.path.abspath(__file__))
@@ -33,74 +51,101 @@ PAGE_LOAD_TIMEOUT = CONFIG.get('PAGE_LOAD_TIMEOUT')
 DEFAULT_USERNAME = CONFIG.get('DEFAULT_USERNAME')
 MOBILE_USER_AGENT = CONFIG.get('MOBILE_USER_AGENT')
 DESKTOP_USER_AGENT = CONFIG.get('DESKTOP_USER_AGENT')
+DRIVER_POOL_SIZE = CONFIG.get('DRIVER_POOL_SIZE', 4)
+SEEN_ENTRIES_MAX = CONFIG.get('SEEN_ENTRIES_MAX', 1000) # per feed and experience
+FETCH_PROFILES = {
+    'full': {'loadImages': True, 'blockUnwanted': False, 'blockedUrls': None},
+    'source-only': {
+        'loadImages': False,
+        'blockUnwanted': True, # hosts of the unwanted_urls file
+        'blockedUrls': '\\.(css|woff2?|ttf|otf|eot|svg|png|jpe?g|gif|webp|ico|mp4|webm)(\\?|$)'
+    }
+}
+FETCH_PROFILE = CONFIG.get('FETCH_PROFILE', 'source-only')
+FETCH_PROFILE_SCRIPT = """
+    var page = this;
+    var blockedHosts = {};
+    arguments[0].forEach(function (host) { blockedHosts[host.toLowerCase()] = true; });
+    var blockedUrls = arguments[1] ? new RegExp(arguments[1], 'i') : null;
+    page.transferredBytes = 0;
+    page.onResourceRequested = function (requestData, networkRequest) {
+        var labels = (requestData.url.split('/')[2] || '').split(':')[0].toLowerCase().split('.');
+        for (var i = 0; i < labels.length - 1; i++) {
+            if (blockedHosts[labels.slice(i).join('.')]) {
+                networkRequest.abort();
+                return;
+            }
+        }
+        if (blockedUrls && blockedUrls.test(requestData.url)) {
+            networkRequest.abort();
+        }
+    };
+    page.onResourceReceived = function (response) {
+        if (response.stage === 'start' && response.bodySize) {
+            page.transferredBytes += response.bodySize;
+        }
+    };
+"""
+UNWANTED_HOSTS = list()
 
-def get_content(driver, url):
+def get_content(driver, url, mobile, source=''):
     """
         Fetch web content from an url.
 
-        This fetch web page content regarding an url and using a predefined web driver.
-        The returned content is automatically decoded with the magic decoding method.
+        This fetch web page content regarding an url, with a plain HTTP GET or with
+        a predefined web driver when the page needs it (see fetch_page). The
+        returned content is automatically decoded with the magic decoding method.
+        Both stages are timed for the source (see time_stage).
 
         :param driver: A web driver
         :param url: Link to fetch
+        :param mobile: The mobile flag
+        :param source: The source of the link (the rss feed url, or jobs)
         :type driver: WebDriver
         :type url: str
-        :return: The web page content
-        :rtype: str
+        :type mobile: bool
+        :type source: str
+        :return: The web page content, the final url
+        :rtype: tuple
     """
-    driver.get(url)
-    return magic_decoding(driver.page_source)
+    with time_stage('page_fetch', source):
+        content, final_url = fetch_page(driver, url, mobile)
+    with time_stage('decode', source):
+        return magic_decoding(content), final_url
 
-def get_feed(driver, url):
+def get_feed(driver, url, mobile):
     """
         Fetch rss feed from an url.
 
-        This fetch rss feed content regarding an url and using a predefined web driver.
-        Compared to the get_content method, this one do not magic decode at the end
-        of the process.
+        This fetch rss feed content regarding an url, with a plain HTTP GET or with
+        a predefined web driver as a fallback (see fetch_feed). Compared to the
+        get_content method, this one do not magic decode at the end of the process.
 
         :param driver: A web driver
         :param url: Link to fetch
+        :param mobile: The mobile flag
         :type driver: WebDriver
         :type url: str
+        :type mobile: bool
         :return: The rss feed content
         :rtype: str
     """
-    driver.get(url)
-    return driver.page_source.encode('utf-8')
+    return fetch_feed(driver, url, mobile)
 
-def format_item(item, xmlns, key):
-    """
-        Format a rss item and return data.
-
-        This properly format a rss item regarding the xmlns attribute and a key.
-        It returns the data of the item regarding it's key.
-
-        :param item: A rss item
-        :param xmlns: XML namespace of the rss feed
-        :param key: The key to format
-        :type item: WebDriver
-        :type xmlns: str
-        :type key: str
-        :return: The item content
-        :rtype: str
-    """
-    formated_key = key
-    if xmlns:
-        formated_key = xmlns + key
-    data = item.find(formated_key)
-    if key == 'link' and xmlns:
-        return data.attrib.get('href')
-    else:
-        return ''.join(data.itertext())
-
-def fetch_and_insert(conn, driver, mobile, url, title, link, username):
+def fetch_and_insert(conn, driver, mobile, url, title, link, username, check_exists=True, \
+    writer=None):
     """
         Fetch content from url and and insert results into the db.
 
         This fetch the content from a specified url with a predefined web driver.
         The method does not parse any item, the title or link are already given as
         parameters. A user is also associated with each item inserted into the db.
+        The content is also rendered once and stored next to the raw content. The
+        raw content is queued to a write-behind writer when one is given, it
+        raises if the item could not be inserted otherwise.
+
+        The existence check and the insert are timed, the fetched pages and the
+        skipped ones are counted, for the source (see lib.metrics).
 
         :param conn: A mongo connection
         :param driver: A web driver
@@ -109,6 +154,9 @@ def fetch_and_insert(conn, driver, mobile, url, title, link, username):
         :param title: The title of the item
         :param link: The link ref of the item
         :param username: The username associated with the item
+        :param check_exists: Check if the item already exists (False when the
+            caller already checked it, see items_exist_in_db)
+        :param writer: A write-behind writer (the item is inserted at once if None)
         :type conn: MongoClient
         :type driver: WebDriver
         :type mobile: bool
@@ -116,60 +164,159 @@ def fetch_and_insert(conn, driver, mobile, url, title, link, username):
         :type title: str
         :type link: str
         :type username: str
-        :return: Nothing
-        :rtype: None
+        :type check_exists: bool
+        :type writer: ItemWriter
+        :return: 'continue' if the item is skipped, the pending item if it's queued
+            to a writer (see PendingItem)
+        :rtype: object
     """
     if not link:
         return 'continue'
     link = format_link(link)
-    if item_exists_in_db(conn, link, mobile):
-        return 'continue'
+    source = url or 'jobs'
+    if check_exists:
+        with time_stage('exists_check', source):
+            exists = item_exists_in_db(conn, link, mobile)
+        if exists:
+            count_event('skips_total', source, link=link, reason='known')
+            return 'continue'
     start_time = time.time()
     print 'Get content for {}'.format(link)
-    content = get_content(driver, link)
-    final_link = clean_link(driver.current_url)
+    content, final_url = get_content(driver, link, mobile, source)
+    final_link = clean_link(final_url)
     print 'Content is parsed for {}, took {} s'.format(link, (time.time() - start_time))
     item = Item(title, final_link, url, username, content)
-    insert_item(conn, item.link, str(item.content), item.get_metadata(), mobile)
-
-def rss_parser(conn, driver, mobile, url):
+    pending = None
+    if writer:
+        pending = writer.put(item.link, str(item.content), item.get_metadata(), mobile)
+    else:
+        with time_stage('insert', source):
+            inserted = insert_item(conn, item.link, str(item.content), item.get_metadata(), mobile)
+        if not inserted:
+            raise Exception('{} could not be inserted...'.format(item.link))
+    count_event('pages_total', source)
+    prerender_item(conn, item.link, str(item.content), item.link, mobile)
+    return pending
+
+def rss_parser(conn, driver, mobile, url, rss_feed_content=None, writer=None):
     """
         Fetch and insert for a rss feed.
 
-        This fetch rss data, then fetch html content of each link and insert parsed
-        content into the db for one rss feed represented by the url.
+        This fetch rss data (unless it has already been polled), then fetch html
+        content of each link and insert parsed content into the db for one rss feed
+        represented by the url.
+
+        The feed is read entry by entry (see iter_entries). The feed state of the
+        experience (the last SEEN_ENTRIES_MAX seen entries, the newest publication
+        date, the failed entries and whether the feed is ordered by date) is kept
+        into the feeds collection. Seen entries are skipped, and so are the entries
+        older than the newest publication date (the high-water mark), so only the
+        new entries are fetched. The mark only moves up to the entries inserted
+        (written, when they are queued to a writer) or already stored, and never
+        past a failed entry, so failed entries are fetched again the next time.
+        The reading stops at the first known entry of a feed ordered by date (the
+        newest first) once the failed entries are reached. Skipped entries and
+        failed pages are counted for the feed (see lib.metrics).
 
         :param conn: A mongo connection
         :param driver: A web driver
         :param mobile: The mobile flag
         :param url: The url of the rss feed
+        :param rss_feed_content: The raw rss feed content (fetched if empty)
+        :param writer: A write-behind writer (see fetch_and_insert)
         :type conn: MongoClient
         :type driver: WebDriver
         :type mobile: bool
         :type url: str
-        :return: Nothing
-        :rtype: None
+        :type rss_feed_content: str
+        :type writer: ItemWriter
+        :return: The number of fetched pages and of failed entries
+        :rtype: dict
     """
-    rss_feed_content = get_feed(driver, url)
+    if not rss_feed_content:
+        with time_stage('feed_fetch', url):
+            rss_feed_content = get_feed(driver, url, mobile)
     print '-- Begin parsing for {} @ {} --'.format(url, datetime.datetime.now().isoformat())
-    tree = ElementTree.fromstring(rss_feed_content)
-    items = tree.findall('.//item')
-    xmlns = ''
-    if not items:
-        xmlns = '{http://www.w3.org/2005/Atom}'
-        items = tree.findall('.//{}entry'.format(xmlns))
-    for item in items:
+    variant = 'mobile' if mobile else 'desktop'
+    state = (find_feed(conn, url) or dict()).get(variant, dict())
+    seen = state.get('seen', list())
+    seen_guids = set(seen)
+    newest_date = state.get('newestPubDate')
+    retries = set(state.get('failed', list()))
+    descending = True # the dates read so far are decreasing
+    last_date = None
+    new_guids = list()
+    failed_guids = list()
+    new_newest_date = newest_date
+    failed_dates = list()
+    failures = 0
+    pages = 0
+    skipped = 0
+    older = 0
+    entries = list()
+    for entry in iter_entries(rss_feed_content):
+        guid, date = entry.get('guid'), entry.get('date')
+        if date and last_date and date > last_date:
+            descending = False
+        last_date = date or last_date
+        retries.discard(guid)
+        known = guid in seen_guids or newest_date and date and date < newest_date
+        if known and state.get('ordered') and descending and not retries:
+            break # the next entries are known too
+        if guid in seen_guids:
+            skipped += 1
+            continue
+        if known:
+            older += 1
+            continue
+        entries.append(entry)
+    count_event('skips_total', url, skipped, link=url, reason='seen')
+    count_event('skips_total', url, older, link=url, reason='older')
+    with time_stage('exists_check', url):
+        existing_links = items_exist_in_db(conn, \
+            [format_link(x.get('link')) for x in entries if x.get('link')], [mobile])[mobile]
+    results = list()
+    for entry in entries:
+        link = entry.get('link')
         try:
-            title = format_item(item, xmlns, 'title')
-            link = format_item(item, xmlns, 'link')
-            tmp_res = fetch_and_insert(conn, driver, mobile, url, title, link, DEFAULT_USERNAME)
-            if tmp_res == 'continue':
-                continue
-            time.sleep(0.5)
+            if link and format_link(link) in existing_links:
+                count_event('skips_total', url, link=link, reason='known')
+                tmp_res = 'continue'
+            else:
+                tmp_res = fetch_and_insert(conn, driver, mobile, url, entry.get('title'), \
+                    link, DEFAULT_USERNAME, check_exists=False, writer=writer)
         except Exception as err:
             print err
+            count_event('failures_total', url, link=link, stage='page')
+            tmp_res = 'failed'
+        results.append((entry, tmp_res))
+    for entry, tmp_res in results: # once the queued items are written
+        guid, date, link = [entry.get(x) for x in ['guid', 'date', 'link']]
+        if tmp_res == 'failed' or isinstance(tmp_res, PendingItem) and not tmp_res.wait():
+            failures += 1
+            if date:
+                failed_dates.append(date)
+            if guid:
+                failed_guids.append(guid)
+            continue
+        if guid:
+            new_guids.append(guid)
+        if link and date and (not new_newest_date or date > new_newest_date):
+            new_newest_date = date
+        if tmp_res == 'continue':
             continue
-    return
+        pages += 1
+    if new_newest_date and failed_dates: # never past a failed entry
+        new_newest_date = min([new_newest_date] + failed_dates)
+    update_feed(conn, url, {variant: {
+        'seen': (new_guids + seen)[:SEEN_ENTRIES_MAX],
+        'newestPubDate': new_newest_date,
+        'failed': failed_guids[:SEEN_ENTRIES_MAX],
+        'ordered': descending
+    }})
+    print '-- {} new pages, {} failed, {} known entries and {} older entries skipped for {} ({}) ' \
+        '--'.format(pages, failures, skipped, older, url, variant)
+    return {'pages': pages, 'failures': failures}
 
 def get_rss_sources():
     """
@@ -190,7 +337,21 @@ def get_rss_sources():
         print err
     return sources
 
-def webdriver_init_with_caps(user_agent):
+def get_unwanted_hosts():
+    """
+        Load the unwanted hosts once.
+
+        :return: The unwanted hosts (empty if the unwanted_urls file is missing)
+        :rtype: list
+    """
+    if not UNWANTED_HOSTS:
+        try:
+            UNWANTED_HOSTS.extend(get_local_unwanted_urls())
+        except IOError as err:
+            print err
+    return UNWANTED_HOSTS
+
+def webdriver_init_with_caps(user_agent, profile=FETCH_PROFILE):
     """
         Initialize a web driver with capabilities.
 
@@ -199,17 +360,29 @@ def webdriver_init_with_caps(user_agent):
         to the PhantomJS binary file with the path PHANTOM_JS_DRIVER_PATH. Finally
         the driver use the additional capability to refine it's user agent.
 
+        The fetch profile (see FETCH_PROFILES) tells which resources of the pages
+        are loaded: the source-only profile does not load images and blocks the
+        requests to the unwanted hosts and to the stylesheets, fonts and medias.
+
         :param user_agent: The user agent to use
+        :param profile: The fetch profile name
         :type conn: str
+        :type profile: str
         :return: A web driver
         :rtype: WebDriver
     """
-    PHANTOM_JS_DRIVER_CAPS['phantomjs.page.settings.userAgent'] = user_agent
+    settings = FETCH_PROFILES[profile]
+    caps = dict(PHANTOM_JS_DRIVER_CAPS)
+    caps['phantomjs.page.settings.userAgent'] = user_agent
+    caps['phantomjs.page.settings.loadImages'] = settings.get('loadImages')
     driver = webdriver.PhantomJS(PHANTOM_JS_DRIVER_PATH, \
         service_args=PHANTOM_JS_DRIVER_ARGS, \
-        desired_capabilities=PHANTOM_JS_DRIVER_CAPS)
+        desired_capabilities=caps)
     driver.delete_all_cookies()
     driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
+    blocked_hosts = get_unwanted_hosts() if settings.get('blockUnwanted') else list()
+    execute_phantom_script(driver, FETCH_PROFILE_SCRIPT, blocked_hosts, settings.get('blockedUrls'))
+    driver.fetch_profile = profile
     return driver
 
 def webdriver_init(mobile):
@@ -229,32 +402,98 @@ def webdriver_init(mobile):
     else:
         return webdriver_init_with_caps(DESKTOP_USER_AGENT)
 
-def insert_links(mobile):
+def crawl_sources(conn, pool, mobile, sources, results, writer):
     """
-        Fetch and insert for all rss feeds.
+        Fetch and insert for rss feeds until there is no more feed to crawl.
 
-        This fetch rss data, then fetch html content of each link and insert parsed
-        content into the db for all rss feeds.
+        This is run by each crawling thread: it takes the next rss feed, then
+        crawls it with a free web driver from the pool.
 
-        :param driver: A web driver
+        :param conn: A mongo connection
+        :param pool: A pool of web drivers
         :param mobile: The mobile flag
-        :type driver: WebDriver
+        :param sources: A queue of rss feeds (url and raw content)
+        :param results: The fetched pages and failed entries of each crawled rss
+            feed (see rss_parser)
+        :param writer: The write-behind writer of the items
+        :type conn: MongoClient
+        :type pool: DriverPool
         :type mobile: bool
+        :type sources: Queue
+        :type results: dict
+        :type writer: ItemWriter
         :return: Nothing
         :rtype: None
     """
-    conn = db_connect()
-    sources = get_rss_sources()
-    for source in sources:
-        driver = webdriver_init(mobile=mobile)
+    while True:
         try:
-            rss_parser(conn, driver, mobile, source)
+            source, rss_feed_content = sources.get_nowait()
+        except Queue.Empty:
+            return
+        driver = pool.acquire()
+        try:
+            results[source] = rss_parser(conn, driver, mobile, source, rss_feed_content, writer)
         except Exception as err:
             print err
-            driver.close()
+            count_event('failures_total', source, link=source, stage='feed')
+            pool.replace(driver)
             continue
-        driver.close()
+        pool.release(driver)
+
+def insert_links(mobile, feeds=None):
+    """
+        Fetch and insert for all rss feeds.
+
+        This fetch rss data, then fetch html content of each link and insert parsed
+        content into the db for all rss feeds. Feeds are crawled in parallel by
+        DRIVER_POOL_SIZE threads sharing a pool of long-lived managed web drivers
+        (see ManagedDriver). Items are written by batches in the background (see
+        ItemWriter), all of them are written when the method returns. The metrics
+        are written into the feeder metrics file (see start_metrics_file).
+
+        :param mobile: The mobile flag
+        :param feeds: The raw content of the already polled rss feeds (all the rss
+            sources are fetched if None)
+        :type mobile: bool
+        :type feeds: dict
+        :return: The fetched pages and failed entries of each crawled rss feed (see
+            rss_parser)
+        :rtype: dict
+    """
+    start_metrics_file('feeder')
+    if feeds is None:
+        feeds = dict((source, b'') for source in get_rss_sources())
+    conn = db_connect()
+    sources = Queue.Queue()
+    for source, rss_feed_content in feeds.items():
+        sources.put((source, rss_feed_content))
+    pool = DriverPool(lambda: ManagedDriver(lambda: webdriver_init(mobile=mobile)), \
+        DRIVER_POOL_SIZE)
+    writer = ItemWriter(conn)
+    results = dict()
+    start_time = time.time()
+    threads = [threading.Thread(target=crawl_sources, \
+        args=(conn, pool, mobile, sources, results, writer)) for _ in range(DRIVER_POOL_SIZE)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    driver_stats = pool.stats()
+    pool.close()
+    writer.close()
     db_close(conn)
+    elapsed_minutes = (time.time() - start_time) / 60
+    pages = sum(x.get('pages') for x in results.values())
+    print '-- {} pages from {} feeds in {:.1f} min ({:.1f} pages/min) --'.format( \
+        pages, len(results), elapsed_minutes, pages / max(elapsed_minutes, 1e-6))
+    print '-- Fetches per strategy: {} --'.format(FETCH_STATS)
+    print '-- Requests per host: {} --'.format(SCHEDULER.stats())
+    print '-- Writes: {} --'.format(writer.stats)
+    print '-- Pages per fetch profile: {} --'.format(get_profile_stats())
+    print '-- Web drivers: {} pages, {} recycles, {} restarts --'.format( \
+        sum(x.get('total_pages') for x in driver_stats), \
+        sum(x.get('recycles') for x in driver_stats), sum(x.get('restarts') for x in driver_stats))
+    return results
 
 def insert_all_links():
     """
@@ -262,12 +501,31 @@ def insert_all_links():
 
         This fetch rss data, then fetch html content of each link and insert parsed
         content into the db for all rss feeds for mobile and desktop experiences.
+        Feeds are polled once for both experiences (see poll_feeds), the unchanged
+        ones are skipped. Both experiences are crawled at the same time, each one
+        with its own pool of web drivers. The validators of a feed are only stored
+        once both experiences crawled it without any failed entry, so a feed with
+        failed entries is fetched again (not answered as unchanged) the next time.
 
         :return: Nothing
         :rtype: None
     """
-    print '-- Desktop version --'
-    insert_links(mobile=False)
-    time.sleep(1)
-    print '-- Mobile version --'
-    insert_links(mobile=True)
+    start_metrics_file('feeder')
+    reap_orphan_drivers()
+    rebuild_links_filter(force=False)
+    conn = db_connect()
+    polled_feeds, unchanged = poll_feeds(conn, get_rss_sources())
+    print '-- {} feeds changed, {} unchanged feeds skipped --'.format(len(polled_feeds), unchanged)
+    feeds = dict((source, content) for source, (content, _) in polled_feeds.items())
+    results = dict()
+    threads = [threading.Thread(target=lambda mobile: results.update( \
+        {mobile: insert_links(mobile, feeds)}), args=(mobile,)) for mobile in [False, True]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for source, (_, validators) in polled_feeds.items():
+        feed_results = [results.get(mobile, dict()).get(source) for mobile in [False, True]]
+        if all(x and not x.get('failures') for x in feed_results):
+            commit_feed(conn, source, validators)
+    db_close(conn)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+"""The fetch strategy methods
+"""
+
+from __future__ import unicode_literals
+
+import re
+import time
+import socket
+import httplib
+import urllib2
+import threading
+
+from lib.config import load_config
+
+from lib.scheduler import HostScheduler
+
+from lib.metrics import METRICS
+
+CONFIG = load_config().get('feeder')
+
+MOBILE_USER_AGENT = CONFIG.get('MOBILE_USER_AGENT')
+DESKTOP_USER_AGENT = CONFIG.get('DESKTOP_USER_AGENT')
+HTTP_TIMEOUT = CONFIG.get('HTTP_TIMEOUT', 30)
+BROWSER_DOMAINS = CONFIG.get('BROWSER_DOMAINS', list()) # always fetched with the web driver
+HTTP_ONLY_DOMAINS = CONFIG.get('HTTP_ONLY_DOMAINS', list()) # never fetched with the web driver
+HOST_RATE = CONFIG.get('HOST_RATE', 1.0) # requests per second
+HOST_BURST = CONFIG.get('HOST_BURST', 2)
+DOMAIN_RATES = CONFIG.get('DOMAIN_RATES', dict())
+MIN_TEXT_LENGTH = 200
+SPA_MARKERS = ['<div id="root"></div>', '<div id="app"></div>', '<div id="__next"></div>', \
+    'ng-app', 'ng-version', 'data-server-rendered="false"']
+CHARSET_REGEX = re.compile('charset=["\']?([\\w-]+)', re.IGNORECASE)
+SCRIPT_REGEX = re.compile('<(script|style|noscript)[^>]*>.*?</\\1>', re.IGNORECASE | re.DOTALL)
+TAG_REGEX = re.compile('<[^>]+>')
+FETCH_STATS = {'http': 0, 'browser': 0, 'browser_fallback': 0, 'http_error': 0}
+FETCH_STATS_LOCK = threading.Lock()
+PROFILE_STATS = dict() # pages, transferred bytes and load time per fetch profile
+PHANTOM_SCRIPT_COMMAND = 'executePhantomScript'
+READ_TRANSFERRED_BYTES_SCRIPT = """
+    var transferredBytes = this.transferredBytes || 0;
+    this.transferredBytes = 0;
+    return transferredBytes;
+"""
+SCHEDULER = HostScheduler(HOST_RATE, HOST_BURST, DOMAIN_RATES)
+
+def count_fetch(strategy):
+    """
+        Count a fetch for a strategy.
+
+        :param strategy: The strategy name
+        :type strategy: str
+        :return: Nothing
+        :rtype: None
+    """
+    with FETCH_STATS_LOCK:
+        FETCH_STATS[strategy] = FETCH_STATS.get(strategy, 0) + 1
+
+def count_profile_page(profile, transferred_bytes, load_time):
+    """
+        Count a page loaded with a fetch profile.
+
+        :param profile: The fetch profile name
+        :param transferred_bytes: The bytes transferred to load the page
+        :param load_time: The load time of the page (in seconds)
+        :type profile: str
+        :type transferred_bytes: int
+        :type load_time: float
+        :return: Nothing
+        :rtype: None
+    """
+    with FETCH_STATS_LOCK:
+        stats = PROFILE_STATS.setdefault(profile, {'pages': 0, 'bytes': 0, 'load_time': 0.0})
+        stats['pages'] += 1
+        stats['bytes'] += transferred_bytes
+        stats['load_time'] += load_time
+
+def get_profile_stats():
+    """
+        Get the statistics of each fetch profile.
+
+        :return: The pages, the mean bytes and load time per page of each profile
+        :rtype: dict
+    """
+    with FETCH_STATS_LOCK:
+        return dict((profile, {
+            'pages': x['pages'],
+            'bytes_per_page': x['bytes'] / max(x['pages'], 1),
+            'load_time_per_page': x['load_time'] / max(x['pages'], 1)
+        }) for profile, x in PROFILE_STATS.items())
+
+def collect_fetch_metrics():
+    """
+        Collect the fetch statistics as metrics (see MetricsRegistry.add_collector).
+
+        :return: The fetches per strategy, the pages, bytes and load time per fetch
+            profile, the requests delayed by the scheduler
+        :rtype: list
+    """
+    with FETCH_STATS_LOCK:
+        samples = [('fetches_total', 'counter', {'strategy': strategy}, count) \
+            for strategy, count in FETCH_STATS.items()]
+        for profile, stats in PROFILE_STATS.items():
+            samples += [
+                ('profile_pages_total', 'counter', {'profile': profile}, stats['pages']),
+                ('profile_bytes_total', 'counter', {'profile': profile}, stats['bytes']),
+                ('profile_load_seconds_total', 'counter', {'profile': profile}, stats['load_time'])
+            ]
+    scheduler_stats = SCHEDULER.stats()
+    return samples + [
+        ('host_waits_total', 'counter', None, scheduler_stats['waits']),
+        ('host_wait_seconds_total', 'counter', None, scheduler_stats['wait_time']),
+        ('hosts_waiting', 'gauge', None, scheduler_stats['waiting']),
+        ('hosts', 'gauge', None, scheduler_stats['hosts'])
+    ]
+
+METRICS.add_collector('fetch', collect_fetch_metrics)
+
+def execute_phantom_script(driver, script, *args):
+    """
+        Execute a script in the PhantomJS context of a web driver.
+
+        The script runs with the PhantomJS page object as this (not inside the
+        page), so it can set the page callbacks.
+
+        :param driver: A PhantomJS web driver
+        :param script: The script to execute
+        :param args: The script arguments
+        :type driver: WebDriver
+        :type script: str
+        :type args: list
+        :return: The script result
+        :rtype: object
+    """
+    driver.command_executor._commands[PHANTOM_SCRIPT_COMMAND] = \
+        ('POST', '/session/$sessionId/phantom/execute')
+    return driver.execute(PHANTOM_SCRIPT_COMMAND, {'script': script, 'args': list(args)})['value']
+
+def get_domain(url):
+    """
+        Get the domain of an url.
+
+        :param url: An url
+        :type url: str
+        :return: The domain
+        :rtype: str
+    """
+    return url.split('/')[2].lower()
+
+def domain_matches(domain, domains):
+    """
+        Check if a domain is (or is a subdomain of) one of some domains.
+
+        :param domain: A domain
+        :param domains: Some domains
+        :type domain: str
+        :type domains: list
+        :return: Match or not
+        :rtype: bool
+    """
+    return any(domain == a or domain.endswith('.' + a) for a in domains)
+
+def http_get(url, mobile, headers=None):
+    """
+        Fetch an url with a plain HTTP GET.
+
+        The request uses the mobile/desktop user agent regarding the mobile flag,
+        and waits for its turn if the host got too many requests (see SCHEDULER).
+
+        :param url: Link to fetch
+        :param mobile: The mobile flag
+        :param headers: Additional request headers
+        :type url: str
+        :type mobile: bool
+        :type headers: dict
+        :return: The body, the final url (after redirections), the response headers
+        :rtype: tuple
+    """
+    request_headers = dict(headers or dict())
+    request_headers['User-Agent'] = MOBILE_USER_AGENT if mobile else DESKTOP_USER_AGENT
+    request = urllib2.Request(url, headers=request_headers)
+    SCHEDULER.wait(get_domain(url))
+    response = urllib2.urlopen(request, timeout=HTTP_TIMEOUT)
+    try:
+        body = response.read()
+    finally:
+        response.close()
+    return body, response.geturl(), response.info()
+
+def decode_body(body, content_type):
+    """
+        Decode the body of an HTTP response.
+
+        The charset is taken from the content type, or from the meta tags of the
+        body, utf-8 otherwise.
+
+        :param body: Raw body
+        :param content_type: Content type of the response
+        :type body: str
+        :type content_type: str
+        :return: The decoded body
+        :rtype: unicode
+    """
+    match = CHARSET_REGEX.search(content_type) or CHARSET_REGEX.search(body[:2048])
+    charset = match.group(1) if match else 'utf-8'
+    try:
+        return body.decode(charset, 'replace')
+    except LookupError: # unknown charset
+        return body.decode('utf-8', 'replace')
+
+def needs_browser(content):
+    """
+        Guess if a page needs javascript to be rendered.
+
+        A page needs javascript when it has (almost) no visible text (empty body,
+        noscript shell), or when it looks like a single page application.
+
+        :param content: The page content
+        :type content: unicode
+        :return: Needs javascript or not
+        :rtype: bool
+    """
+    if any(marker in content for marker in SPA_MARKERS):
+        return True
+    text = TAG_REGEX.sub('', SCRIPT_REGEX.sub('', content))
+    return len(' '.join(text.split())) < MIN_TEXT_LENGTH
+
+def browser_get(driver, url):
+    """
+        Fetch an url with a web driver.
+
+        The request waits for its turn if the host got too many requests (see
+        SCHEDULER). The transferred bytes and load time of the page are counted
+        for the fetch profile of the web driver, if it has one.
+
+        :param driver: A web driver
+        :param url: Link to fetch
+        :type driver: WebDriver
+        :type url: str
+        :return: The page content, the final url
+        :rtype: tuple
+    """
+    count_fetch('browser')
+    SCHEDULER.wait(get_domain(url))
+    profile = getattr(driver, 'fetch_profile', None)
+    start_time = time.time()
+    driver.get(url)
+    if profile:
+        load_time = time.time() - start_time
+        count_profile_page(profile, execute_phantom_script(driver, \
+            READ_TRANSFERRED_BYTES_SCRIPT) or 0, load_time)
+    return driver.page_source, driver.current_url
+
+def fetch_page(driver, url, mobile):
+    """
+        Fetch a web page with the lightest strategy.
+
+        This fetch the page with a plain HTTP GET first, and only loads it with the
+        web driver when it looks like it needs javascript (or the HTTP GET failed).
+        Domains of BROWSER_DOMAINS are always loaded with the web driver, domains of
+        HTTP_ONLY_DOMAINS never are.
+
+        :param driver: A web driver
+        :param url: Link to fetch
+        :param mobile: The mobile flag
+        :type driver: WebDriver
+        :type url: str
+        :type mobile: bool
+        :return: The page content, the final url
+        :rtype: tuple
+    """
+    domain = get_domain(url)
+    if domain_matches(domain, BROWSER_DOMAINS):
+        return browser_get(driver, url)
+    http_only = domain_matches(domain, HTTP_ONLY_DOMAINS)
+    try:
+        body, final_url, response_headers = http_get(url, mobile)
+    except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError) as err:
+        count_fetch('http_error')
+        if http_only:
+            raise
+        print 'HTTP fetch failed for {} ({}), fallback to the web driver'.format(url, err)
+        return browser_get(driver, url)
+    content = decode_body(body, response_headers.get('Content-Type', ''))
+    if not http_only and needs_browser(content):
+        count_fetch('browser_fallback')
+        return browser_get(driver, url)
+    count_fetch('http')
+    return content, final_url
+
+def fetch_feed(driver, url, mobile):
+    """
+        Fetch a rss feed with the lightest strategy.
+
+        This fetch the feed with a plain HTTP GET, and only loads it with the web
+        driver when the HTTP GET failed or returned nothing.
+
+        :param driver: A web driver
+        :param url: Link to fetch
+        :param mobile: The mobile flag
+        :type driver: WebDriver
+        :type url: str
+        :type mobile: bool
+        :return: The raw rss feed content
+        :rtype: str
+    """
+    if not domain_matches(get_domain(url), BROWSER_DOMAINS):
+        try:
+            body = http_get(url, mobile)[0]
+            if body.strip():
+                count_fetch('http')
+                return body
+            count_fetch('browser_fallback')
+        except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError) as err:
+            count_fetch('http_error')
+            print 'HTTP fetch failed for {} ({}), fallback to the web driver'.format(url, err)
+    return browser_get(driver, url)[0].encode('utf-8')
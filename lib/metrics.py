@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+
+"""The ingestion metrics methods and class
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import atexit
+import urlparse
+import bisect
+import threading
+import contextlib
+
+from lib.config import load_config
+
+CONFIG = load_config().get('metrics', dict())
+
+LIB_DIR_ABSPATH = os.path.dirname(os.path.abspath(__file__))
+METRICS_DIRPATH = CONFIG.get('DIRPATH', os.path.join(LIB_DIR_ABSPATH, '../metrics'))
+METRICS_INTERVAL = CONFIG.get('INTERVAL', 15) # seconds between two writes of the file
+METRICS_BUCKETS = CONFIG.get('BUCKETS', \
+    [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]) # seconds
+METRICS_DOMAINS_MAX = CONFIG.get('DOMAINS_MAX', 50) # domains labelled, the others are other
+METRICS_OTHER_DOMAIN = 'other'
+METRICS_PREFIX = 'randomery_'
+METRICS_HELP = {
+    'stage_seconds': 'Duration of each ingestion stage',
+    'pages_total': 'Pages fetched and queued for insertion',
+    'skips_total': 'Feeds and entries skipped, by reason',
+    'failures_total': 'Failures, by stage',
+    'retries_total': 'Jobs released to be retried',
+    'dead_letters_total': 'Jobs dead-lettered after their last attempt',
+    'writes_total': 'Items written by the write-behind writers',
+    'write_batches_total': 'Batches written by the write-behind writers',
+    'write_errors_total': 'Batches which failed (the items not inserted are written one by one)',
+    'write_failures_total': 'Items which could not be written (fetched again later)',
+    'write_blocked_total': 'Items queued while the writer queue was full',
+    'driver_recycles_total': 'Web drivers recycled (too many pages or too much memory)',
+    'driver_restarts_total': 'Web drivers restarted (crashed or not answering)',
+    'fetches_total': 'Fetches, by strategy',
+    'profile_pages_total': 'Pages loaded by the web drivers, by fetch profile',
+    'profile_bytes_total': 'Bytes transferred by the web drivers, by fetch profile',
+    'profile_load_seconds_total': 'Load time of the web drivers pages, by fetch profile',
+    'host_waits_total': 'Requests delayed by the host scheduler',
+    'host_wait_seconds_total': 'Total delay of the requests by the host scheduler',
+    'hosts_waiting': 'Requests waiting for their host now',
+    'hosts': 'Hosts known by the host scheduler'
+}
+
+def escape_label(value):
+    """
+        Escape a label value of the Prometheus text format.
+
+        :param value: A label value
+        :type value: str
+        :return: The escaped value
+        :rtype: unicode
+    """
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    """
+        Format the labels of a sample.
+
+        :param labels: The labels as (name, value) tuples
+        :type labels: tuple
+        :return: The formated labels (empty if there is no label)
+        :rtype: unicode
+    """
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, escape_label(value)) \
+        for name, value in labels))
+
+def format_value(value):
+    """
+        Format the value of a sample.
+
+        :param value: A value
+        :type value: float
+        :return: The formated value
+        :rtype: unicode
+    """
+    return repr(float(value)) if isinstance(value, float) else '{}'.format(value)
+
+class MetricsRegistry(object):
+    """
+        Define a registry of counters and histograms, rendered with the Prometheus
+        text format.
+
+        Collectors add the values of statistics kept elsewhere (fetch strategies,
+        scheduler...) when the metrics are rendered.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        """
+            Initialize a metrics registry object.
+
+            :param buckets: The upper bounds of the histogram buckets
+            :type buckets: list
+        """
+        self.buckets = sorted(buckets)
+        self.counters = dict()
+        self.histograms = dict()
+        self.collectors = dict()
+        self.lock = threading.Lock()
+
+    def count(self, name, labels=None, value=1):
+        """
+            Increment a counter.
+
+            :param name: The counter name
+            :param labels: The labels of the counter
+            :param value: The increment
+            :type name: str
+            :type labels: dict
+            :type value: int
+            :return: Nothing
+            :rtype: None
+        """
+        key = (name, tuple(sorted((labels or dict()).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        """
+            Add a value to a histogram.
+
+            :param name: The histogram name
+            :param value: The value (a duration in seconds)
+            :param labels: The labels of the histogram
+            :type name: str
+            :type value: float
+            :type labels: dict
+            :return: Nothing
+            :rtype: None
+        """
+        key = (name, tuple(sorted((labels or dict()).items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        """
+            Time a block of code into a histogram.
+
+            The duration is added even if the block raised.
+
+            :param name: The histogram name
+            :param labels: The labels of the histogram
+            :type name: str
+            :type labels: dict
+            :return: A context manager
+            :rtype: GeneratorContextManager
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start_time, labels)
+
+    def add_collector(self, name, method):
+        """
+            Add (or replace) a collector.
+
+            :param name: The collector name
+            :param method: A method without parameters returning samples as
+                (name, type, labels, value) tuples
+            :type name: str
+            :type method: function
+            :return: Nothing
+            :rtype: None
+        """
+        self.collectors[name] = method
+
+    def collect(self):
+        """
+            Get the samples of every metric.
+
+            :return: The samples of each metric by name, as (suffix, labels, value)
+                tuples (buckets in order), and the type of each metric
+            :rtype: tuple
+        """
+        samples = dict()
+        types = dict()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                types[name] = 'counter'
+                samples.setdefault(name, list()).append(('', labels, value))
+            for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                types[name] = 'histogram'
+                series = samples.setdefault(name, list())
+                cumulated = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulated += bucket_count
+                    series.append(('_bucket', labels + (('le', format_value(bound)),), cumulated))
+                series += [('_bucket', labels + (('le', '+Inf'),), count), \
+                    ('_sum', labels, total), ('_count', labels, count)]
+        for collector in self.collectors.values():
+            try:
+                collected = collector()
+            except Exception as err:
+                print err
+                continue
+            for name, kind, labels, value in collected:
+                types[name] = kind
+                samples.setdefault(name, list()).append(('', \
+                    tuple(sorted((labels or dict()).items())), value))
+        return samples, types
+
+    def render(self, labels=None):
+        """
+            Render every metric with the Prometheus text format.
+
+            :param labels: Labels added to every sample (the process name...)
+            :type labels: dict
+            :return: The metrics
+            :rtype: unicode
+        """
+        common_labels = tuple(sorted((labels or dict()).items()))
+        samples, types = self.collect()
+        lines = list()
+        for name in sorted(samples):
+            full_name = METRICS_PREFIX + name
+            if name in METRICS_HELP:
+                lines.append('# HELP {} {}'.format(full_name, METRICS_HELP[name]))
+            lines.append('# TYPE {} {}'.format(full_name, types[name]))
+            for suffix, sample_labels, value in samples[name]:
+                lines.append('{}{}{} {}'.format(full_name, suffix, \
+                    format_labels(common_labels + sample_labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+METRICS = MetricsRegistry()
+
+METRICS_DOMAINS = {'domains': set(), 'lock': threading.Lock()}
+
+def label_domain(url):
+    """
+        Get the domain label of an url.
+
+        The first METRICS_DOMAINS_MAX domains get their own label, the next ones
+        are labelled as METRICS_OTHER_DOMAIN, so the number of series stays bounded
+        whatever the number of crawled domains.
+
+        :param url: An url
+        :type url: str
+        :return: The domain label (empty if the url has no domain)
+        :rtype: str
+    """
+    domain = urlparse.urlsplit(url or '').netloc.lower()
+    if not domain:
+        return ''
+    with METRICS_DOMAINS['lock']:
+        if domain in METRICS_DOMAINS['domains']:
+            return domain
+        if len(METRICS_DOMAINS['domains']) < METRICS_DOMAINS_MAX:
+            METRICS_DOMAINS['domains'].add(domain)
+            return domain
+    return METRICS_OTHER_DOMAIN
+
+def time_stage(stage, source=''):
+    """
+        Time an ingestion stage (see MetricsRegistry.timer).
+
+        The histograms are only labelled by stage and source, the number of
+        series does not grow with the crawled domains.
+
+        :param stage: The stage name (feed_fetch, page_fetch, decode, exists_check,
+            insert or insert_batch)
+        :param source: The source (the rss feed url, or jobs)
+        :type stage: str
+        :type source: str
+        :return: A context manager
+        :rtype: GeneratorContextManager
+    """
+    return METRICS.timer('stage_seconds', {'stage': stage, 'source': source})
+
+def count_event(name, source='', value=1, link=None, **labels):
+    """
+        Count an ingestion event for a source.
+
+        The skips, failures and retries are counted per domain too (see
+        label_domain), the high-volume counters are not.
+
+        :param name: The counter name (skips_total, failures_total...)
+        :param source: The source (the rss feed url, or jobs)
+        :param value: The increment
+        :param link: The url the event is about, labelled by its domain
+        :param labels: Additional labels (the reason of a skip, the stage of a
+            failure...)
+        :type name: str
+        :type source: str
+        :type value: int
+        :type link: str
+        :type labels: dict
+        :return: Nothing
+        :rtype: None
+    """
+    if not value:
+        return
+    labels['source'] = source
+    if link is not None:
+        labels['domain'] = label_domain(link)
+    METRICS.count(name, labels, value)
+
+METRICS_FILE = {'filepath': None, 'labels': None, 'thread': None, 'lock': threading.Lock(), \
+    'stopped': threading.Event()}
+
+def write_metrics_file():
+    """
+        Write the metrics into the metrics file of the process.
+
+        The file is replaced at once (written aside then renamed), so a reader
+        never gets a partial file.
+
+        :return: Nothing
+        :rtype: None
+    """
+    filepath = METRICS_FILE['filepath']
+    if not filepath:
+        return
+    with METRICS_FILE['lock']:
+        try:
+            with open(filepath + '.tmp', 'w') as metrics_file:
+                metrics_file.write(METRICS.render(METRICS_FILE['labels']).encode('utf-8'))
+            os.rename(filepath + '.tmp', filepath)
+        except (IOError, OSError) as err:
+            print err
+
+def run_metrics_file(interval):
+    """
+        Write the metrics file every interval seconds until it's stopped.
+
+        :param interval: The time between two writes (in seconds)
+        :type interval: float
+        :return: Nothing
+        :rtype: None
+    """
+    while not METRICS_FILE['stopped'].wait(interval):
+        write_metrics_file()
+
+def stop_metrics_file():
+    """
+        Stop the periodic writes then write the metrics file a last time.
+
+        :return: Nothing
+        :rtype: None
+    """
+    METRICS_FILE['stopped'].set()
+    if METRICS_FILE['thread']:
+        METRICS_FILE['thread'].join()
+    write_metrics_file()
+
+def start_metrics_file(process, interval=METRICS_INTERVAL):
+    """
+        Write the metrics of the process into a file periodically.
+
+        The file is METRICS_DIRPATH/<process>.prom (the format of the textfile
+        collector of the Prometheus node exporter), it's written every interval
+        seconds and once more when the process exits. Every sample has a process
+        label, so the files of several processes can be collected together.
+
+        :param process: The process name (feeder, or the worker identifier)
+        :param interval: The time between two writes (in seconds)
+        :type process: str
+        :type interval: float
+        :return: The metrics file path
+        :rtype: str
+    """
+    if not os.path.isdir(METRICS_DIRPATH):
+        os.makedirs(METRICS_DIRPATH)
+    filename = '{}.prom'.format(''.join(a if a.isalnum() or a in '-_' else '_' for a in process))
+    METRICS_FILE['filepath'] = os.path.join(METRICS_DIRPATH, filename)
+    METRICS_FILE['labels'] = {'process': process}
+    if not METRICS_FILE['thread']:
+        METRICS_FILE['thread'] = threading.Thread(target=run_metrics_file, args=(interval,))
+        METRICS_FILE['thread'].daemon = True
+        METRICS_FILE['thread'].start()
+        atexit.register(stop_metrics_file)
+    return METRICS_FILE['filepath']
@@ -5,11 +5,62 @@
 
 from __future__ import unicode_literals
 
+import os
+import re
+import codecs
+
 import cssutils
 
 from unidecode import unidecode
 from bs4 import BeautifulSoup as bs
 
+# Bump it whenever the rendered content changes (invalidates rendered pages)
+PARSER_VERSION = 2
+DISCOVERY_KWARGS_CACHE = dict()
+EMBED_MAIN_URLS = ['https://www.youtube.com', \
+    'https://www.dailymotion.com', 'http://www.dailymotion.com']
+REWRITE_RULES = [
+    (['a', 'link'], 'href'), # Hrefs + CSS
+    (['script', 'img'], 'src'), # JS scripts + imgs
+    (['img'], 'srcset'), # alternate imgs
+    (['img'], 'data-icon'), # alternate imgs
+    (['div'], 'data-version') # alternate data
+]
+SRCSET_URL_REGEX = re.compile('[\\s,]*(\\S+)')
+NON_ASCII_REGEX = re.compile('[^\\x00-\\x7f]+')
+
+class TransliterationTable(dict):
+    """
+        Define a memoized table of the transliteration of each character.
+
+        A character is transliterated with unidecode the first time it's seen,
+        then it's a simple lookup.
+    """
+    def __missing__(self, char):
+        """
+            Transliterate a character seen for the first time.
+
+            :param char: A character
+            :type char: unicode
+            :return: The transliterated character
+            :rtype: str
+        """
+        transliteration = self[char] = unidecode(char)
+        return transliteration
+
+TRANSLITERATIONS = TransliterationTable()
+
+def transliterate_run(match):
+    """
+        Transliterate a run of non-ASCII characters.
+
+        :param match: The match of a run of non-ASCII characters
+        :type match: MatchObject
+        :return: The transliterated run
+        :rtype: str
+    """
+    return ''.join(map(TRANSLITERATIONS.__getitem__, match.group(0)))
+
 def magic_decoding(ustring):
     """
         Magic decode content.
@@ -17,12 +68,50 @@ def magic_decoding(ustring):
         This decode any unicode string and transform it into a ncide string. This
         has for effect to avoid failing situation when manipulating string after.
 
+        Pure ASCII strings are returned as is (encoded by the ASCII codec), only
+        the runs of non-ASCII characters are transliterated (see TRANSLITERATIONS),
+        the result is the same as unidecode. Like unidecode, each byte of an
+        encoded string is read as a character.
+
         :param ustring: An unicode string to decode
         :type ustring: unicode
         :return: The decoded string
         :rtype: str
     """
-    return unidecode(ustring)
+    if isinstance(ustring, bytes):
+        try:
+            ustring.decode('ascii')
+            return ustring
+        except UnicodeDecodeError:
+            ustring = ustring.decode('latin-1')
+    try:
+        return ustring.encode('ascii')
+    except UnicodeEncodeError:
+        return NON_ASCII_REGEX.sub(transliterate_run, ustring).encode('ascii')
+
+def iter_magic_decoding(chunks, encoding='utf-8'):
+    """
+        Magic decode content chunk by chunk.
+
+        This decode raw chunks with an incremental decoder (a character can be
+        split between two chunks) then magic decode each of them, so the whole
+        content is never loaded in memory.
+
+        :param chunks: Some chunks of raw content
+        :param encoding: The encoding of the content
+        :type chunks: iterable
+        :type encoding: str
+        :return: A generator of decoded chunks
+        :rtype: generator
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    for chunk in chunks:
+        decoded = magic_decoding(decoder.decode(chunk))
+        if decoded:
+            yield decoded
+    decoded = magic_decoding(decoder.decode(b'', final=True))
+    if decoded:
+        yield decoded
 
 def magic_parser(data, url):
     """
@@ -38,18 +127,31 @@ def magic_parser(data, url):
         :return: The formated DOM
         :rtype: BeautifulSoup
     """
+    embed_content = get_embed_content(url)
+    if embed_content:
+        return embed_content
     soup = bs(data, 'html5lib')
     main_url = get_main_url(url)
+    for tags, keyword in REWRITE_RULES:
+        logic(soup, tags, keyword, main_url)
+    return soup
+
+def get_embed_content(url):
+    """
+        Get the embed content of a video provider.
+
+        Pages of some video providers are not rendered, they are embedded into
+        an iframe instead.
+
+        :param url: Main url of the website
+        :type url: str
+        :return: The iframe (None if not a video provider)
+        :rtype: str
+    """
     # TODO: Should be removed at some point, or find a better way
-    if main_url in ['https://www.youtube.com', \
-        'https://www.dailymotion.com', 'http://www.dailymotion.com']:
+    if get_main_url(url) in EMBED_MAIN_URLS:
         return '<iframe style="border:none;width:100%;height:100%;" src="{}"></iframe>'.format(url)
-    logic(soup, ['a', 'link'], 'href', main_url) # Hrefs + CSS
-    logic(soup, ['script', 'img'], 'src', main_url) # JS scripts + imgs
-    logic(soup, ['img'], 'srcset', main_url) # alternate imgs
-    logic(soup, ['img'], 'data-icon', main_url) # alternate imgs
-    logic(soup, ['div'], 'data-version', main_url) # alternate data
-    return soup
+    return None
 
 def format_src(src, url):
     """
@@ -108,7 +210,67 @@ def logic(soup, tags, keyword, url):
         src = ref.get(keyword)
         if not src:
             continue
-        ref[keyword] = format_src(src, url)
+        ref[keyword] = format_attribute(keyword, src, url)
+
+def format_attribute(keyword, value, url):
+    """
+        Reformat an attribute value from the DOM.
+
+        This reformat the url of an attribute value, or each url of a srcset
+        attribute value.
+
+        :param keyword: The attribute name
+        :param value: The attribute value
+        :param url: A main url of a website
+        :type keyword: str
+        :type value: str
+        :type url: str
+        :return: The formated value
+        :rtype: str
+    """
+    if keyword == 'srcset':
+        return format_srcset(value, url)
+    return format_src(value, url)
+
+def format_srcset(srcset, url):
+    """
+        Reformat each url of a srcset.
+
+        This reformat each url of a comma-separated srcset attribute (urls with
+        their width or density descriptors), as described by the html spec. An
+        url can contain commas (data urls), descriptors can't.
+
+        :param srcset: A srcset to reformat
+        :param url: A main url of a website
+        :type srcset: str
+        :type url: str
+        :return: The formated srcset
+        :rtype: str
+
+        :Example:
+
+        >>> format_srcset('/a.png 1x, /b.png 2x', 'https://example.com')
+        'https://example.com/a.png 1x, https://example.com/b.png 2x'
+    """
+    entries = list()
+    position = 0
+    while True:
+        match = SRCSET_URL_REGEX.match(srcset, position)
+        if not match:
+            break
+        src = match.group(1)
+        position = match.end()
+        descriptors = ''
+        if src.endswith(','):
+            src = src.rstrip(',')
+        else:
+            end = srcset.find(',', position)
+            if end == -1:
+                end = len(srcset)
+            descriptors = srcset[position:end].strip()
+            position = end + 1
+        entries.append(' '.join([a for a in [format_src(src, url), descriptors] if a]))
+    return ', '.join(entries)
 
 def get_main_url(url):
     """
@@ -180,6 +342,42 @@ def build_discovery_kwargs(css_files):
         'the_big_container': style_dict.get('#the-big-container')
     }
 
+def get_mtimes(files):
+    """
+        Get the modification times of files.
+
+        :param files: A list of files
+        :type files: list
+        :return: The modification times
+        :rtype: list
+    """
+    return [os.path.getmtime(a) for a in files]
+
+def get_discovery_kwargs(css_files, check_mtime=False):
+    """
+        Get kwargs for the discover page.
+
+        This return the kwargs of the discover page from a compiled style table.
+        CSS files are only parsed the first time, then the kwargs are a simple
+        lookup. With check_mtime the CSS files are parsed again whenever one of
+        them has been modified (useful for development).
+
+        :param css_files: A list of CSS files
+        :param check_mtime: Check the modification times or not
+        :type css_files: list
+        :type check_mtime: bool
+        :return: A map of kwargs attribute with these values
+        :rtype: dict
+    """
+    key = tuple(css_files)
+    compiled = DISCOVERY_KWARGS_CACHE.get(key)
+    if compiled and check_mtime and compiled[0] != get_mtimes(css_files):
+        compiled = None
+    if not compiled:
+        compiled = (get_mtimes(css_files), build_discovery_kwargs(css_files))
+        DISCOVERY_KWARGS_CACHE[key] = compiled
+    return compiled[1]
+
 def parse_title(raw_title):
     """
         Format the title associated with a link.
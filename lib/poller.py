@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""The rss feeds poller methods
+"""
+
+from __future__ import unicode_literals
+
+import Queue
+import socket
+import httplib
+import urllib2
+import datetime
+import threading
+
+from lib.config import load_config
+
+from lib.db import find_feed, update_feed
+
+from lib.fetcher import http_get, get_domain, count_fetch
+
+from lib.metrics import time_stage, count_event
+
+CONFIG = load_config().get('feeder')
+
+POLLER_THREADS = CONFIG.get('POLLER_THREADS', 16)
+POLLER_HOST_CONCURRENCY = CONFIG.get('POLLER_HOST_CONCURRENCY', 2)
+NOT_MODIFIED_STATUS = 304
+
+class HostLimiter(object):
+    """
+        Define a limiter of the concurrent requests per host.
+    """
+    def __init__(self, concurrency):
+        """
+            Initialize a host limiter object.
+
+            :param concurrency: The max number of concurrent requests per host
+            :type concurrency: int
+        """
+        self.concurrency = concurrency
+        self.semaphores = dict()
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        """
+            Get the semaphore of a host (created on first use).
+
+            :param host: A host
+            :type host: str
+            :return: The semaphore of the host
+            :rtype: Semaphore
+        """
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.concurrency)
+            return self.semaphores[host]
+
+def get_validators(feed):
+    """
+        Build the conditional request headers of a feed.
+
+        :param feed: A feed document (None if the feed has never been polled)
+        :type feed: dict
+        :return: The conditional request headers
+        :rtype: dict
+    """
+    headers = dict()
+    if feed and feed.get('etag'):
+        headers['If-None-Match'] = feed.get('etag')
+    if feed and feed.get('lastModified'):
+        headers['If-Modified-Since'] = feed.get('lastModified')
+    return headers
+
+def poll_feed(url, headers):
+    """
+        Poll a rss feed with a conditional HTTP GET.
+
+        :param url: The url of the rss feed
+        :param headers: The conditional request headers (see get_validators)
+        :type url: str
+        :type headers: dict
+        :return: The raw feed content (None if not modified, '' if the GET failed),
+            the new validators of the feed
+        :rtype: tuple
+    """
+    try:
+        with time_stage('feed_fetch', url):
+            body, _, response_headers = http_get(url, False, headers)
+    except urllib2.HTTPError as err:
+        if err.code == NOT_MODIFIED_STATUS:
+            count_event('skips_total', url, link=url, reason='unchanged')
+            return None, dict()
+        count_fetch('http_error')
+        count_event('failures_total', url, link=url, stage='feed_fetch')
+        print 'Poll failed for {} ({})'.format(url, err)
+        return b'', dict()
+    except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError) as err:
+        count_fetch('http_error')
+        count_event('failures_total', url, link=url, stage='feed_fetch')
+        print 'Poll failed for {} ({})'.format(url, err)
+        return b'', dict()
+    count_fetch('http')
+    validators = {
+        'etag': response_headers.get('ETag'),
+        'lastModified': response_headers.get('Last-Modified')
+    }
+    return body, validators
+
+def poll_sources(conn, limiter, sources, results):
+    """
+        Poll rss feeds until there is no more feed to poll.
+
+        This is run by each polling thread: it takes the next rss feed, then
+        polls it once the host has a free slot.
+
+        :param conn: A mongo connection
+        :param limiter: The host limiter
+        :param sources: A queue of rss feeds
+        :param results: The polled rss feeds
+        :type conn: MongoClient
+        :type limiter: HostLimiter
+        :type sources: Queue
+        :type results: dict
+        :return: Nothing
+        :rtype: None
+    """
+    while True:
+        try:
+            url = sources.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            headers = get_validators(find_feed(conn, url))
+            with limiter.get(get_domain(url)):
+                results[url] = poll_feed(url, headers)
+        except Exception as err:
+            print err
+            results[url] = (b'', dict())
+
+def poll_feeds(conn, urls):
+    """
+        Poll many rss feeds at the same time.
+
+        The feeds are polled by POLLER_THREADS threads with conditional HTTP GET
+        requests (the ETag and Last-Modified validators of the previous poll), a
+        host never gets more than POLLER_HOST_CONCURRENCY requests at the same time.
+        Unchanged feeds only cost a 304 response and are not returned.
+
+        :param conn: A mongo connection
+        :param urls: The urls of the rss feeds
+        :type conn: MongoClient
+        :type urls: list
+        :return: The raw content ('' when the feed has to be fetched with a web
+            driver) and the validators of each changed feed, the number of
+            unchanged feeds
+        :rtype: tuple
+    """
+    sources = Queue.Queue()
+    for url in urls:
+        sources.put(url)
+    limiter = HostLimiter(POLLER_HOST_CONCURRENCY)
+    results = dict()
+    threads = [threading.Thread(target=poll_sources, args=(conn, limiter, sources, results)) \
+        for _ in range(min(POLLER_THREADS, max(len(urls), 1)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    feeds = dict((url, result) for url, result in results.items() if result[0] is not None)
+    return feeds, len(results) - len(feeds)
+
+def commit_feed(conn, url, validators):
+    """
+        Store the validators of a polled rss feed.
+
+        This must be called once the feed has been crawled, so a feed which
+        failed is fully fetched again the next time. The validators missing from
+        the new response are removed, so stale ones are never sent again.
+
+        :param conn: A mongo connection
+        :param url: The url of the rss feed
+        :param validators: The validators returned by poll_feeds
+        :type conn: MongoClient
+        :type url: str
+        :type validators: dict
+        :return: Nothing
+        :rtype: None
+    """
+    state = dict((key, value) for key, value in validators.items() if value)
+    state['checkedAt'] = datetime.datetime.utcnow()
+    update_feed(conn, url, state, [key for key, value in validators.items() if not value])
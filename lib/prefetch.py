@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""The prefetch methods and class
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import Queue
+import threading
+
+from lib.config import load_config
+
+from lib.render import draw_item
+
+CONFIG = load_config().get('prefetch', dict())
+
+PREFETCH_DEPTH = CONFIG.get('PREFETCH_DEPTH', 8)
+PREFETCH_LOW_WATER = CONFIG.get('PREFETCH_LOW_WATER', 4)
+PREFETCH_MAX_AGE = CONFIG.get('PREFETCH_MAX_AGE', 300)
+PREFETCH_ERROR_DELAY = 1 # doubled after each failed draw
+PREFETCH_MAX_ERROR_DELAY = 60
+
+class Prefetcher(object):
+    """
+        Define a queue of ready-to-serve random items for one experience.
+    """
+    def __init__(self, conn, mobile, depth=PREFETCH_DEPTH, low_water=PREFETCH_LOW_WATER, \
+        max_age=PREFETCH_MAX_AGE):
+        """
+            Initialize a prefetcher object.
+
+            The background thread is only started by the first pop, in the
+            process which serves the requests. A process forked afterwards (or
+            recycled) starts its own thread and queue.
+
+            :param conn: A mongo connection
+            :param mobile: The mobile flag
+            :param depth: Max number of items in the queue (0 to disable)
+            :param low_water: The queue is refilled under this number of items
+            :param max_age: Max age of an item in the queue (in s)
+            :type conn: MongoClient
+            :type mobile: bool
+            :type depth: int
+            :type low_water: int
+            :type max_age: int
+        """
+        self.conn = conn
+        self.mobile = mobile
+        self.depth = depth
+        self.low_water = low_water
+        self.max_age = max_age
+        self.pid = None
+        self.items = None
+        self.refill = None
+
+    def ensure_started(self):
+        """
+            Start the background thread if not started in this process.
+
+            :return: Nothing
+            :rtype: None
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.items = Queue.Queue(maxsize=self.depth)
+        self.refill = threading.Event()
+        self.refill.set()
+        thread = threading.Thread(target=self.run, args=(self.items, self.refill))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, items, refill):
+        """
+            Fill the queue each time it goes under the low water mark.
+
+            Filling stops when there is no item to draw (until the next refill).
+            A failed draw is retried after PREFETCH_ERROR_DELAY seconds, doubled
+            after each consecutive failure (up to PREFETCH_MAX_ERROR_DELAY).
+
+            :param items: The queue of items
+            :param refill: The refill event
+            :type items: Queue
+            :type refill: Event
+            :return: Nothing
+            :rtype: None
+        """
+        error_delay = PREFETCH_ERROR_DELAY
+        while True:
+            refill.wait()
+            refill.clear()
+            while not items.full():
+                try:
+                    item = draw_item(self.conn, self.mobile)
+                except Exception as err:
+                    print err
+                    time.sleep(error_delay)
+                    error_delay = min(error_delay * 2, PREFETCH_MAX_ERROR_DELAY)
+                    continue
+                error_delay = PREFETCH_ERROR_DELAY
+                if not item: # empty collection
+                    break
+                title, link, rendered = item
+                items.put((time.time(), title, link, rendered))
+
+    def pop(self):
+        """
+            Pop a ready-to-serve item.
+
+            Items older than max_age are dropped. The background thread is woken up
+            when the queue goes under the low water mark.
+
+            :return: the title, the link, the rendered content (None if the queue is empty)
+            :rtype: tuple
+        """
+        if self.depth <= 0:
+            return None
+        self.ensure_started()
+        result = None
+        while result is None:
+            try:
+                created_at, title, link, rendered = self.items.get_nowait()
+            except Queue.Empty:
+                break
+            if time.time() - created_at <= self.max_age:
+                result = (title, link, rendered)
+        if self.items.qsize() < self.low_water:
+            self.refill.set()
+        return result
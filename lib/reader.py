@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""The rss feeds reader methods
+"""
+
+from __future__ import unicode_literals
+
+import io
+import re
+import datetime
+
+from email.utils import parsedate_tz, mktime_tz
+
+from xml.etree import ElementTree
+
+ATOM_NAMESPACE = '{http://www.w3.org/2005/Atom}'
+RSS1_NAMESPACE = '{http://purl.org/rss/1.0/}'
+RSS09_NAMESPACE = '{http://my.netscape.com/rdf/simple/0.9/}'
+RDF_NAMESPACE = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+DC_NAMESPACE = '{http://purl.org/dc/elements/1.1/}'
+ENTRY_TAGS = {
+    'item': '', # rss 2.0
+    ATOM_NAMESPACE + 'entry': ATOM_NAMESPACE,
+    RSS1_NAMESPACE + 'item': RSS1_NAMESPACE, # rss 1.0 (rdf)
+    RSS09_NAMESPACE + 'item': RSS09_NAMESPACE
+}
+ISO_DATE_REGEX = re.compile( \
+    '(\\d{4})-(\\d{2})-(\\d{2})[T ](\\d{2}):(\\d{2}):(\\d{2})(?:\\.\\d+)?(Z|[+-]\\d{2}:?\\d{2})?')
+
+def parse_date(text):
+    """
+        Parse the date of a feed entry.
+
+        This parse RFC 822 dates (rss feeds) and ISO 8601 dates (atom and rdf feeds).
+
+        :param text: A date
+        :type text: str
+        :return: The UTC date (None if it can't be parsed)
+        :rtype: datetime
+    """
+    if not text:
+        return None
+    match = ISO_DATE_REGEX.match(text)
+    if match:
+        date = datetime.datetime(*[int(x) for x in match.groups()[:6]])
+        offset = match.group(7)
+        if offset and offset != 'Z':
+            sign = -1 if offset[0] == '-' else 1
+            offset = offset[1:].replace(':', '')
+            date -= sign * datetime.timedelta(hours=int(offset[:2]), minutes=int(offset[2:]))
+        return date
+    parsed_date = parsedate_tz(text)
+    if not parsed_date:
+        return None
+    try:
+        return datetime.datetime.utcfromtimestamp(mktime_tz(parsed_date))
+    except (ValueError, OverflowError):
+        return None
+
+def get_text(element, tag):
+    """
+        Get the text of a child of an element.
+
+        :param element: An element
+        :param tag: The tag of the child (with its namespace)
+        :type element: Element
+        :type tag: str
+        :return: The text of the child (None if missing or empty)
+        :rtype: unicode
+    """
+    child = element.find(tag)
+    if child is None:
+        return None
+    return ''.join(child.itertext()).strip() or None
+
+def get_atom_link(element):
+    """
+        Get the link of an atom entry.
+
+        :param element: An atom entry
+        :type element: Element
+        :return: The link (the alternate one if there are several)
+        :rtype: unicode
+    """
+    links = element.findall(ATOM_NAMESPACE + 'link')
+    for link in links:
+        if link.get('rel', 'alternate') == 'alternate' and link.get('href'):
+            return link.get('href')
+    return links[0].get('href') if links else None
+
+def build_entry(element, namespace):
+    """
+        Build a feed entry from an item (or entry) element.
+
+        :param element: An item element
+        :param namespace: The namespace of the feed (empty for rss 2.0)
+        :type element: Element
+        :type namespace: str
+        :return: The guid, title, link and UTC publication date of the entry
+        :rtype: dict
+    """
+    if namespace == ATOM_NAMESPACE:
+        link = get_atom_link(element)
+        guid = get_text(element, namespace + 'id')
+        date = get_text(element, namespace + 'published') or \
+            get_text(element, namespace + 'updated')
+    else:
+        link = get_text(element, namespace + 'link')
+        guid = get_text(element, 'guid') if not namespace else element.get(RDF_NAMESPACE + 'about')
+        date = get_text(element, 'pubDate') if not namespace else None
+        date = date or get_text(element, DC_NAMESPACE + 'date')
+    return {
+        'guid': guid or link,
+        'title': get_text(element, namespace + 'title') or '',
+        'link': link,
+        'date': parse_date(date)
+    }
+
+def iter_entries(content):
+    """
+        Read the entries of a feed one by one.
+
+        This parse a rss 2.0, atom or rss 1.0 (rdf) feed incrementally: each entry
+        is yielded as soon as it's parsed, then dropped from the tree, so the whole
+        tree is never built. Stopping the iteration (once the known entries are
+        reached) stops the parsing.
+
+        :param content: The raw feed content (or a file object)
+        :type content: str
+        :return: A generator of entries (see build_entry)
+        :rtype: generator
+    """
+    source = io.BytesIO(content) if isinstance(content, bytes) else content
+    parents = list() # the open elements
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag not in ENTRY_TAGS:
+            continue
+        yield build_entry(element, ENTRY_TAGS[element.tag])
+        if parents: # the channel keeps no entry
+            parents[-1].remove(element)
+        element.clear()
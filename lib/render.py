@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+"""The render methods
+"""
+
+from __future__ import unicode_literals
+
+from lib.config import load_config
+
+from lib.cache import cache_key, cache_get, cache_set
+
+from lib.db import db_connect, db_close, find_items, insert_rendered_item, get_rendered_item, \
+    get_random_item, read_item_content, iter_item_content
+
+from lib.parser import PARSER_VERSION, magic_decoding, iter_magic_decoding, magic_parser, \
+    get_embed_content
+
+from lib.rewriter import StreamRewriter, rewrite_content, extract_rewritten_attributes
+
+PARSER_BACKEND = load_config().get('PARSER_BACKEND', 'html5lib')
+RENDER_VERSION = '{}-{}'.format(PARSER_VERSION, PARSER_BACKEND)
+
+def render_content(content, link, backend=PARSER_BACKEND):
+    """
+        Render raw content.
+
+        This decode and parse raw content of an item, the result is the html
+        ready to be inlined into the discover page. The content is parsed by the
+        html5lib backend (see magic_parser), or by the tokenizer backend (see
+        rewrite_content) which is faster but does not fix broken html.
+
+        :param content: Raw content
+        :param link: The link of the item
+        :param backend: The parser backend (html5lib or tokenizer)
+        :type content: str
+        :type link: str
+        :type backend: str
+        :return: The rendered content
+        :rtype: unicode
+    """
+    if backend == 'tokenizer':
+        return rewrite_content(magic_decoding(content), link)
+    return unicode(magic_parser(magic_decoding(content), link))
+
+def is_current_rendering(rendered_obj):
+    """
+        Check if a rendered content is up to date.
+
+        A content rendered with another parser version or backend is stale.
+
+        :param rendered_obj: The rendered content stream of an item
+        :type rendered_obj: GridOut
+        :return: Up to date or not
+        :rtype: bool
+    """
+    return (rendered_obj.metadata or dict()).get('parser_version') == RENDER_VERSION
+
+def get_prerendered_content(conn, filename, mobile):
+    """
+        Get the prerendered content of an item.
+
+        This fetch the content rendered at ingest time, stale contents are ignored.
+
+        :param conn: A mongo connection
+        :param filename: The filename of the item
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type filename: str
+        :type mobile: bool
+        :return: The rendered content (None if missing or stale)
+        :rtype: unicode
+    """
+    rendered_obj = get_rendered_item(conn, filename, mobile)
+    if not rendered_obj:
+        return None
+    if not is_current_rendering(rendered_obj):
+        return None
+    return read_item_content(conn, rendered_obj).decode('utf-8')
+
+def render_item(conn, content_obj, link, mobile):
+    """
+        Render an item.
+
+        This render the content of an item fetched from the db. The rendered
+        content is looked up in the shared cache first, then in the content
+        prerendered at ingest time. The raw content is only parsed when both
+        are missing (or stale).
+
+        :param conn: A mongo connection
+        :param content_obj: The content stream of the item
+        :param link: The link of the item
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type content_obj: GridOut
+        :type link: str
+        :type mobile: bool
+        :return: The rendered content
+        :rtype: unicode
+    """
+    key = cache_key(content_obj.filename, mobile, RENDER_VERSION)
+    rendered = cache_get(key)
+    if rendered is None:
+        rendered = get_prerendered_content(conn, content_obj.filename, mobile)
+        if rendered is None:
+            rendered = render_content(read_item_content(conn, content_obj), link)
+        cache_set(key, rendered)
+    return rendered
+
+def draw_item(conn, mobile):
+    """
+        Draw a random item and render it.
+
+        :param conn: A mongo connection
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type mobile: bool
+        :return: the title, the link, the rendered content (None if there is no item)
+        :rtype: tuple
+    """
+    item = get_random_item(conn, mobile)
+    if not item:
+        return None
+    title, link, content_obj = item
+    return title, link, render_item(conn, content_obj, link, mobile)
+
+def stream_item(conn, content_obj, link, mobile):
+    """
+        Render an item chunk by chunk.
+
+        This stream the content prerendered at ingest time straight from its
+        chunks. Otherwise the raw content is decoded and rewritten chunk by chunk
+        with the stream rewriter, so the whole page is never loaded in memory.
+
+        :param conn: A mongo connection
+        :param content_obj: The content stream of the item
+        :param link: The link of the item
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type content_obj: GridOut
+        :type link: str
+        :type mobile: bool
+        :return: A generator of utf-8 encoded chunks
+        :rtype: generator
+    """
+    rendered_obj = get_rendered_item(conn, content_obj.filename, mobile)
+    if rendered_obj and is_current_rendering(rendered_obj):
+        for chunk in iter_item_content(conn, rendered_obj):
+            yield chunk
+        return
+    embed_content = get_embed_content(link)
+    if embed_content:
+        yield embed_content.encode('utf-8')
+        return
+    rewriter = StreamRewriter(link)
+    for chunk in iter_magic_decoding(iter_item_content(conn, content_obj)):
+        yield rewriter.feed(chunk).encode('utf-8')
+    yield rewriter.close().encode('utf-8')
+
+def prerender_item(conn, filename, content, link, mobile):
+    """
+        Prerender an item.
+
+        This render the raw content of an item at ingest time and store the result
+        next to the raw content, so the discover page does not have to parse it.
+
+        :param conn: A mongo connection
+        :param filename: The filename of the item
+        :param content: Raw content
+        :param link: The link of the item
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type filename: str
+        :type content: str
+        :type link: str
+        :type mobile: bool
+        :return: Nothing
+        :rtype: None
+    """
+    try:
+        rendered = render_content(content, link)
+    except Exception as err:
+        print err
+        return
+    insert_rendered_item(conn, filename, rendered, RENDER_VERSION, mobile)
+
+def prerender_items(conn, mobile):
+    """
+        Prerender all items of a collection.
+
+        This (re)render every item of one of the data collection regarding the
+        mobile parameter whose rendered content is missing or stale.
+
+        :param conn: A mongo connection
+        :param mobile: The mobile flag
+        :type conn: MongoClient
+        :type mobile: bool
+        :return: The number of rendered items
+        :rtype: int
+    """
+    count = 0
+    for content_obj in find_items(conn, mobile):
+        rendered_obj = get_rendered_item(conn, content_obj.filename, mobile)
+        if rendered_obj and is_current_rendering(rendered_obj):
+            continue
+        link = (content_obj.metadata or dict()).get('link')
+        content = read_item_content(conn, content_obj)
+        prerender_item(conn, content_obj.filename, content, link, mobile)
+        count += 1
+    return count
+
+def prerender_all_items():
+    """
+        Prerender all items for all kind of experiences.
+
+        This (re)render every item whose rendered content is missing or stale,
+        useful after bumping the parser version.
+
+        :return: Nothing
+        :rtype: None
+    """
+    conn = db_connect()
+    print '-- Desktop version --'
+    print '{} items rendered'.format(prerender_items(conn, False))
+    print '-- Mobile version --'
+    print '{} items rendered'.format(prerender_items(conn, True))
+    db_close(conn)
+
+def compare_backends(content, link):
+    """
+        Compare the parser backends on a content.
+
+        Both backends do not output the same html (html5lib fixes broken html),
+        but they must reformat the same attributes to the same values.
+
+        :param content: Raw content
+        :param link: The link of the item
+        :type content: str
+        :type link: str
+        :return: The attributes only found with html5lib, and only with the tokenizer
+        :rtype: tuple
+    """
+    html5lib_attributes = extract_rewritten_attributes(render_content(content, link, 'html5lib'))
+    tokenizer_attributes = extract_rewritten_attributes(render_content(content, link, 'tokenizer'))
+    return html5lib_attributes - tokenizer_attributes, tokenizer_attributes - html5lib_attributes
+
+def verify_backends(limit=1000):
+    """
+        Verify the parser backends are equivalent on the items of the db.
+
+        This compare both parser backends on up to limit items of each experience
+        and print the differences.
+
+        :param limit: The max number of items per experience
+        :type limit: int
+        :return: The number of items with differences
+        :rtype: int
+    """
+    conn = db_connect()
+    count, failures = 0, 0
+    for mobile in [False, True]:
+        for content_obj in find_items(conn, mobile).limit(limit):
+            link = (content_obj.metadata or dict()).get('link')
+            content = read_item_content(conn, content_obj)
+            only_html5lib, only_tokenizer = compare_backends(content, link)
+            count += 1
+            if only_html5lib or only_tokenizer:
+                failures += 1
+                print '-- {} --'.format(link)
+                print 'html5lib only: {}'.format(list(only_html5lib.elements()))
+                print 'tokenizer only: {}'.format(list(only_tokenizer.elements()))
+    print '{} items compared, {} with differences'.format(count, failures)
+    db_close(conn)
+    return failures
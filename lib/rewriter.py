@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""The streaming rewriter methods and class
+"""
+
+from __future__ import unicode_literals
+
+import re
+import cgi
+import collections
+
+from HTMLParser import HTMLParser
+
+from lib.parser import REWRITE_RULES, format_attribute, get_main_url, get_embed_content
+
+def build_rewrite_map(rules):
+    """
+        Build the rewrite map of some rewrite rules.
+
+        :param rules: Some (tags, keyword) rules
+        :type rules: list
+        :return: A map of tag with the keywords to reformat
+        :rtype: dict
+    """
+    rewrite_map = dict()
+    for tags, keyword in rules:
+        for tag in tags:
+            rewrite_map.setdefault(tag, set()).add(keyword)
+    return rewrite_map
+
+REWRITE_MAP = build_rewrite_map(REWRITE_RULES)
+MARKED_SECTION_REGEX = re.compile(r'([a-zA-Z][-_.a-zA-Z0-9]*)\s*')
+MARKED_SECTIONS = ('temp', 'cdata', 'ignore', 'include', 'rcdata', 'if', 'else', 'endif')
+
+class StreamRewriter(HTMLParser):
+    """
+        Define an html rewriter working on chunks of content.
+
+        Tags are rewritten as soon as they are complete, without building any
+        tree, with the same rules as the magic parser (see REWRITE_RULES).
+    """
+    def __init__(self, url):
+        """
+            Initialize a stream rewriter object.
+
+            :param url: Main url of the website
+            :type url: str
+        """
+        HTMLParser.__init__(self)
+        self.main_url = get_main_url(url)
+        self.output = list()
+
+    def feed(self, data):
+        """
+            Rewrite a chunk of content.
+
+            Incomplete tags at the end of the chunk are kept until the next one.
+
+            :param data: A chunk of content
+            :type data: unicode
+            :return: The rewritten content available so far
+            :rtype: unicode
+        """
+        HTMLParser.feed(self, data)
+        return self.flush()
+
+    def close(self):
+        """
+            Rewrite the end of the content.
+
+            :return: The remaining rewritten content
+            :rtype: unicode
+        """
+        HTMLParser.close(self)
+        return self.flush()
+
+    def flush(self):
+        """
+            Get the rewritten content available so far.
+
+            :return: The rewritten content
+            :rtype: unicode
+        """
+        result = ''.join(self.output)
+        self.output = list()
+        return result
+
+    def rewrite_tag(self, tag, attrs, closing):
+        """
+            Rewrite a start tag.
+
+            The original text of the tag is kept if no attribute is reformated.
+
+            :param tag: The tag name
+            :param attrs: The tag attributes
+            :param closing: Self closing tag or not
+            :type tag: str
+            :type attrs: list
+            :type closing: bool
+            :return: Nothing
+            :rtype: None
+        """
+        keywords = REWRITE_MAP.get(tag)
+        if not keywords or not any(k in keywords and v for k, v in attrs):
+            self.output.append(self.get_starttag_text())
+            return
+        parts = [tag]
+        for keyword, value in attrs:
+            if value is None:
+                parts.append(keyword)
+                continue
+            if keyword in keywords and value:
+                value = format_attribute(keyword, value, self.main_url)
+            parts.append('{}="{}"'.format(keyword, cgi.escape(value, quote=True)))
+        self.output.append('<{}{}>'.format(' '.join(parts), '/' if closing else ''))
+
+    def handle_starttag(self, tag, attrs):
+        """
+            Rewrite a start tag.
+        """
+        self.rewrite_tag(tag, attrs, False)
+
+    def handle_startendtag(self, tag, attrs):
+        """
+            Rewrite a self closing tag.
+        """
+        self.rewrite_tag(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        """
+            Keep an end tag.
+        """
+        self.output.append('</{}>'.format(tag))
+
+    def handle_data(self, data):
+        """
+            Keep some text.
+        """
+        self.output.append(data)
+
+    def handle_entityref(self, name):
+        """
+            Keep a named character reference.
+        """
+        self.output.append('&{};'.format(name))
+
+    def handle_charref(self, name):
+        """
+            Keep a numeric character reference.
+        """
+        self.output.append('&#{};'.format(name))
+
+    def handle_comment(self, data):
+        """
+            Keep a comment.
+        """
+        self.output.append('<!--{}-->'.format(data))
+
+    def handle_decl(self, decl):
+        """
+            Keep a doctype declaration.
+        """
+        self.output.append('<!{}>'.format(decl))
+
+    def handle_pi(self, data):
+        """
+            Keep a processing instruction.
+        """
+        self.output.append('<?{}>'.format(data))
+
+    def unknown_decl(self, data):
+        """
+            Keep a CDATA section.
+        """
+        self.output.append('<![{}]>'.format(data))
+
+    def parse_marked_section(self, i, report=1):
+        """
+            Parse a marked section, the unknown or malformed ones (<![foo]>...) are
+            kept as they are.
+        """
+        match = MARKED_SECTION_REGEX.match(self.rawdata, i + 3)
+        if match and match.end() < len(self.rawdata) \
+            and match.group(1).lower() in MARKED_SECTIONS:
+            return HTMLParser.parse_marked_section(self, i, report)
+        end = self.rawdata.find('>', i + 3)
+        if end < 0:
+            return -1
+        self.handle_data(self.rawdata[i:end + 1])
+        return end + 1
+
+    def error(self, message):
+        """
+            Ignore a parse error, the malformed markup is kept as it is instead of
+            breaking the (maybe already streamed) response.
+        """
+        pass
+
+class AttributesExtractor(HTMLParser):
+    """
+        Define an html parser collecting the attributes reformated by the rewrite rules.
+    """
+    def __init__(self):
+        """
+            Initialize an attributes extractor object.
+        """
+        HTMLParser.__init__(self)
+        self.attributes = collections.Counter()
+
+    def handle_starttag(self, tag, attrs):
+        """
+            Collect the attributes of a start tag.
+        """
+        keywords = REWRITE_MAP.get(tag, set())
+        for keyword, value in attrs:
+            if keyword in keywords and value:
+                self.attributes[(tag, keyword, value)] += 1
+
+def rewrite_content(data, url):
+    """
+        Rewrite content in a single pass.
+
+        This is the tokenizer backend of the magic parser: urls are reformated
+        with the same rules, in a single pass and without building any tree.
+
+        :param data: Raw content
+        :param url: Main url of the website
+        :type data: str
+        :type url: str
+        :return: The rewritten content
+        :rtype: unicode
+    """
+    embed_content = get_embed_content(url)
+    if embed_content:
+        return embed_content
+    rewriter = StreamRewriter(url)
+    return rewriter.feed(data) + rewriter.close()
+
+def extract_rewritten_attributes(content):
+    """
+        Extract the attributes reformated by the rewrite rules.
+
+        :param content: Some rendered content
+        :type content: unicode
+        :return: The (tag, keyword, value) attributes with their count
+        :rtype: Counter
+    """
+    extractor = AttributesExtractor()
+    extractor.feed(content)
+    extractor.close()
+    return extractor.attributes
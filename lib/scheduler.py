@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""The politeness scheduler methods and class
+"""
+
+from __future__ import unicode_literals
+
+import time
+import threading
+
+class HostScheduler(object):
+    """
+        Define a scheduler of the requests sent to each host.
+
+        Each host has a token bucket: a request waits only when its host has no
+        token left, requests to other hosts are never delayed.
+    """
+    def __init__(self, default_rate, burst, rates=None):
+        """
+            Initialize a host scheduler object.
+
+            :param default_rate: The default number of requests per second of a host
+            :param burst: The number of requests a host can get at once
+            :param rates: The number of requests per second of some domains (and
+                their subdomains)
+            :type default_rate: float
+            :type burst: int
+            :type rates: dict
+        """
+        self.default_rate = default_rate
+        self.burst = burst
+        self.rates = rates or dict()
+        self.buckets = dict()
+        self.waiting = dict()
+        self.max_waiting = dict()
+        self.waits = 0
+        self.wait_time = 0.0
+        self.lock = threading.Lock()
+
+    def get_rate(self, host):
+        """
+            Get the number of requests per second of a host.
+
+            The rate of the closest configured parent domain is used, the default
+            rate otherwise.
+
+            :param host: A host
+            :type host: str
+            :return: The number of requests per second
+            :rtype: float
+        """
+        labels = host.split('.')
+        for index in range(len(labels)):
+            rate = self.rates.get('.'.join(labels[index:]))
+            if rate:
+                return rate
+        return self.default_rate
+
+    def reserve(self, host):
+        """
+            Take a token from the bucket of a host.
+
+            The bucket is refilled regarding the time elapsed since its last use. A
+            missing token is borrowed, the caller has to wait for it.
+
+            :param host: A host
+            :type host: str
+            :return: The time to wait (in seconds)
+            :rtype: float
+        """
+        rate = self.get_rate(host)
+        now = time.time()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * rate) - 1
+            self.buckets[host] = (tokens, now)
+            if tokens >= 0:
+                return 0
+            self.waiting[host] = self.waiting.get(host, 0) + 1
+            self.max_waiting[host] = max(self.max_waiting.get(host, 0), self.waiting[host])
+            self.waits += 1
+            return -tokens / rate
+
+    def wait(self, host):
+        """
+            Wait until a request can be sent to a host.
+
+            :param host: A host
+            :type host: str
+            :return: The time waited (in seconds)
+            :rtype: float
+        """
+        delay = self.reserve(host)
+        if delay:
+            time.sleep(delay)
+            with self.lock:
+                self.waiting[host] -= 1
+                self.wait_time += delay
+        return delay
+
+    def stats(self):
+        """
+            Get the statistics of the scheduler.
+
+            :return: The number of hosts, the number of requests waiting now, the
+                hosts with the deepest queues (max number of requests waiting at the
+                same time), the number of delayed requests and the total delay
+            :rtype: dict
+        """
+        with self.lock:
+            deepest = sorted(self.max_waiting.items(), key=lambda x: -x[1])[:5]
+            return {
+                'hosts': len(self.buckets),
+                'waiting': sum(self.waiting.values()),
+                'deepest': deepest,
+                'waits': self.waits,
+                'wait_time': self.wait_time
+            }
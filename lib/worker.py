@@ -5,85 +5,164 @@
 
 from __future__ import unicode_literals
 
+import os
 import time
+import socket
+import threading
 
-from lib.db import db_connect, db_close, find_jobs, remove_job
+from lib.config import load_config
+
+from lib.db import db_connect, db_close, create_grid_indexes, create_pool_indexes, \
+    rebuild_links_filter, items_exist_in_db, claim_job, complete_job, fail_job
+
+from lib.drivers import ManagedDriver, reap_orphan_drivers
 
 from lib.feeder import webdriver_init, fetch_and_insert
 
-def remove_pool_job(conn, item):
+from lib.item import format_link
+
+from lib.metrics import time_stage, count_event, start_metrics_file
+
+CONFIG = load_config().get('jobs', dict())
+
+IDLE_MIN_DELAY = CONFIG.get('IDLE_MIN_DELAY', 0.2)
+IDLE_MAX_DELAY = CONFIG.get('IDLE_MAX_DELAY', 10)
+
+def get_worker_id():
+    """
+        Get the identifier of the current worker.
+
+        :return: The worker identifier (host and pid)
+        :rtype: str
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def process_job(conn, driver, mobile, job):
     """
-        Remove a job from the pool.
+        Fetch and insert a job item.
 
-        This remove a specific job from the pool regarding an item as paramater.
+        This fetch html content of the job link and insert parsed content into
+        the db. It uses the same process than the feeder expected that this does
+        not come from rss feeds.
 
         :param conn: A mongo connection
-        :param item: An item
+        :param driver: A web driver
+        :param mobile: The mobile flag
+        :param job: A job document
         :type conn: MongoClient
-        :type item: dict
-        :return: TODO
-        :rtype: TODO
+        :type driver: WebDriver
+        :type mobile: bool
+        :type job: dict
+        :return: Nothing
+        :rtype: None
     """
-    remove_job(conn, {
-        'link': item.get('link'),
-        'username': item.get('username')
-    })
+    fetch_and_insert(conn, driver, mobile, '', job.get('title'), job.get('link'), \
+        job.get('username'), check_exists=False)
 
-def process_job(conn, driver, mobile, items):
+def process_variant(conn, driver, mobile, job, errors):
     """
-        Fetch and insert items.
+        Fetch and insert a job item for one experience.
 
-        This fetch html content of each link item and insert parsed content into
-        the db for one items list. It uses the same process than the feeder expected
-        that this does not come from rss feeds.
+        This is run by each experience thread, the error (if any) is stored into
+        errors regarding the mobile flag.
 
         :param conn: A mongo connection
-        :param driver: A web driver
+        :param driver: The web driver of the experience
         :param mobile: The mobile flag
-        :param item: A list of items
+        :param job: A job document
+        :param errors: The errors of each experience
         :type conn: MongoClient
         :type driver: WebDriver
         :type mobile: bool
-        :type items: list
+        :type job: dict
+        :type errors: dict
         :return: Nothing
         :rtype: None
     """
-    for item in items:
-        print item
-        try:
-            title = item.get('title')
-            link = item.get('link')
-            username = item.get('username')
-            tmp_res = fetch_and_insert(conn, driver, mobile, '', title, link, username)
-            if tmp_res == 'continue':
-                continue
-            remove_pool_job(conn, item)
-        except Exception as err:
-            print err
-            remove_pool_job(conn, item)
-            continue
+    try:
+        process_job(conn, driver, mobile, job)
+    except Exception as err:
+        errors[mobile] = err
+
+def process_variants(conn, drivers, job):
+    """
+        Fetch and insert a job item for all kind of experiences.
+
+        The mobile and desktop experiences are processed at the same time, each
+        one in its own thread with its own web driver. The experiences which
+        already have the item are skipped (checked at once, see items_exist_in_db).
+        The skipped and failed experiences are counted (see lib.metrics).
+
+        :param conn: A mongo connection
+        :param drivers: The web driver of each experience (by mobile flag)
+        :param job: A job document
+        :type conn: MongoClient
+        :type drivers: dict
+        :type job: dict
+        :return: The errors of each experience (empty if both succeeded)
+        :rtype: dict
+    """
+    errors = dict()
+    link = format_link(job.get('link') or '')
+    with time_stage('exists_check', 'jobs'):
+        existing_links = items_exist_in_db(conn, [link])
+    mobiles = [mobile for mobile in [False, True] if link not in existing_links[mobile]]
+    count_event('skips_total', 'jobs', 2 - len(mobiles), link=link, reason='known')
+    threads = [threading.Thread(target=process_variant, \
+        args=(conn, drivers[mobile], mobile, job, errors)) for mobile in mobiles]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    count_event('failures_total', 'jobs', len(errors), link=link, stage='job')
+    return errors
 
 def job_loop():
     """
-        Fetch and insert for all items and all kind of experiences.
+        Fetch and insert for all jobs and all kind of experiences.
 
-        This fetch html content of each link and insert parsed content into the
-        db for one items list for mobile and desktop experiences.
+        This claims the jobs of the pool one by one (several workers can run at
+        the same time, see claim_job), then fetch html content of the job link and
+        insert parsed content into the db for mobile and desktop experiences at the
+        same time. A job is removed once both experiences are processed, or released
+        to be retried when one of them failed. Web drivers get a checkup after each
+        job (see ManagedDriver). An idle worker waits longer and longer (up to
+        IDLE_MAX_DELAY seconds) before claiming again. The metrics are written into
+        the metrics file of the worker (see start_metrics_file).
 
         :return: Nothing
         :rtype: None
     """
     conn = db_connect()
-    desktop_driver = webdriver_init(mobile=False)
-    mobile_driver = webdriver_init(mobile=True)
-    while True:
-        items = find_jobs(conn)
-        if items:
-            process_job(conn, desktop_driver, False, items)
-            time.sleep(0.5)
-            process_job(conn, mobile_driver, True, items)
-        else:
-            time.sleep(0.2)
-    db_close(conn)
-    desktop_driver.close()
-    mobile_driver.close()
+    create_grid_indexes(conn)
+    create_pool_indexes(conn)
+    rebuild_links_filter(force=False)
+    worker_id = get_worker_id()
+    start_metrics_file('worker-{}'.format(worker_id))
+    reap_orphan_drivers()
+    drivers = dict((mobile, ManagedDriver(lambda mobile=mobile: webdriver_init(mobile=mobile))) \
+        for mobile in [False, True])
+    idle_delay = IDLE_MIN_DELAY
+    try:
+        while True:
+            job = claim_job(conn, worker_id)
+            if not job:
+                time.sleep(idle_delay)
+                idle_delay = min(idle_delay * 2, IDLE_MAX_DELAY)
+                continue
+            idle_delay = IDLE_MIN_DELAY
+            print job
+            errors = process_variants(conn, drivers, job)
+            for driver in drivers.values():
+                driver.checkup()
+            if errors:
+                print errors
+                retried = fail_job(conn, job, '; '.join(str(err) for err in errors.values()))
+                count_event('retries_total' if retried else 'dead_letters_total', 'jobs', \
+                    link=job.get('link') or '')
+                continue
+            complete_job(conn, job)
+    finally:
+        db_close(conn)
+        for driver in drivers.values():
+            driver.quit()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""The write-behind storage methods and class
+"""
+
+from __future__ import unicode_literals
+
+import time
+import Queue
+import atexit
+import weakref
+import threading
+
+from lib.config import load_config
+
+from lib.db import create_grid_indexes, insert_items, insert_item, drop_stored_items
+
+from lib.metrics import METRICS, time_stage
+
+CONFIG = load_config().get('storage', dict())
+
+WRITE_BATCH_SIZE = CONFIG.get('WRITE_BATCH_SIZE', 50)
+WRITE_FLUSH_INTERVAL = CONFIG.get('WRITE_FLUSH_INTERVAL', 2.0) # seconds
+WRITE_QUEUE_SIZE = CONFIG.get('WRITE_QUEUE_SIZE', 200)
+WRITE_RETRIES = CONFIG.get('WRITE_RETRIES', 5)
+WRITE_RETRY_DELAY = 1 # seconds, doubled after each failed attempt
+WRITE_PUT_TIMEOUT = 0.5 # seconds between two checks of a closed writer
+ITEM_WRITERS = weakref.WeakSet()
+
+def close_item_writers():
+    """
+        Close all the item writers, so no queued item is lost at exit.
+
+        :return: Nothing
+        :rtype: None
+    """
+    for writer in list(ITEM_WRITERS):
+        writer.close()
+
+atexit.register(close_item_writers)
+
+class PendingItem(object):
+    """
+        Define an item queued to a writer, which tells once it has been written.
+    """
+    def __init__(self, item):
+        """
+            Initialize a pending item object.
+
+            :param item: The item as a (filename, content, meta, mobile) tuple
+            :type item: tuple
+        """
+        self.item = item
+        self.written = False
+        self.done = threading.Event()
+
+    def finish(self, written):
+        """
+            Tell the item has been written, or given up.
+
+            :param written: Written or not
+            :type written: bool
+            :return: Nothing
+            :rtype: None
+        """
+        self.written = written
+        self.done.set()
+
+    def wait(self):
+        """
+            Wait until the item has been written, or given up.
+
+            :return: Written or not
+            :rtype: bool
+        """
+        self.done.wait()
+        return self.written
+
+class ItemWriter(object):
+    """
+        Define a write-behind stage inserting items into the db by batches.
+    """
+    def __init__(self, conn, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL, \
+        queue_size=WRITE_QUEUE_SIZE):
+        """
+            Initialize an item writer object.
+
+            This start the background thread writing the queued items. A batch is
+            written once it has batch_size items, or flush_interval seconds after
+            its first item was queued.
+
+            :param conn: A mongo connection
+            :param batch_size: The max number of items of a batch
+            :param flush_interval: The max time an item waits (in seconds)
+            :param queue_size: The max number of queued items
+            :type conn: MongoClient
+            :type batch_size: int
+            :type flush_interval: float
+            :type queue_size: int
+        """
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.items = Queue.Queue(queue_size)
+        self.stats = {'items': 0, 'batches': 0, 'errors': 0, 'blocked': 0, 'unwritten': 0}
+        self.closed = False
+        self.lock = threading.Lock()
+        create_grid_indexes(conn)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        ITEM_WRITERS.add(self)
+
+    def put(self, filename, content, meta, mobile):
+        """
+            Queue a new item to insert.
+
+            The caller waits when the queue is full, until the writer catches up.
+            Items can't be queued anymore once the writer is closed.
+
+            :param filename: An item link
+            :param content: An item content
+            :param meta: An item metadata
+            :param mobile: The mobile flag
+            :type filename: str
+            :type content: str
+            :type meta: dict
+            :type mobile: bool
+            :return: The pending item, to know if it has been written
+            :rtype: PendingItem
+        """
+        pending = PendingItem((filename, content, meta, mobile))
+        if self.items.full():
+            self.stats['blocked'] += 1
+            METRICS.count('write_blocked_total')
+        while True:
+            with self.lock:
+                if self.closed:
+                    raise Exception('The writer is closed, {} is not queued...'.format(filename))
+                try:
+                    self.items.put(pending, timeout=WRITE_PUT_TIMEOUT)
+                    return pending
+                except Queue.Full:
+                    pass
+
+    def next_batch(self):
+        """
+            Wait for the next batch of items.
+
+            :return: A batch of items (None once the writer is closed and drained)
+            :rtype: list
+        """
+        item = self.items.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                item = self.items.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            if item is None: # closing, write what's left
+                self.items.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def insert(self, items):
+        """
+            Insert some items.
+
+            The items are inserted with bulk writes, the items which have not been
+            inserted (see insert_items) are then inserted item by item. When it's
+            unknown which items have been inserted (the db is not reachable), the
+            items not stored (see drop_stored_items) are inserted again after a
+            delay doubled at each attempt, up to WRITE_RETRIES times.
+
+            :param items: Some items as (filename, content, meta, mobile) tuples
+            :type items: list
+            :return: The items which have not been written
+            :rtype: list
+        """
+        delay = WRITE_RETRY_DELAY
+        for attempt in range(WRITE_RETRIES + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            try:
+                if attempt:
+                    items = drop_stored_items(self.conn, items)
+                failed = insert_items(self.conn, items)
+            except Exception as err:
+                print err
+                self.stats['errors'] += 1
+                METRICS.count('write_errors_total')
+                continue
+            if failed:
+                self.stats['errors'] += 1
+                METRICS.count('write_errors_total')
+            return [item for item in failed if not insert_item(self.conn, *item)]
+        return items
+
+    def write(self, batch):
+        """
+            Insert a batch of queued items (see insert).
+
+            Each pending item is told whether it has been written. The insert time
+            is added to the insert_batch stage (see time_stage).
+
+            :param batch: A batch of pending items
+            :type batch: list
+            :return: Nothing
+            :rtype: None
+        """
+        with time_stage('insert_batch'):
+            unwritten = set(id(item) for item in self.insert([x.item for x in batch]))
+        for pending in batch:
+            pending.finish(id(pending.item) not in unwritten)
+        self.stats['items'] += len(batch) - len(unwritten)
+        self.stats['unwritten'] += len(unwritten)
+        self.stats['batches'] += 1
+        METRICS.count('writes_total', value=len(batch) - len(unwritten))
+        METRICS.count('write_failures_total', value=len(unwritten))
+        METRICS.count('write_batches_total')
+
+    def run(self):
+        """
+            Write the queued items by batches until the writer is closed.
+
+            :return: Nothing
+            :rtype: None
+        """
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            self.write(batch)
+
+    def close(self):
+        """
+            Write the queued items then stop the writer.
+
+            :return: Nothing
+            :rtype: None
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.items.put(None)
+        self.thread.join()
+        ITEM_WRITERS.discard(self)
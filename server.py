@@ -6,30 +6,48 @@
 from __future__ import unicode_literals
 
 import os
+import itertools
 
-from flask import Flask, render_template, request, redirect, session, g
+from flask import Flask, Response, render_template, request, redirect, session, g
 
 from lib.config import load_config
 
-from lib.db import db_connect, get_random_item
+from lib.db import db_connect, create_pool_indexes, get_random_item
 from lib.user import add_user, get_user
 from lib.job import add_job
 
-from lib.parser import magic_decoding, magic_parser, build_discovery_kwargs, parse_title
+from lib.parser import get_discovery_kwargs, parse_title
+from lib.render import draw_item, stream_item
+from lib.prefetch import Prefetcher
 from lib.urls_filter import get_local_unwanted_urls, is_clean_link
 
 CONFIG = load_config()
 MONGO_CONN = db_connect()
 
-DEBUG = os.environ.get('FLASK_DEBUG', True)
+DEBUG = os.environ.get('FLASK_DEBUG', 'True') not in ['False', 'false', '0']
 REDIRECT_CODE = 302
 UNWANTED_URLS_LIST = get_local_unwanted_urls()
 WEBSITE_TITLE = CONFIG.get('WEBSITE_TITLE')
+DISCOVER_STREAMING = CONFIG.get('DISCOVER_STREAMING', False)
+CONTENT_PLACEHOLDER = '<!--randomery-content-->'
 CSS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/css')
+DISCOVERY_CSS_FILES = {
+    mobile: [
+        '{}/shared/shared-discover.css'.format(CSS_FOLDER),
+        '{}/{}the-discover-style.css'.format(CSS_FOLDER, mobile)
+    ] for mobile in ['', 'mobile/']
+}
+
+create_pool_indexes(MONGO_CONN) # a link can only be queued once
+
+PREFETCHERS = {mobile: Prefetcher(MONGO_CONN, mobile) for mobile in [False, True]}
 
 SESSION_USERNAME = '{}-username'.format(WEBSITE_TITLE.lower().strip())
 SESSION_LINK = '{}-link'.format(WEBSITE_TITLE.lower().strip())
 
+for css_files in DISCOVERY_CSS_FILES.values(): # compile styles once at startup
+    get_discovery_kwargs(css_files)
+
 app = Flask(__name__, static_url_path='', template_folder='templates')
 app.secret_key = CONFIG.get('APP_SECRET_KEY')
 
@@ -113,19 +131,19 @@ def logout():
 @app.route('/discover', methods=['GET'])
 def discover():
     """
-        Discover page of the website. Fetch a random item from the db then parse
-        the content, build some inline CSS features and render the template. We add
-        the current link into the session (can be useful).
+        Discover page of the website. Pop a random item already rendered in the
+        background, or fetch a random item from the db then parse the content (or
+        get it from the rendered pages cache or the content rendered at ingest time),
+        build some inline CSS features and render the template. We add the current
+        link into the session (can be useful).
     """
     if SESSION_USERNAME not in session:
         return redirect('/', code=REDIRECT_CODE)
-    title, link, content_obj = get_random_item(MONGO_CONN, g.is_mobile)
-    content = magic_decoding(content_obj.read())
-    parsed_content = magic_parser(content, link)
-    kwargs = build_discovery_kwargs([
-        '{}/shared/shared-discover.css'.format(CSS_FOLDER),
-        '{}/{}the-discover-style.css'.format(CSS_FOLDER, g.mobile)
-    ])
+    if DISCOVER_STREAMING:
+        return discover_streaming()
+    title, link, parsed_content = PREFETCHERS[g.is_mobile].pop() or \
+        draw_item(MONGO_CONN, g.is_mobile)
+    kwargs = get_discovery_kwargs(DISCOVERY_CSS_FILES[g.mobile], check_mtime=DEBUG)
     session[SESSION_LINK] = link
 
     return render_template('discover.html', \
@@ -137,6 +155,28 @@ def discover():
         link=link, \
         **kwargs)
 
+def discover_streaming():
+    """
+        Streaming version of the discover page. The template is rendered around a
+        placeholder, then the header, the content chunks (straight from the db) and
+        the footer are sent with a chunked response.
+    """
+    title, link, content_obj = get_random_item(MONGO_CONN, g.is_mobile)
+    kwargs = get_discovery_kwargs(DISCOVERY_CSS_FILES[g.mobile], check_mtime=DEBUG)
+    session[SESSION_LINK] = link
+    header, footer = render_template('discover.html', \
+        website_title=WEBSITE_TITLE, \
+        mobile=g.mobile, \
+        username=session.get(SESSION_USERNAME), \
+        content=CONTENT_PLACEHOLDER, \
+        title=parse_title(title), \
+        link=link, \
+        **kwargs).split(CONTENT_PLACEHOLDER, 1)
+    return Response(itertools.chain( \
+        [header.encode('utf-8')], \
+        stream_item(MONGO_CONN, content_obj, link, g.is_mobile), \
+        [footer.encode('utf-8')]), mimetype='text/html')
+
 @app.route('/addlink', methods=['GET', 'POST'])
 def addlink():
     """
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""The fetch strategy tests
+"""
+
+from __future__ import unicode_literals
+
+import httplib
+import unittest
+
+import lib.fetcher
+
+from lib.fetcher import needs_browser, fetch_page, fetch_feed, MIN_TEXT_LENGTH
+
+ARTICLE = '<html><head><title>Article</title></head><body><p>{}</p></body></html>'.format( \
+    ' '.join(['word'] * MIN_TEXT_LENGTH))
+
+class NeedsBrowserTest(unittest.TestCase):
+    """
+        Test the guess of the pages which need javascript.
+    """
+    def test_article(self):
+        """
+            A page with enough visible text is fetched with HTTP.
+        """
+        self.assertFalse(needs_browser(ARTICLE))
+
+    def test_empty_body(self):
+        """
+            A page without visible text needs javascript.
+        """
+        self.assertTrue(needs_browser('<html><head><title>App</title></head><body></body></html>'))
+        self.assertTrue(needs_browser(''))
+
+    def test_short_text(self):
+        """
+            The text is counted once its whitespaces are collapsed.
+        """
+        text = 'a' * (MIN_TEXT_LENGTH - 1)
+        self.assertTrue(needs_browser('<p>{}</p>\n\n   \t'.format(text)))
+        self.assertFalse(needs_browser('<p>{}</p><p>a</p>'.format(text)))
+
+    def test_scripts_and_styles(self):
+        """
+            The content of the scripts, styles and noscript tags is not visible text.
+        """
+        hidden = 'x ' * MIN_TEXT_LENGTH
+        for tag in ['script', 'style', 'noscript', 'SCRIPT']:
+            content = '<html><body><{0} type="text/plain">{1}</{0}></body></html>'.format( \
+                tag, hidden)
+            self.assertTrue(needs_browser(content), tag)
+
+    def test_spa_markers(self):
+        """
+            A single page application needs javascript, whatever its text.
+        """
+        for marker in ['<div id="root"></div>', '<div id="app"></div>', \
+            '<div id="__next"></div>', '<html ng-app="app">', '<app-root ng-version="8.0.0">', \
+            '<div data-server-rendered="false"></div>']:
+            self.assertTrue(needs_browser(ARTICLE.replace('<body>', '<body>' + marker)), marker)
+
+class FetchFallbackTest(unittest.TestCase):
+    """
+        Test the fallback to the web driver when the HTTP GET fails.
+    """
+    def setUp(self):
+        """
+            Replace the HTTP GET and the web driver fetch.
+        """
+        self.http_get, self.browser_get = lib.fetcher.http_get, lib.fetcher.browser_get
+        lib.fetcher.browser_get = lambda driver, url: ('<p>rendered</p>', url)
+
+    def tearDown(self):
+        """
+            Restore the HTTP GET and the web driver fetch.
+        """
+        lib.fetcher.http_get, lib.fetcher.browser_get = self.http_get, self.browser_get
+
+    def test_http_exception(self):
+        """
+            A broken HTTP response (bad status line, truncated body...) falls back
+            to the web driver.
+        """
+        for error in [httplib.BadStatusLine(''), httplib.IncompleteRead(b'')]:
+            def failing_get(url, mobile, headers=None):
+                raise error
+            lib.fetcher.http_get = failing_get
+            self.assertEqual(fetch_page(None, 'http://example.com/a', False), \
+                ('<p>rendered</p>', 'http://example.com/a'))
+            self.assertEqual(fetch_feed(None, 'http://example.com/rss', False), b'<p>rendered</p>')
+
+    def test_needs_browser(self):
+        """
+            A page which needs javascript is loaded with the web driver.
+        """
+        lib.fetcher.http_get = lambda url, mobile, headers=None: \
+            (b'<div id="root"></div>', url, {'Content-Type': 'text/html'})
+        self.assertEqual(fetch_page(None, 'http://example.com/a', False), \
+            ('<p>rendered</p>', 'http://example.com/a'))
+        lib.fetcher.http_get = lambda url, mobile, headers=None: \
+            (ARTICLE.encode('utf-8'), url, {'Content-Type': 'text/html; charset=utf-8'})
+        self.assertEqual(fetch_page(None, 'http://example.com/a', False), \
+            (ARTICLE, 'http://example.com/a'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""The rss feeds reader tests
+"""
+
+from __future__ import unicode_literals
+
+import datetime
+import unittest
+
+from lib.reader import iter_entries, parse_date
+
+RSS_FEED = b'''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel><title>Feed</title>
+<item><title>First</title><link>http://example.com/1</link>
+<guid>urn:1</guid><pubDate>Sat, 10 Oct 2026 10:00:00 +0200</pubDate></item>
+<item><title>Second</title><link>http://example.com/2</link>
+<pubDate>Fri, 09 Oct 2026 10:00:00 GMT</pubDate></item>
+</channel></rss>'''
+
+ATOM_FEED = b'''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed</title>
+<entry><title>First</title><id>urn:1</id>
+<link rel="self" href="http://example.com/1.atom"/>
+<link rel="alternate" href="http://example.com/1"/>
+<published>2026-10-10T10:00:00+02:00</published></entry>
+<entry><title>Second</title><id>urn:2</id><link href="http://example.com/2"/>
+<updated>2026-10-09T10:00:00Z</updated></entry>
+</feed>'''
+
+RDF_FEED = b'''<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+    xmlns="http://purl.org/rss/1.0/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel rdf:about="http://example.com/"><title>Feed</title></channel>
+<item rdf:about="http://example.com/1"><title>First</title>
+<link>http://example.com/1</link><dc:date>2026-10-10T08:00:00Z</dc:date></item>
+<item rdf:about="http://example.com/2"><title>Second</title>
+<link>http://example.com/2</link></item>
+</rdf:RDF>'''
+
+class IterEntriesTest(unittest.TestCase):
+    """
+        Test the incremental reading of the rss 2.0, atom and rdf feeds.
+    """
+    def test_rss(self):
+        """
+            The entries of a rss 2.0 feed are read in order, the link is the guid
+            of an entry without guid.
+        """
+        entries = list(iter_entries(RSS_FEED))
+        self.assertEqual(entries, [{
+            'guid': 'urn:1',
+            'title': 'First',
+            'link': 'http://example.com/1',
+            'date': datetime.datetime(2026, 10, 10, 8, 0)
+        }, {
+            'guid': 'http://example.com/2',
+            'title': 'Second',
+            'link': 'http://example.com/2',
+            'date': datetime.datetime(2026, 10, 9, 10, 0)
+        }])
+
+    def test_atom(self):
+        """
+            The entries of an atom feed get their alternate link, and their updated
+            date when they have no published date.
+        """
+        entries = list(iter_entries(ATOM_FEED))
+        self.assertEqual(entries, [{
+            'guid': 'urn:1',
+            'title': 'First',
+            'link': 'http://example.com/1',
+            'date': datetime.datetime(2026, 10, 10, 8, 0)
+        }, {
+            'guid': 'urn:2',
+            'title': 'Second',
+            'link': 'http://example.com/2',
+            'date': datetime.datetime(2026, 10, 9, 10, 0)
+        }])
+
+    def test_rdf(self):
+        """
+            The entries of a rss 1.0 (rdf) feed are identified by their about
+            attribute, the channel is not an entry.
+        """
+        entries = list(iter_entries(RDF_FEED))
+        self.assertEqual(entries, [{
+            'guid': 'http://example.com/1',
+            'title': 'First',
+            'link': 'http://example.com/1',
+            'date': datetime.datetime(2026, 10, 10, 8, 0)
+        }, {
+            'guid': 'http://example.com/2',
+            'title': 'Second',
+            'link': 'http://example.com/2',
+            'date': None
+        }])
+
+    def test_stop_early(self):
+        """
+            Stopping the iteration stops the parsing: a feed broken after its
+            first entries can be read up to them.
+        """
+        content = RSS_FEED.replace(b'</channel></rss>', \
+            b'<item><description>' + b'x' * 100000 + b'</description></item><<broken')
+        entries = iter_entries(content)
+        self.assertEqual(next(entries).get('guid'), 'urn:1')
+        self.assertEqual(next(entries).get('guid'), 'http://example.com/2')
+        entries.close()
+        with self.assertRaises(SyntaxError):
+            list(iter_entries(content))
+
+class ParseDateTest(unittest.TestCase):
+    """
+        Test the parsing of the dates of the feed entries.
+    """
+    def test_dates(self):
+        """
+            RFC 822 and ISO 8601 dates are converted to UTC, other dates are
+            ignored.
+        """
+        self.assertEqual(parse_date('Sat, 10 Oct 2026 10:00:00 -0130'), \
+            datetime.datetime(2026, 10, 10, 11, 30))
+        self.assertEqual(parse_date('2026-10-10 10:00:00.123-01:30'), \
+            datetime.datetime(2026, 10, 10, 11, 30))
+        self.assertEqual(parse_date('2026-10-10T10:00:00'), datetime.datetime(2026, 10, 10, 10, 0))
+        self.assertIsNone(parse_date('yesterday'))
+        self.assertIsNone(parse_date(None))
+
+if __name__ == '__main__':
+    unittest.main()
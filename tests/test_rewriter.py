@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""The streaming rewriter tests
+"""
+
+from __future__ import unicode_literals
+
+import unittest
+
+from lib.parser import magic_parser
+from lib.rewriter import StreamRewriter, rewrite_content, extract_rewritten_attributes
+
+CORPUS = [
+    ('http://example.com/blog/post', '<!DOCTYPE html><html><head><title>Post</title>'
+        '<link rel="stylesheet" href="/css/main.css"><script src="js/app.js"></script>'
+        '<script>var a = "<a href=\\"/not-a-link\\">";</script></head><body>'
+        '<div data-version="v2"><a href="//cdn.example.com/x">x</a>'
+        '<a href="https://other.com/y?a=1&amp;b=2">y</a><a>no href</a><a href="">empty</a>'
+        '<img src="img/a.png" data-icon="/icons/a.svg"></div></body></html>'),
+    ('https://example.com/gallery/', '<html><body><p>caf\xe9</p>'
+        '<img src="/a.png" srcset="/a.png 1x, /a@2x.png 2x">'
+        '<img srcset="small.jpg 480w,  //cdn.example.com/large.jpg 1080w">'
+        '<img srcset="data:image/png;base64,iVBORw0KGgo=, /b.png 2x">'
+        '<img srcset="/c.png">'
+        '<IMG SRC="/upper.png" SrcSet="/upper@2x.png 2x"></body></html>'),
+    ('http://example.com/', '<p>unclosed <a href="/a">a<div data-version="/v">'
+        '<a href="b">b</p><!-- <a href="/comment"> --><img src=/unquoted.png>'
+        '<link href="/feed.xml" rel="alternate">'),
+]
+
+EMBED_LINKS = ['https://www.youtube.com/embed/abc', 'http://www.dailymotion.com/embed/video/x']
+
+class StreamRewriterTest(unittest.TestCase):
+    """
+        Test the streaming rewriter on malformed markup.
+    """
+    def test_unknown_marked_section(self):
+        """
+            An unknown marked section is kept as it is.
+        """
+        content = rewrite_content('<p>a<![foo]>b<img src="/x.png"></p>', 'http://example.com/')
+        self.assertEqual(content, '<p>a<![foo]>b<img src="http://example.com/x.png"></p>')
+
+    def test_malformed_marked_section(self):
+        """
+            A marked section without keyword is kept as it is.
+        """
+        content = rewrite_content('<p>a<![ foo]>b</p>', 'http://example.com/')
+        self.assertEqual(content, '<p>a<![ foo]>b</p>')
+
+    def test_malformed_marked_section_across_chunks(self):
+        """
+            A malformed marked section split between chunks is kept as it is.
+        """
+        rewriter = StreamRewriter('http://example.com/')
+        chunks = ['<p>a<!', '[fo', 'o]>b<img src="/x', '.png"></p>']
+        content = ''.join(rewriter.feed(chunk) for chunk in chunks) + rewriter.close()
+        self.assertEqual(content, '<p>a<![foo]>b<img src="http://example.com/x.png"></p>')
+
+    def test_unterminated_marked_section(self):
+        """
+            An unterminated marked section is kept as text at the end of the content.
+        """
+        content = rewrite_content('<p>a</p><![foo', 'http://example.com/')
+        self.assertEqual(content, '<p>a</p><![foo')
+
+    def test_conditional_comment(self):
+        """
+            A conditional comment is still parsed as a marked section.
+        """
+        content = rewrite_content('<![if !IE]><a href="/y">b</a><![endif]>', 'http://example.com/')
+        self.assertEqual(content, '<![if !IE]><a href="http://example.com/y">b</a><![endif]>')
+
+class BackendsEquivalenceTest(unittest.TestCase):
+    """
+        Test the streaming rewriter against the magic parser on a corpus.
+    """
+    def test_corpus(self):
+        """
+            Both backends reformat the same attributes (srcset included) to the
+            same values.
+        """
+        for url, content in CORPUS:
+            self.assertEqual(extract_rewritten_attributes(rewrite_content(content, url)), \
+                extract_rewritten_attributes(unicode(magic_parser(content, url))), url)
+        self.assertIn(('img', 'srcset', 'https://example.com/a.png 1x, ' \
+            'https://example.com/a@2x.png 2x'), extract_rewritten_attributes( \
+            rewrite_content(CORPUS[1][1], CORPUS[1][0])))
+
+    def test_corpus_by_chunks(self):
+        """
+            The content fed by chunks is rewritten as the whole content.
+        """
+        for url, content in CORPUS:
+            for size in [1, 7, 64]:
+                rewriter = StreamRewriter(url)
+                chunks = [content[i:i + size] for i in range(0, len(content), size)]
+                rewritten = ''.join(rewriter.feed(chunk) for chunk in chunks) + rewriter.close()
+                self.assertEqual(rewritten, rewrite_content(content, url), (url, size))
+
+    def test_embed(self):
+        """
+            The pages of the video providers are embedded the same way.
+        """
+        for url in EMBED_LINKS:
+            content = rewrite_content('<p>video</p>', url)
+            self.assertEqual(content, magic_parser('<p>video</p>', url))
+            self.assertIn('src="{}"'.format(url), content)
+
+if __name__ == '__main__':
+    unittest.main()